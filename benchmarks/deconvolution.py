@@ -0,0 +1,85 @@
+"""
+Throughput (ROIs/s) of the batched AR deconvolution of `workflow_miniscope.deconvolution`
+against OASIS - CaImAn's default `method_deconvolution`, run on one ROI at a time (requires
+the `oasis-deconv` package) - on synthetic calcium traces:
+
+    python benchmarks/deconvolution.py --nrois 500 --nframes 3000 --processes 1 4
+"""
+import json
+import time
+import argparse
+
+import numpy as np
+from scipy import signal
+
+from workflow_miniscope.deconvolution import deconvolve, deconvolve_batch
+
+
+def synthetic_traces(nrois=500, nframes=3000, g=(1.7, -0.712), rate=0.02, noise=0.1, seed=0):
+    """
+    AR(2) calcium traces of random spike trains, on a baseline with Gaussian noise
+    :return: (spikes, traces) - (nrois, nframes) arrays
+    """
+    rng = np.random.default_rng(seed)
+    spikes = (rng.random((nrois, nframes)) < rate) * rng.uniform(0.5, 1.5, (nrois, nframes))
+    calcium = signal.lfilter([1], [1, -g[0], -g[1]], spikes, axis=1)
+    return spikes, 10 + calcium + rng.normal(0, noise, calcium.shape)
+
+
+def _spike_correlation(inferred, spikes):
+    return float(np.mean([np.corrcoef(i, s)[0, 1] for i, s in zip(inferred, spikes)]))
+
+
+def benchmark_oasis(traces, spikes, p=2, nrois=None):
+    """ Reference: OASIS on each of the first `nrois` traces, estimating its AR coefficients """
+    from oasis.functions import deconvolve as oasis_deconvolve
+
+    traces = traces[:nrois]
+    start_time = time.time()
+    inferred = [oasis_deconvolve(trace, g=(None,) * p, penalty=1)[1] for trace in traces]
+    duration = time.time() - start_time
+    return {'mode': 'OASIS per ROI', 'rois_per_sec': len(traces) / duration,
+            'duration': duration, 'spike_correlation': _spike_correlation(inferred, spikes)}
+
+
+def benchmark_batch(traces, spikes, params, n_processes=1, batch_size=200):
+    start_time = time.time()
+    inferred = deconvolve_batch(traces, params, n_processes=n_processes, batch_size=batch_size)
+    duration = time.time() - start_time
+    return {'mode': f'batch ({n_processes} process(es))', 'rois_per_sec': len(traces) / duration,
+            'duration': duration, 'spike_correlation': _spike_correlation(inferred, spikes)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--nrois', type=int, default=500)
+    parser.add_argument('--nframes', type=int, default=3000)
+    parser.add_argument('--p', type=int, default=2, choices=(1, 2))
+    parser.add_argument('--batch-size', type=int, default=200)
+    parser.add_argument('--processes', type=int, nargs='+', default=[1])
+    parser.add_argument('--oasis-rois', type=int, default=None,
+                        help='number of ROIs deconvolved with OASIS (default: all)')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    spikes, traces = synthetic_traces(args.nrois, args.nframes)
+    params = {'p': args.p}
+
+    results = [benchmark_oasis(traces, spikes, p=args.p, nrois=args.oasis_rois)]
+    for n_processes in args.processes:
+        results.append(benchmark_batch(traces, spikes, params, n_processes=n_processes,
+                                       batch_size=args.batch_size))
+    for result in results:
+        result['speedup'] = result['rois_per_sec'] / results[0]['rois_per_sec']
+        print('---- {mode}: {rois_per_sec:.1f} ROIs/s ({speedup:.2f}x OASIS), '
+              'spike correlation {spike_correlation:.3f} ----'.format(**result))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'nrois': args.nrois, 'nframes': args.nframes, 'p': args.p,
+                       'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""
+Import time of the workflow modules, each in a fresh interpreter, and whether importing
+them activates the schemas (i.e. connects to the database). None must: the schemas are
+activated on the first use of the tables of `workflow_miniscope.pipeline`, so that the
+light commands - validating CSV files, scanning session directories or starting the
+command line - work without the database:
+
+    python benchmarks/import_time.py --repeat 5 --output import_time.json
+"""
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+
+modules = ('workflow_miniscope.paths', 'workflow_miniscope.csv_stream',
+           'workflow_miniscope.discovery', 'workflow_miniscope.ingest',
+           'workflow_miniscope.recording_info', 'workflow_miniscope.process',
+           'workflow_miniscope.pipeline')
+
+# run in the fresh interpreter: time the import, then report whether it activated the schemas
+timing_script = '''
+import sys, time, json
+start_time = time.perf_counter()
+import {module}
+pipeline = sys.modules.get('workflow_miniscope.pipeline')
+print(json.dumps({{'duration': time.perf_counter() - start_time,
+                  'activated': getattr(pipeline, '_activated', False)}}))
+'''
+
+
+def time_import(module):
+    """ :return: dict of the import duration (s) and whether the schemas got activated """
+    completed = subprocess.run([sys.executable, '-c', timing_script.format(module=module)],
+                               capture_output=True, text=True)
+    if completed.returncode:
+        return {'error': completed.stderr.strip().splitlines()[-1]}
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='imports per module, the median duration is reported')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    results = []
+    for module in modules:
+        runs = [time_import(module) for _ in range(args.repeat)]
+        errors = [run['error'] for run in runs if 'error' in run]
+        if errors:
+            result = {'module': module, 'error': errors[0]}
+            print(f'---- {module}: failed ({errors[0]}) ----')
+        else:
+            result = {'module': module,
+                      'duration': statistics.median(run['duration'] for run in runs),
+                      'activated': runs[0]['activated']}
+            print(f'---- {module}: {result["duration"] * 1000:.0f} ms'
+                  f'{", activates the schemas" if result["activated"] else ""} ----')
+        results.append(result)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'repeat': args.repeat, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""
+Throughput (frames/s) of the rigid motion correction backends of
+`workflow_miniscope.motion_correction` on a synthetic drifting movie:
+
+    python benchmarks/motion_correction.py --nframes 1000 --size 256
+"""
+import json
+import time
+import argparse
+
+import numpy as np
+
+from workflow_miniscope.motion_correction import backends, fft_apply_shifts
+
+
+def synthetic_drifting_movie(nframes=1000, size=256, ncells=60, max_drift=4, noise=5, seed=0):
+    """
+    Gaussian cells on a smooth background, translated by a bounded random-walk drift
+    :return: (movie (nframes, size, size) float32, template, (nframes, 2) drift)
+    """
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[:size, :size]
+
+    template = 20 + 10 * np.exp(-((y - size / 2) ** 2 + (x - size / 2) ** 2) / (size / 2) ** 2)
+    for cy, cx in rng.uniform(0, size, (ncells, 2)):
+        template += 50 * np.exp(-((y - cy) ** 2 + (x - cx) ** 2) / (2 * 3 ** 2))
+
+    drift = np.clip(np.cumsum(rng.normal(0, 0.3, (nframes, 2)), axis=0), -max_drift, max_drift)
+
+    movie = np.empty((nframes, size, size), dtype=np.float32)
+    for first in range(0, nframes, 100):
+        batch_drift = drift[first:first + 100]
+        movie[first:first + 100] = fft_apply_shifts(
+            np.repeat(template[None].astype(np.float32), len(batch_drift), axis=0), batch_drift)
+    movie += rng.normal(0, noise, movie.shape).astype(np.float32)
+
+    return movie, template, drift
+
+
+def benchmark(backend, movie, template, drift, max_shifts=(6, 6), batch_size=100):
+    register, apply_shifts = backends[backend]
+
+    start_time = time.time()
+    shifts = []
+    for first in range(0, len(movie), batch_size):
+        batch = movie[first:first + batch_size]
+        shifts.append(register(batch, template, max_shifts))
+        apply_shifts(batch, shifts[-1])
+    duration = time.time() - start_time
+
+    # registering shifts undo the drift
+    error = np.abs(np.concatenate(shifts) + drift)
+    return {'backend': backend,
+            'frames_per_sec': len(movie) / duration,
+            'duration': duration,
+            'mean_shift_error': float(error.mean()),
+            'max_shift_error': float(error.max())}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--nframes', type=int, default=1000)
+    parser.add_argument('--size', type=int, default=256)
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--backends', nargs='+', default=sorted(backends))
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    movie, template, drift = synthetic_drifting_movie(args.nframes, args.size)
+
+    results = []
+    for backend in args.backends:
+        try:
+            results.append(benchmark(backend, movie, template, drift, batch_size=args.batch_size))
+        except ImportError as error:
+            print(f'---- Skipped {backend}: {error} ----')
+            continue
+        print('---- {backend}: {frames_per_sec:.1f} frames/s, '
+              'mean shift error {mean_shift_error:.3f} px ----'.format(**results[-1]))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'nframes': args.nframes, 'size': args.size, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
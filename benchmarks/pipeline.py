@@ -0,0 +1,190 @@
+"""
+End-to-end timing of the workflow stages on synthetic Miniscope-DAQ-V4 recordings (see
+`synthetic_recording.py`): ingestion, RecordingInfo, motion correction, summary images,
+segmentation, fluorescence and activity. Runs against the database of the local DataJoint
+configuration (`dj_local_conf.json` or the DJ_HOST/DJ_USER/DJ_PASS environment variables),
+in schemas of their own prefix dropped at the end unless `--keep`:
+
+    python benchmarks/pipeline.py --sessions 2 --nframes 3000 --size 256 --output results.json
+"""
+import json
+import time
+import shutil
+import pathlib
+import argparse
+import tempfile
+
+import datajoint as dj
+
+from synthetic_recording import write_daq_v4_recording
+
+
+subject_name = 'benchmark0'
+motion_correction_params = {'max_shifts': (6, 6), 'splits_rig': 14, 'niter_rig': 1}
+segmentation_params = {'gSig': (3, 3), 'gSiz': (13, 13), 'min_corr': 0.8, 'min_pnr': 10,
+                       'rf': 64, 'stride': 16, 'K': 30, 'p': 1, 'fr': 30, 'decay_time': 0.4,
+                       'method_init': 'corr_pnr', 'center_psf': True, 'merge_thr': 0.8,
+                       'patch_parallel': True}
+
+
+def generate_sessions(root_dir, nsessions, **recording_settings):
+    """ Write `nsessions` synthetic recordings to <root_dir>/<subject_name>/session<i> """
+    session_dirs = []
+    for session_id in range(nsessions):
+        session_dir = root_dir / subject_name / f'session{session_id}'
+        write_daq_v4_recording(session_dir, seed=session_id, **recording_settings)
+        session_dirs.append(session_dir)
+        # the session datetime is the creation time of the first AVI file, at a 1 s
+        # resolution - the sessions must not share the same second
+        time.sleep(1 - time.time() % 1)
+    return session_dirs
+
+
+def time_stage(stage, table, populate, nframes=None):
+    """
+    Time one call to `populate()` - returning the list of (key, error message) of its
+    failed keys - and count the entries it added to `table`
+    """
+    rows = len(table())
+    start_time, start_cpu_time = time.time(), time.process_time()
+    errors = populate() or []
+    duration = time.time() - start_time
+
+    result = {'stage': stage, 'duration': duration,
+              'cpu_time': time.process_time() - start_cpu_time,
+              'rows': len(table()) - rows, 'errors': [str(error) for _, error in errors]}
+    if nframes and result['rows']:
+        result['frames_per_sec'] = nframes * result['rows'] / duration
+    print(f'---- {stage}: {duration:.2f}s, {result["rows"]} entry(s),'
+          f' {len(errors)} error(s) ----')
+    return result
+
+
+def insert_tasks():
+    """ Recording, motion correction and segmentation tasks of every ingested session """
+    from workflow_miniscope.pipeline import miniscope, session
+    from workflow_miniscope.deconvolution import extraction_method
+
+    miniscope.MotionCorrectionParamSet.insert_new_params(
+        motion_correction_method='numpy', motion_correction_paramset_id=0,
+        motion_correction_paramset_desc='Benchmark - chunked rigid motion correction',
+        motion_correction_params=motion_correction_params)
+    miniscope.ProcessingParamSet.insert_new_params(
+        'caiman', 0, 'Benchmark - patch-parallel CNMF-E', segmentation_params)
+    miniscope.ActivityExtractionMethod.insert1({'extraction_method': extraction_method},
+                                               skip_duplicates=True)
+    paramset_pk = miniscope.ProcessingParamSet.primary_key[0]
+
+    for session_key, session_dir in zip(*session.SessionDirectory.fetch('KEY', 'session_dir')):
+        recording_key = dict(session_key, recording_id=0)
+        miniscope.Recording.insert1(dict(recording_key, scanner='Miniscope-DAQ-V4',
+                                         acquisition_software='Miniscope-DAQ-V4',
+                                         recording_directory=session_dir,
+                                         recording_notes='benchmark'))
+        miniscope.MotionCorrectionTask.insert1(dict(
+            recording_key, motion_correction_task_id=0, motion_correction_paramset_id=0,
+            motion_correction_output_dir=f'{session_dir}/motion_correction',
+            motion_correction_task_mode='trigger'))
+        miniscope.ProcessingTask.insert1(dict(
+            recording_key, motion_correction_task_id=0, motion_correction_paramset_id=0,
+            **{paramset_pk: 0}, processing_output_dir=f'{session_dir}/segmentation',
+            task_mode='trigger'), ignore_extra_fields=True)
+
+
+def run_benchmark(root_dir, nframes, n_processes=None):
+    """ :return: list of the results of `time_stage` of every stage """
+    from workflow_miniscope.pipeline import miniscope, session, SummaryImages
+    from workflow_miniscope.ingest import ingest_subjects, ingest_sessions
+    from workflow_miniscope.recording_info import populate_recording_info
+    from workflow_miniscope.motion_correction import populate_motion_correction
+    from workflow_miniscope.segmentation import populate_segmentation
+    from workflow_miniscope.fluorescence import populate_fluorescence
+    from workflow_miniscope.deconvolution import populate_activity
+
+    subjects_csv_path, sessions_csv_path = root_dir / 'subjects.csv', root_dir / 'sessions.csv'
+    subjects_csv_path.write_text('subject,sex,subject_birth_date,subject_description\n'
+                                 f'{subject_name},U,2020-01-01 00:00:01,benchmark\n')
+    sessions_csv_path.write_text('subject,session_dir\n' + ''.join(
+        f'{subject_name},{session_dir.as_posix()}\n'
+        for session_dir in sorted((root_dir / subject_name).iterdir())))
+
+    def ingest():
+        ingest_subjects(subjects_csv_path)
+        ingest_sessions(sessions_csv_path)
+        insert_tasks()
+
+    return [
+        time_stage('ingestion', session.Session, ingest),
+        time_stage('recording_info', miniscope.RecordingInfo,
+                   lambda: populate_recording_info(suppress_errors=True), nframes),
+        time_stage('motion_correction', miniscope.MotionCorrection,
+                   lambda: populate_motion_correction(n_processes=n_processes,
+                                                      suppress_errors=True), nframes),
+        time_stage('summary_images', SummaryImages,
+                   lambda: SummaryImages.populate(suppress_errors=True), nframes),
+        time_stage('segmentation', miniscope.Segmentation,
+                   lambda: populate_segmentation(n_processes=n_processes,
+                                                 suppress_errors=True), nframes),
+        time_stage('fluorescence', miniscope.Fluorescence,
+                   lambda: populate_fluorescence(suppress_errors=True), nframes),
+        time_stage('activity', miniscope.Activity,
+                   lambda: populate_activity(n_processes=n_processes,
+                                             suppress_errors=True), nframes)]
+
+
+def drop_schemas():
+    from workflow_miniscope import pipeline
+
+    for schema in (pipeline.miniscope.schema, pipeline.session.schema,
+                   pipeline.subject.schema, pipeline.lab.schema):
+        schema.drop(force=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sessions', type=int, default=2)
+    parser.add_argument('--nframes', type=int, default=3000)
+    parser.add_argument('--size', type=int, default=256)
+    parser.add_argument('--ncells', type=int, default=50)
+    parser.add_argument('--frames-per-file', type=int, default=1000)
+    parser.add_argument('--processes', type=int, default=None,
+                        help='worker processes of the motion correction, segmentation and'
+                             ' activity stages (default: one per CPU core)')
+    parser.add_argument('--root', help='root data directory of the synthetic recordings'
+                                       ' (default: a temporary directory)')
+    parser.add_argument('--database-prefix', default='benchmark_')
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the schemas and the synthetic recordings')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    root_dir = pathlib.Path(args.root or tempfile.mkdtemp(prefix='miniscope_benchmark_'))
+
+    start_time = time.time()
+    generate_sessions(root_dir, args.sessions, nframes=args.nframes, size=args.size,
+                      ncells=args.ncells, frames_per_file=args.frames_per_file)
+    print(f'---- Generated {args.sessions} recording(s) in {time.time() - start_time:.2f}s ----')
+
+    # the schema prefix and root data directory are read when the pipeline is imported
+    dj.config['safemode'] = False
+    dj.config['custom'] = {**dj.config.get('custom', {}),
+                           'database.prefix': args.database_prefix,
+                           'miniscope_root_data_dir': root_dir.as_posix()}
+    try:
+        results = run_benchmark(root_dir, args.nframes, n_processes=args.processes)
+    finally:
+        if not args.keep:
+            drop_schemas()
+            if not args.root:
+                shutil.rmtree(root_dir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'sessions': args.sessions, 'nframes': args.nframes, 'size': args.size,
+                       'ncells': args.ncells, 'processes': args.processes,
+                       'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""
+Synthetic Miniscope-DAQ-V4 recordings: simulated neurons with calcium transients on a
+fluctuating background, a random-walk drift and sensor noise, written as the `ms*.avi`
+chunks, `metaData.json` and `timeStamps.csv` of the DAQ software:
+
+    python benchmarks/synthetic_recording.py ./data/subject0/session0 --nframes 3000 --size 256
+"""
+import csv
+import json
+import pathlib
+import argparse
+
+import numpy as np
+from scipy import signal
+
+from workflow_miniscope.motion_correction import fft_apply_shifts
+
+
+def simulate_neurons(nframes, size, ncells=50, cell_radius=5, fps=30, rate=0.5,
+                     decay_time=0.4, rng=None):
+    """
+    Gaussian footprints at random positions and their AR(1) calcium traces of Poisson
+    spike trains
+    :return: (footprints (ncells, size * size), traces (ncells, nframes), spikes, centres)
+    """
+    rng = rng or np.random.default_rng()
+    y, x = np.mgrid[:size, :size]
+
+    centres = rng.uniform(cell_radius, size - cell_radius, (ncells, 2))
+    footprints = np.stack([np.exp(-((y - cy) ** 2 + (x - cx) ** 2) / (2 * (cell_radius / 2) ** 2))
+                           for cy, cx in centres]).reshape(ncells, -1).astype(np.float32)
+
+    spikes = rng.poisson(rate / fps, (ncells, nframes)) * rng.uniform(0.5, 1.5, (ncells, nframes))
+    traces = signal.lfilter([1], [1, -np.exp(-1 / (decay_time * fps))], spikes, axis=1)
+    return footprints, traces.astype(np.float32), spikes, centres
+
+
+def write_daq_v4_recording(recording_dir, nframes=3000, size=256, ncells=50, fps=30,
+                           frames_per_file=1000, max_drift=4, noise=3, seed=0):
+    """
+    Write a synthetic Miniscope-DAQ-V4 recording of (`nframes`, `size`, `size`) uint8 frames
+    to `recording_dir`: `ms0.avi`, `ms1.avi`, ... (FFV1, `frames_per_file` frames each),
+    `metaData.json` and `timeStamps.csv`
+    :return: ground truth - dict of footprints, traces, spikes, centres and (nframes, 2) drift
+    """
+    import cv2
+
+    recording_dir = pathlib.Path(recording_dir)
+    recording_dir.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+
+    footprints, traces, spikes, centres = simulate_neurons(nframes, size, ncells, fps=fps,
+                                                           rng=rng)
+    drift = np.clip(np.cumsum(rng.normal(0, 0.2, (nframes, 2)), axis=0), -max_drift, max_drift)
+
+    # vignetted background, slowly fluctuating in brightness
+    y, x = np.mgrid[:size, :size]
+    background = (60 + 40 * np.exp(-((y - size / 2) ** 2 + (x - size / 2) ** 2)
+                                   / (size / 1.5) ** 2)).astype(np.float32)
+    brightness = 1 + 0.05 * np.sin(2 * np.pi * np.arange(nframes) / (60 * fps))
+
+    for file_id, first in enumerate(range(0, nframes, frames_per_file)):
+        frame_ids = np.arange(first, min(first + frames_per_file, nframes))
+        frames = (background[None] * brightness[frame_ids, None, None]
+                  + 80 * (traces[:, frame_ids].T @ footprints).reshape(-1, size, size))
+        frames = fft_apply_shifts(frames, drift[frame_ids])
+        frames += rng.normal(0, noise, frames.shape).astype(np.float32)
+
+        video = cv2.VideoWriter((recording_dir / f'ms{file_id}.avi').as_posix(),
+                                cv2.VideoWriter_fourcc(*'FFV1'), fps, (size, size),
+                                isColor=False)
+        for frame in np.clip(frames, 0, 255).astype(np.uint8):
+            video.write(frame)
+        video.release()
+
+    with open(recording_dir / 'metaData.json', 'w') as f:
+        json.dump({'ROI': {'height': size, 'width': size, 'leftEdge': 0, 'topEdge': 0},
+                   'compression': 'FFV1', 'deviceName': 'Miniscope', 'deviceType': 'Miniscope_V4_BNO',
+                   'frameRate': f'{fps}FPS', 'framesPerFile': frames_per_file,
+                   'gain': 'Low', 'led0': 10, 'ewl': 0}, f, indent=4)
+
+    with open(recording_dir / 'timeStamps.csv', 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['Frame Number', 'Time Stamp (ms)', 'Buffer Index'])
+        writer.writerows((i, int(round(1000 * i / fps)), 0) for i in range(nframes))
+
+    return {'footprints': footprints, 'traces': traces, 'spikes': spikes, 'centres': centres,
+            'drift': drift}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('recording_dir')
+    parser.add_argument('--nframes', type=int, default=3000)
+    parser.add_argument('--size', type=int, default=256)
+    parser.add_argument('--ncells', type=int, default=50)
+    parser.add_argument('--fps', type=int, default=30)
+    parser.add_argument('--frames-per-file', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    write_daq_v4_recording(args.recording_dir, nframes=args.nframes, size=args.size,
+                           ncells=args.ncells, fps=args.fps,
+                           frames_per_file=args.frames_per_file, seed=args.seed)
+    print(f'---- Wrote {args.nframes} frames to {args.recording_dir} ----')
+
+
+if __name__ == '__main__':
+    main()
@@ -57,3 +57,9 @@ miniscope.RecordingInfo.populate(**populate_settings)
 # Deconvolution ----------------------------------------------------------------
 # miniscope.Activity.populate(**populate_settings)
 
+
+# Parallel processing ----------------------------------------------------------
+# Alternatively, populate all the stages above for every pending recording with a
+# pool of worker processes (one per CPU core by default)
+# from workflow_miniscope import process
+# process.run(workers={'Segmentation': 4})
@@ -34,4 +34,7 @@ setup(
     keywords='neuroscience datajoint calcium-imaging miniscope',
     packages=find_packages(exclude=['contrib', 'docs', 'tests*']),
     install_requires=requirements,
+    entry_points={
+        'console_scripts': ['workflow-miniscope=workflow_miniscope.cli:main'],
+    },
 )
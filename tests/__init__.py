@@ -11,7 +11,8 @@ import numpy as np
 
 
 from workflow_miniscope.paths import get_miniscope_root_data_dir
-from workflow_miniscope.pipeline import Equipment
+# `pipeline` is imported within the fixtures: the tests without database fixtures
+# (e.g. test_traces, test_sweep) run without connecting to the database
 
 
 
@@ -588,6 +589,66 @@ def recording(pipeline, ingest_sessions):
     miniscope.RecordingInfo.delete()
 
 
+@pytest.fixture
+def synthetic_recording(pipeline, ingest_subjects, tmp_path):
+    """
+    Small unprocessed Miniscope-DAQ-V4 recording in a temporary root data directory,
+    with a 'trigger' task of the 'numpy' chunked motion correction
+    """
+    import cv2
+    import json
+    miniscope, session = pipeline['miniscope'], pipeline['session']
+
+    nframes, size = 120, 48
+    recording_dir = tmp_path / 'LO012' / 'synthetic'
+    recording_dir.mkdir(parents=True)
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[:size, :size]
+    template = 20 + sum(100 * np.exp(-((y - cy) ** 2 + (x - cx) ** 2) / 6)
+                        for cy, cx in rng.uniform(8, size - 8, (15, 2)))
+    movie = np.clip(template[None] + rng.normal(0, 3, (nframes, size, size)), 0, 255)
+    video = cv2.VideoWriter((recording_dir / 'ms0.avi').as_posix(),
+                            cv2.VideoWriter_fourcc(*'FFV1'), 30, (size, size), isColor=False)
+    for frame in movie.astype(np.uint8):
+        video.write(frame)
+    video.release()
+    (recording_dir / 'metaData.json').write_text(json.dumps(
+        {'ROI': {'height': size, 'width': size}, 'frameRate': '30FPS', 'gain': 'Low',
+         'led0': 10}))
+    (recording_dir / 'timeStamps.csv').write_text(
+        'Frame Number,Time Stamp (ms),Buffer Index\n'
+        + ''.join(f'{i},{round(1000 * i / 30)},0\n' for i in range(nframes)))
+
+    # the temporary root first: the outputs are written to the primary root
+    custom = dj.config['custom']
+    dj.config['custom'] = {**custom, 'miniscope_root_data_dir': [
+        tmp_path.as_posix(), custom['miniscope_root_data_dir']]}
+
+    session_key = dict(subject='LO012', session_datetime='2021-08-26 10:00:00')
+    recording_key = dict(session_key, recording_id=0)
+    pipeline['Equipment'].insert1(('UCLA Miniscope',), skip_duplicates=True)
+    session.Session.insert1(session_key)
+    miniscope.Recording.insert1(dict(recording_key, scanner='UCLA Miniscope',
+                                     acquisition_software='Miniscope-DAQ-V4',
+                                     recording_directory='LO012/synthetic',
+                                     recording_notes=''))
+    miniscope.MotionCorrectionParamSet.insert_new_params(
+        motion_correction_method='numpy', motion_correction_paramset_id=0,
+        motion_correction_paramset_desc='Test - chunked rigid motion correction',
+        motion_correction_params={'max_shifts': (6, 6), 'splits_rig': 4,
+                                  'num_frames_split': 10, 'niter_rig': 1})
+    miniscope.MotionCorrectionTask.insert1(dict(
+        recording_key, motion_correction_task_id=0, motion_correction_paramset_id=0,
+        motion_correction_output_dir='LO012/synthetic/motion_correction',
+        motion_correction_task_mode='trigger'))
+
+    yield recording_key
+
+    (miniscope.Recording & recording_key).delete()
+    (miniscope.MotionCorrectionParamSet & {'motion_correction_paramset_id': 0}).delete()
+    dj.config['custom'] = custom
+
+
 @pytest.fixture
 def curations(recording, pipeline):
     miniscope = pipeline['miniscope']
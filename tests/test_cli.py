@@ -0,0 +1,64 @@
+import datajoint as dj
+import pytest
+
+from . import dj_config
+
+
+def test_ingest_dry_run(tmp_path):
+    from workflow_miniscope.cli import main
+    from workflow_miniscope.paths import clear_path_cache
+
+    (tmp_path / 'LO012' / 'session0').mkdir(parents=True)
+    (tmp_path / 'LO012' / 'session0' / 'ms0.avi').touch()
+    (tmp_path / 'LO012' / 'session1').mkdir(parents=True)
+
+    subjects_csv_path, sessions_csv_path = tmp_path / 'subjects.csv', tmp_path / 'sessions.csv'
+    subjects_csv_path.write_text('subject,sex,subject_birth_date\n'
+                                 'LO012,F,2020-01-01 00:00:01\n')
+    sessions_csv_path.write_text('subject,session_dir\n'
+                                 f'LO012,{(tmp_path / "LO012" / "session0").as_posix()}\n')
+
+    custom = dj.config['custom']
+    dj.config['custom'] = {**custom, 'miniscope_root_data_dir': str(tmp_path)}
+    try:
+        clear_path_cache()
+        assert main(['ingest', '--subjects', str(subjects_csv_path),
+                     '--sessions', str(sessions_csv_path), '--dry-run']) == 0
+
+        # a session directory without recording
+        with open(sessions_csv_path, 'a') as f:
+            f.write(f'LO012,{(tmp_path / "LO012" / "session1").as_posix()}\n')
+        assert main(['ingest', '--sessions', str(sessions_csv_path), '--dry-run']) == 1
+
+        # a row without its session directory: reported
+        sessions_csv_path.write_text('subject,session_dir\n'
+                                     f'LO012,{(tmp_path / "LO012" / "session0").as_posix()}\n'
+                                     'LO012,\n')
+        assert main(['ingest', '--sessions', str(sessions_csv_path), '--dry-run']) == 1
+    finally:
+        dj.config['custom'] = custom
+        clear_path_cache()
+
+
+def test_parser():
+    from workflow_miniscope.cli import get_parser
+
+    args = get_parser().parse_args(['worker', '--processes', '4', '--stages', 'RecordingInfo',
+                                    'MotionCorrection', '--once'])
+    assert (args.processes, args.stages, args.mode, args.once) == (
+        4, ['RecordingInfo', 'MotionCorrection'], 'pipelined', True)
+
+    with pytest.raises(SystemExit):
+        get_parser().parse_args([])
+
+
+def test_init_worker():
+    # Ctrl+C of `worker` is handled by the parent process only
+    import signal
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    from workflow_miniscope.process import init_worker
+
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=init_worker, initargs=({},)) as executor:
+        assert executor.submit(signal.getsignal, signal.SIGINT).result() == signal.SIG_IGN
@@ -0,0 +1,118 @@
+import numpy as np
+import pytest
+from scipy import signal, linalg
+
+
+def _simulate_traces(ntraces=20, nframes=600, g=(1.7, -0.712), noise=0.1, seed=0):
+    rng = np.random.default_rng(seed)
+    spikes = (rng.random((ntraces, nframes)) < 0.02) * rng.uniform(0.5, 1.5, (ntraces, nframes))
+    calcium = signal.lfilter([1], [1, -g[0], -g[1]], spikes, axis=1)
+    return spikes, 10 + calcium + rng.normal(0, noise, calcium.shape)
+
+
+def test_estimate_ar():
+    from workflow_miniscope.deconvolution import estimate_noise, estimate_ar
+
+    _, traces = _simulate_traces()
+    sn = estimate_noise(traces)
+    g = estimate_ar(traces, sn, p=2, lags=5, fudge_factor=1)
+
+    # per-ROI Yule-Walker least squares
+    for trace, trace_sn, trace_g in zip(traces, sn, g):
+        centered = trace - trace.mean()
+        xc = np.correlate(centered, centered, mode='full')[len(trace) - 1:] / len(trace)
+        A = linalg.toeplitz(xc[:7], xc[:2]) - trace_sn ** 2 * np.eye(7, 2)
+        expected = np.linalg.lstsq(A, xc[1:8], rcond=None)[0]
+        assert np.allclose(trace_g, expected)
+
+
+def test_deconvolve_batch():
+    # the traces are not coupled: each gets the result it gets when deconvolved on its own
+    from workflow_miniscope.deconvolution import deconvolve
+
+    spikes, traces = _simulate_traces()
+    batch = deconvolve(traces, p=2)
+
+    for k, trace in enumerate(traces):
+        single = deconvolve(trace, p=2)
+        for name in ('spikes', 'calcium', 'baseline', 'g', 'sn'):
+            assert np.allclose(batch[name][k], single[name][0], atol=1e-8), name
+
+    assert np.allclose(batch['baseline'], 10, atol=0.5)
+    assert np.mean([np.corrcoef(inferred, true)[0, 1]
+                    for inferred, true in zip(batch['spikes'], spikes)]) > 0.8
+
+
+def test_deconvolve_reference():
+    # the same problem for the AR coefficients and noise levels found by `deconvolve`,
+    # solved over the spikes with a bound-constrained quasi-Newton method
+    from scipy import optimize
+    from workflow_miniscope.deconvolution import deconvolve, ar_filter
+
+    _, traces = _simulate_traces(ntraces=3, nframes=300)
+    result = deconvolve(traces, p=2)
+    assert result['converged'].all()
+
+    for k, trace in enumerate(traces):
+        g = result['g'][[k]]
+        kernel = ar_filter(np.eye(len(trace)), np.repeat(g, len(trace), axis=0)).T
+        penalty = result['sn'][k] * np.linalg.norm(kernel[:, 0])
+
+        def objective(x):
+            residual = trace - x[-1] - kernel @ x[:-1]
+            gradient = np.append(penalty - kernel.T @ residual, -residual.sum())
+            return 0.5 * residual @ residual + penalty * x[:-1].sum(), gradient
+
+        reference = optimize.minimize(
+            objective, np.append(np.zeros(len(trace)), trace.mean()), jac=True,
+            method='L-BFGS-B', bounds=[(0, None)] * len(trace) + [(None, None)],
+            options={'maxiter': 10000, 'ftol': 1e-14, 'gtol': 1e-10})
+
+        assert np.isclose(objective(np.append(result['spikes'][k], result['baseline'][k]))[0],
+                          reference.fun, rtol=1e-4)
+        assert np.allclose(result['calcium'][k], kernel @ reference.x[:-1],
+                           atol=0.02 * np.ptp(result['calcium'][k]))
+
+
+def test_deconvolve_not_converged():
+    from workflow_miniscope.deconvolution import deconvolve
+
+    _, traces = _simulate_traces(ntraces=2)
+    with pytest.warns(RuntimeWarning, match='did not converge'):
+        result = deconvolve(traces, max_iter=3)
+    assert not result['converged'].any()
+
+
+def test_oasis():
+    # OASIS (CaImAn's default `method_deconvolution`) on each trace, for the AR coefficients
+    # and noise levels found by `deconvolve`
+    oasis = pytest.importorskip('oasis.functions')
+    from workflow_miniscope.deconvolution import deconvolve
+
+    spikes, traces = _simulate_traces()
+    result = deconvolve(traces, p=2)
+
+    for k, trace in enumerate(traces):
+        c, s, b, g, lam = oasis.deconvolve(trace, g=tuple(result['g'][k]), sn=result['sn'][k],
+                                           penalty=1)
+        # OASIS constrains the residual to the noise level instead of penalising the spikes
+        assert np.corrcoef(result['calcium'][k], c)[0, 1] > 0.99
+        assert np.corrcoef(result['spikes'][k], s)[0, 1] > 0.9
+        assert np.isclose(result['baseline'][k], b, atol=0.1)
+
+
+def test_constrained_foopsi():
+    caiman_deconvolution = pytest.importorskip('caiman.source_extraction.cnmf.deconvolution')
+    from workflow_miniscope.deconvolution import deconvolve
+
+    spikes, traces = _simulate_traces(ntraces=5)
+    result = deconvolve(traces, p=2, fudge_factor=0.96)
+
+    for k, trace in enumerate(traces):
+        c, bl, c1, g, sn, sp, lam = caiman_deconvolution.constrained_foopsi(
+            trace, p=2, fudge_factor=0.96, method_deconvolution='oasis')
+        assert np.isclose(result['sn'][k], sn)
+        assert np.allclose(result['g'][k], g)
+        # CaImAn constrains the residual to the noise level instead of penalising the spikes
+        assert np.corrcoef(result['spikes'][k], sp)[0, 1] > 0.9
+        assert np.corrcoef(result['calcium'][k], c)[0, 1] > 0.95
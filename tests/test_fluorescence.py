@@ -0,0 +1,46 @@
+import numpy as np
+
+
+def test_extract_traces():
+    from workflow_miniscope.fluorescence import mask_matrix, extract_traces
+
+    rng = np.random.default_rng(0)
+    movie = rng.uniform(0, 255, (250, 30, 40)).astype(np.float32)
+    ypix = [np.array([1, 1, 2]), np.arange(10, 20)]
+    xpix = [np.array([3, 4, 3]), np.arange(20, 30)]
+    weights = [np.array([1., 2., 1.]), rng.random(10)]
+
+    traces = extract_traces(movie, mask_matrix(ypix, xpix, weights, movie.shape[1:]),
+                            block_size=64)
+
+    assert traces.shape == (2, len(movie))
+    for trace, y, x, w in zip(traces, ypix, xpix, weights):
+        assert np.allclose(trace, movie[:, y, x] @ w / w.sum(), rtol=1e-4)
+
+
+def test_mask_matrix_zero_weights():
+    from workflow_miniscope.fluorescence import mask_matrix, extract_traces
+
+    movie = np.arange(2 * 4 * 5, dtype=np.float32).reshape((2, 4, 5))
+    masks = mask_matrix([np.array([0, 1])], [np.array([2, 2])], [np.zeros(2)], movie.shape[1:])
+
+    traces = extract_traces(movie, masks)
+    assert np.array_equal(traces[0], movie[:, [0, 1], [2, 2]].mean(axis=1))
+
+
+def test_extract_traces_no_masks():
+    from workflow_miniscope.fluorescence import mask_matrix, extract_traces
+
+    class Movie:
+        # no frame read without masks
+        shape = (5, 8, 8)
+
+        def __len__(self):
+            return self.shape[0]
+
+        def __getitem__(self, item):
+            raise AssertionError('frames read')
+
+    masks = mask_matrix([], [], [], Movie.shape[1:])
+    assert masks.shape == (0, 64)
+    assert extract_traces(Movie(), masks).shape == (0, 5)
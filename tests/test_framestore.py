@@ -0,0 +1,62 @@
+import json
+
+import numpy as np
+import pytest
+
+
+def write_avi(filepath, frames, fps=30):
+    import cv2
+
+    video = cv2.VideoWriter(str(filepath), cv2.VideoWriter_fourcc(*'FFV1'), fps,
+                            frames.shape[:0:-1], isColor=False)
+    for frame in frames:
+        video.write(frame)
+    video.release()
+
+
+def test_build_frame_store(tmp_path):
+    from workflow_miniscope.framestore import build_frame_store, open_frame_store, FrameStore
+
+    rng = np.random.default_rng(0)
+    movie = rng.integers(0, 256, (25, 16, 24), dtype=np.uint8)
+    recording_dir = tmp_path / 'session0'
+    recording_dir.mkdir()
+    write_avi(recording_dir / 'ms0.avi', movie[:10])
+    write_avi(recording_dir / 'ms1.avi', movie[10:])
+
+    frame_store = build_frame_store(recording_dir)
+    assert frame_store.shape == movie.shape and frame_store.dtype == np.uint8
+    assert np.array_equal(frame_store[:], movie)  # FFV1 is lossless
+    assert np.array_equal(np.concatenate([block for _, block in frame_store.iter_blocks(7)]),
+                          movie)
+    assert not list(tmp_path.glob('*.tmp'))
+
+    # reopened as is while up to date
+    build_id = frame_store.header['build_id']
+    assert open_frame_store(recording_dir).header['build_id'] == build_id
+
+    # rebuilt once the recording changes
+    write_avi(recording_dir / 'ms2.avi', movie[:5])
+    assert FrameStore(recording_dir).is_stale()
+    frame_store = open_frame_store(recording_dir)
+    assert frame_store.header['build_id'] != build_id and len(frame_store) == 30
+
+
+def test_empty_frame_store(tmp_path):
+    from workflow_miniscope.framestore import FrameStore, get_frame_store_paths
+
+    data_path, header_path = get_frame_store_paths(tmp_path / 'session0')
+    data_path.touch()
+    header_path.write_text(json.dumps({'shape': [0, 16, 24], 'dtype': 'uint8',
+                                       'source_files': [], 'build_id': '0'}))
+
+    frame_store = FrameStore(tmp_path / 'session0')
+    assert len(frame_store) == 0 and frame_store.shape == (0, 16, 24)
+    assert list(frame_store.iter_blocks()) == []
+
+
+def test_build_frame_store_no_avi(tmp_path):
+    from workflow_miniscope.framestore import build_frame_store
+
+    with pytest.raises(FileNotFoundError):
+        build_frame_store(tmp_path)
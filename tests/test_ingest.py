@@ -26,3 +26,80 @@ def test_ingest_sessions(pipeline, sessions_csv, ingest_sessions):
     assert (session.SessionDirectory
             & {'subject': sess.name}).fetch1('session_dir') == sess_dir.as_posix()
 
+
+
+def test_ingest_sessions_rerun(pipeline, sessions_csv, ingest_sessions):
+    from workflow_miniscope.ingest import ingest_sessions as _ingest_sessions
+    session = pipeline['session']
+
+    session_count = len(session.Session())
+
+    _, sessions_csv_path = sessions_csv
+    _ingest_sessions(sessions_csv_path, chunk_size=1)
+
+    assert len(session.Session()) == session_count
+
+
+def test_discover_sessions(pipeline, sessions_csv):
+    from workflow_miniscope.discovery import discover_sessions
+
+    sessions, _ = sessions_csv
+    session_dirs = [pathlib.Path(c.session_dir).as_posix() for c in discover_sessions()]
+
+    assert set(sessions.session_dir) <= set(session_dirs)
+
+
+def test_scan_manifest(sessions_csv, tmp_path):
+    from workflow_miniscope.manifest import ScanManifest
+
+    sessions, _ = sessions_csv
+
+    with ScanManifest(tmp_path / 'scan_manifest.sqlite') as manifest:
+        scanned = list(manifest.scan_session_dirs(sessions.session_dir))
+        assert manifest.rescanned_count == len(sessions)
+
+    with ScanManifest(tmp_path / 'scan_manifest.sqlite') as manifest:
+        assert list(manifest.scan_session_dirs(sessions.session_dir)) == scanned
+        assert manifest.rescanned_count == 0
+
+
+def test_ingest_subjects_stream(pipeline, subjects_csv):
+    from workflow_miniscope.ingest import ingest_subjects
+    subject = pipeline['subject']
+
+    _, subjects_csv_path = subjects_csv
+    ingest_subjects(subjects_csv_path, stream=True, chunk_size=1)
+
+    assert len(subject.Subject()) == 1
+    assert not subjects_csv_path.with_name(subjects_csv_path.name + '.checkpoint').exists()
+
+
+def test_round_to_second():
+    from datetime import datetime
+    from workflow_miniscope.discovery import round_to_second
+
+    # as MySQL rounds fractional seconds on insert into a `datetime` column
+    assert round_to_second(datetime(2021, 8, 25, 23, 45, 44, 499999)) == datetime(2021, 8, 25, 23, 45, 44)
+    assert round_to_second(datetime(2021, 8, 25, 23, 45, 44, 500000)) == datetime(2021, 8, 25, 23, 45, 45)
+    assert round_to_second(datetime(2021, 8, 25, 23, 59, 59, 900000)) == datetime(2021, 8, 26, 0, 0, 0)
+
+
+def test_discover_sessions_unreadable_dir(tmp_path, monkeypatch):
+    import os
+    from workflow_miniscope.discovery import discover_sessions
+
+    for session in ('session0', 'session1'):
+        (tmp_path / 'LO012' / session).mkdir(parents=True)
+        (tmp_path / 'LO012' / session / 'ms0.avi').touch()
+
+    scandir = os.scandir
+
+    def failing_scandir(path):
+        if pathlib.Path(path).name == 'session1':
+            raise PermissionError(13, 'Permission denied', str(path))
+        return scandir(path)
+
+    monkeypatch.setattr(os, 'scandir', failing_scandir)
+    session_dirs = [c.session_dir for c in discover_sessions(tmp_path)]
+
+    assert session_dirs == [tmp_path / 'LO012' / 'session0']
@@ -0,0 +1,65 @@
+from . import dj_config
+
+
+def test_prometheus_file(tmp_path):
+    from workflow_miniscope.metrics import update_prometheus_file
+
+    prom_file = tmp_path / 'miniscope.prom'
+    record = {'wall_time': 2.5, 'cpu_time': 2., 'peak_rss': 2 ** 20, 'bytes_read': 1000,
+              'rows_inserted': 3, 'error': None}
+    update_prometheus_file(prom_file, 'Segmentation', record)
+    update_prometheus_file(prom_file, 'Segmentation', dict(record, wall_time=1.5, error='Error'))
+    update_prometheus_file(prom_file, 'Fluorescence', record)
+
+    samples = dict(line.rsplit(' ', 1) for line in prom_file.read_text().splitlines()
+                   if not line.startswith('#'))
+    assert float(samples['miniscope_stage_calls_total{stage="Segmentation"}']) == 2
+    assert float(samples['miniscope_stage_errors_total{stage="Segmentation"}']) == 1
+    assert float(samples['miniscope_stage_wall_seconds_total{stage="Segmentation"}']) == 4
+    assert float(samples['miniscope_stage_max_wall_seconds{stage="Segmentation"}']) == 2.5
+    assert float(samples['miniscope_stage_rows_inserted_total{stage="Fluorescence"}']) == 3
+
+
+def test_prometheus_file_precision(tmp_path):
+    from workflow_miniscope.metrics import update_prometheus_file
+
+    prom_file = tmp_path / 'miniscope.prom'
+    record = {'wall_time': 1234567.123456, 'cpu_time': 0.1, 'peak_rss': 2 ** 40 + 1,
+              'bytes_read': 10 ** 15 + 1, 'rows_inserted': 3, 'error': None}
+    for _ in range(3):
+        update_prometheus_file(prom_file, 'Segmentation', record)
+
+    samples = dict(line.rsplit(' ', 1) for line in prom_file.read_text().splitlines()
+                   if not line.startswith('#'))
+    assert samples['miniscope_stage_bytes_read_total{stage="Segmentation"}'] == str(
+        3 * (10 ** 15 + 1))
+    assert samples['miniscope_stage_peak_rss_bytes{stage="Segmentation"}'] == str(2 ** 40 + 1)
+    assert float(samples['miniscope_stage_wall_seconds_total{stage="Segmentation"}']) == (
+        1234567.123456 + 1234567.123456 + 1234567.123456)
+
+
+def test_measure_stage_rows(monkeypatch):
+    from workflow_miniscope import metrics
+
+    class Table:
+        # counted only for the calls of one key
+        def __init__(self):
+            self.rows = []
+
+        def __and__(self, key):
+            if key is None or not isinstance(key, dict):
+                raise AssertionError('whole table counted')
+            return [row for row in self.rows if row['id'] == key['id']]
+
+    records = []
+    monkeypatch.setattr(metrics, '_save_record', records.append)
+    table = Table()
+
+    with metrics.measure_stage('Stage', {'id': 1}, table):
+        table.rows += [{'id': 1}, {'id': 1}, {'id': 2}]
+    with metrics.measure_stage('Stage', None, table):
+        table.rows.append({'id': 1})
+    with metrics.measure_stage('Stage') as record:
+        record['rows_inserted'] = 5
+
+    assert [record['rows_inserted'] for record in records] == [2, None, 5]
@@ -0,0 +1,70 @@
+import numpy as np
+
+
+def test_fft_register():
+    from workflow_miniscope.motion_correction import fft_register, fft_apply_shifts
+
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[:64, :64]
+    template = sum(np.exp(-((y - cy) ** 2 + (x - cx) ** 2) / 8)
+                   for cy, cx in rng.uniform(8, 56, (20, 2))).astype(np.float32)
+
+    drift = rng.uniform(-4, 4, (10, 2))
+    frames = fft_apply_shifts(np.repeat(template[None], len(drift), axis=0), drift)
+
+    shifts = fft_register(frames, template, max_shifts=(6, 6), upsample_factor=10)
+
+    assert np.allclose(shifts, -drift, atol=0.1)
+    assert np.allclose(fft_apply_shifts(frames, shifts), template, atol=0.05 * template.max())
+
+
+def test_stitch_shifts():
+    from workflow_miniscope.motion_correction import split_blocks, stitch_shifts
+
+    blocks = split_blocks(1000, splits_rig=4, num_frames_split=50)
+    drift = np.cumsum(np.full((1000, 2), 0.01), axis=0)
+
+    # each block registered against a template offset by a different constant
+    block_shifts = [drift[start:stop] + i for i, (start, stop, _, _) in enumerate(blocks)]
+
+    assert np.allclose(stitch_shifts(blocks, block_shifts), drift)
+
+
+def test_motion_correct_chunked(tmp_path):
+    import cv2
+    from workflow_miniscope.motion_correction import motion_correct_chunked, fft_apply_shifts
+    from workflow_miniscope.framestore import FrameStore
+
+    rng = np.random.default_rng(1)
+    y, x = np.mgrid[:48, :48]
+    template = 20 + sum(100 * np.exp(-((y - cy) ** 2 + (x - cx) ** 2) / 6)
+                        for cy, cx in rng.uniform(8, 40, (15, 2)))
+    drift = np.clip(np.cumsum(rng.normal(0, 0.5, (120, 2)), axis=0), -3, 3)
+    movie = np.clip(np.round(fft_apply_shifts(np.repeat(template[None], len(drift), axis=0),
+                                              drift)), 0, 255).astype(np.uint8)
+
+    recording_dir = tmp_path / 'session0'
+    recording_dir.mkdir()
+    video = cv2.VideoWriter(str(recording_dir / 'ms0.avi'), cv2.VideoWriter_fourcc(*'FFV1'),
+                            30, (48, 48), isColor=False)
+    for frame in movie:
+        video.write(frame)
+    video.release()
+
+    results = motion_correct_chunked(recording_dir, tmp_path / 'motion_correction',
+                                     {'max_shifts': (6, 6), 'splits_rig': 4,
+                                      'num_frames_split': 10, 'niter_rig': 1},
+                                     n_processes=1, backend='numpy', batch_size=16)
+
+    # registered to the mean of the frames: the shifts undo the drift up to a constant
+    shifts = results['shifts']
+    assert shifts.shape == drift.shape
+    residual = shifts + drift
+    assert np.allclose(residual, np.median(residual, axis=0), atol=0.25)
+
+    registered = FrameStore(tmp_path / 'motion_correction' / 'motion_corrected')
+    assert registered.shape == movie.shape and registered.dtype == np.uint8
+    registered_error = np.abs(registered[:].astype(float) - registered[:].mean(axis=0))
+    raw_error = np.abs(movie.astype(float) - movie.mean(axis=0))
+    assert registered_error[:, 6:-6, 6:-6].mean() < 0.25 * raw_error[:, 6:-6, 6:-6].mean()
+    assert np.allclose(results['average_image'], registered[:].mean(axis=0), atol=1)
@@ -0,0 +1,77 @@
+import datajoint as dj
+import pytest
+
+from . import dj_config
+
+
+def test_find_full_path(tmp_path):
+    from workflow_miniscope.paths import (find_full_path, get_relative_path,
+                                          get_miniscope_root_data_dirs, clear_path_cache)
+
+    scratch, archive = tmp_path / 'scratch', tmp_path / 'archive'
+    for root_dir in (scratch, archive):
+        (root_dir / 'LO012' / 'session0').mkdir(parents=True)
+    (archive / 'LO012' / 'session1').mkdir(parents=True)
+
+    custom = dj.config['custom']
+    dj.config['custom'] = {**custom, 'miniscope_root_data_dir': [str(scratch), str(archive)]}
+    try:
+        clear_path_cache()
+        assert get_miniscope_root_data_dirs() == [scratch, archive]
+        assert find_full_path('LO012/session0') == scratch / 'LO012' / 'session0'
+        assert find_full_path('LO012/session1') == archive / 'LO012' / 'session1'
+        with pytest.raises(FileNotFoundError):
+            find_full_path('LO012/session2')
+
+        assert get_relative_path(archive / 'LO012' / 'session1').as_posix() == 'LO012/session1'
+        with pytest.raises(ValueError):
+            get_relative_path(tmp_path / 'elsewhere')
+
+        # the cached lookup falls back to the other roots once the copy is removed
+        (scratch / 'LO012' / 'session0').rmdir()
+        assert find_full_path('LO012/session0') == archive / 'LO012' / 'session0'
+    finally:
+        dj.config['custom'] = custom
+        clear_path_cache()
+
+
+def test_find_full_path_staged(tmp_path):
+    from workflow_miniscope.paths import find_full_path, clear_path_cache
+
+    scratch, archive = tmp_path / 'scratch', tmp_path / 'archive'
+    (archive / 'LO012' / 'session0').mkdir(parents=True)
+    scratch.mkdir()
+
+    custom = dj.config['custom']
+    dj.config['custom'] = {**custom, 'miniscope_root_data_dir': str(archive),
+                           'miniscope_scratch_dir': str(scratch)}
+    try:
+        clear_path_cache()
+        assert find_full_path('LO012/session0') == archive / 'LO012' / 'session0'
+
+        # staged after the (cached) lookup
+        (scratch / 'LO012' / 'session0').mkdir(parents=True)
+        assert find_full_path('LO012/session0') == scratch / 'LO012' / 'session0'
+    finally:
+        dj.config['custom'] = custom
+        clear_path_cache()
+
+
+def test_get_scan_manifest_path(tmp_path):
+    from workflow_miniscope.paths import get_scan_manifest_path
+
+    custom = dj.config['custom']
+    try:
+        dj.config['custom'] = {**custom, 'miniscope_root_data_dir': [str(tmp_path / 'local'),
+                                                                     str(tmp_path / 'archive')]}
+        assert get_scan_manifest_path() == tmp_path / 'local' / '.scan_manifest.sqlite'
+
+        dj.config['custom'] = {**custom, 'miniscope_root_data_dir': None,
+                               'miniscope_scan_manifest': str(tmp_path / 'manifest.sqlite')}
+        assert get_scan_manifest_path() == tmp_path / 'manifest.sqlite'
+
+        dj.config['custom'] = {**custom, 'miniscope_root_data_dir': None}
+        with pytest.raises(ValueError):
+            get_scan_manifest_path()
+    finally:
+        dj.config['custom'] = custom
@@ -1,8 +1,9 @@
+import pathlib
 import numpy as np
 #TODO remove caiman2d_paramset
 from . import (dj_config, pipeline, subjects_csv, ingest_subjects,
                sessions_csv, ingest_sessions,
-               testdata_paths, caiman_paramset, recording, curations)
+               testdata_paths, caiman_paramset, recording, synthetic_recording, curations)
 
 
 def test_daqv4_info_populate(testdata_paths, pipeline, recording):
@@ -22,3 +23,59 @@ def test_recordinginfo_populate(recording, pipeline):
     miniscope = pipeline['miniscope']
 
     assert len(miniscope.RecordingInfo()) == 1
+
+
+def test_process_run(synthetic_recording, pipeline):
+    from workflow_miniscope import process
+    miniscope = pipeline['miniscope']
+    recording_key = synthetic_recording
+
+    errors = process.run(workers={'RecordingInfo': 2, 'MotionCorrection': 2},
+                         stages=('RecordingInfo', 'MotionCorrection'))
+
+    # the motion correction only starts from the RecordingInfo populated by `run`
+    assert not errors['RecordingInfo'] and not errors['MotionCorrection']
+    assert (miniscope.RecordingInfo & recording_key).fetch1('nframes') == 120
+    assert len(miniscope.MotionCorrection & recording_key) == 1
+
+
+def test_process_run_pipelined(synthetic_recording, pipeline):
+    from workflow_miniscope import process
+    miniscope = pipeline['miniscope']
+    recording_key = synthetic_recording
+
+    errors = process.run_pipelined(workers=2, stages=('RecordingInfo', 'MotionCorrection'),
+                                   poll_interval=1)
+
+    # the motion correction is queued once the RecordingInfo of the recording lands
+    assert not errors['RecordingInfo'] and not errors['MotionCorrection']
+    assert (miniscope.RecordingInfo & recording_key).fetch1('nframes') == 120
+    assert len(miniscope.MotionCorrection & recording_key) == 1
+
+
+def test_worker_errors():
+    from concurrent.futures import Future
+    from workflow_miniscope.process import _worker_errors
+
+    failed = Future()
+    failed.set_exception(ConnectionError('Lost connection'))
+    done = Future()
+    done.set_result([({'recording_id': 1}, 'ValueError: bad frame')])
+
+    assert _worker_errors(failed, {'recording_id': 0}) == [
+        ({'recording_id': 0}, 'ConnectionError: Lost connection')]
+    assert _worker_errors(failed) == [({}, 'ConnectionError: Lost connection')]
+    assert _worker_errors(done) == [({'recording_id': 1}, 'ValueError: bad frame')]
+
+
+def test_get_recording_info(recording, pipeline):
+    from workflow_miniscope.recording_info import get_recording_info
+    miniscope = pipeline['miniscope']
+    get_miniscope_root_data_dir = pipeline['get_miniscope_root_data_dir']
+
+    recording_dir = miniscope.Recording.fetch1('recording_directory')
+    recording_info = get_recording_info(pathlib.Path(get_miniscope_root_data_dir()) / recording_dir,
+                                        decode_fallback=False)
+
+    assert (recording_info['nframes'], recording_info['px_height'], recording_info['px_width']) \
+        == tuple(miniscope.RecordingInfo.fetch1('nframes', 'px_height', 'px_width'))
@@ -0,0 +1,40 @@
+import os
+
+import numpy as np
+
+
+def test_result_cache(tmp_path):
+    from workflow_miniscope.result_cache import ResultCache, params_digest
+
+    cache = ResultCache(tmp_path / 'cache')
+    input_file = tmp_path / 'ms0.avi'
+    input_file.write_bytes(b'frames')
+
+    key = cache.result_key('segmentation', [input_file], params_digest({'gSig': 3, 'p': 2}))
+    assert key == cache.result_key('segmentation', [input_file],
+                                   params_digest({'p': 2, 'gSig': 3}))
+    assert key != cache.result_key('segmentation', [input_file], params_digest({'gSig': 4}))
+    assert cache.load('segmentation', key) is None
+
+    cache.save('segmentation', key, {'traces': np.arange(6).reshape(2, 3)})
+    assert np.array_equal(cache.load('segmentation', key)['traces'], np.arange(6).reshape(2, 3))
+
+    # same path, different contents
+    input_file.write_bytes(b'other frames')
+    os.utime(input_file, ns=(0, 0))
+    assert key != cache.result_key('segmentation', [input_file],
+                                   params_digest({'gSig': 3, 'p': 2}))
+
+
+def test_params_digest_arrays():
+    from workflow_miniscope.result_cache import params_digest
+
+    template = np.zeros((100, 100))
+    other = template.copy()
+    other[50, 50] = 1  # only in the part of the array that str() elides
+
+    assert params_digest({'template': template}) == params_digest({'template': template.copy()})
+    assert params_digest({'template': template}) != params_digest({'template': other})
+    assert (params_digest({'template': template})
+            != params_digest({'template': template.astype(np.float32)}))
+    assert params_digest({'p': np.int64(2)}) == params_digest({'p': 2})
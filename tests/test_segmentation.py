@@ -0,0 +1,66 @@
+import numpy as np
+
+
+def test_split_patches():
+    from workflow_miniscope.segmentation import split_patches
+
+    for dims, rf, stride in (((300, 250), 64, 16), ((100, 40), 32, 8), ((20, 20), 64, 16)):
+        patches = split_patches(dims, rf=rf, stride=stride)
+        core_count = np.zeros(dims, dtype=int)
+        for (y0, y1, x0, x1), (cy0, cy1, cx0, cx1) in patches:
+            assert 0 <= y0 <= cy0 < cy1 <= y1 <= dims[0]
+            assert 0 <= x0 <= cx0 < cx1 <= x1 <= dims[1]
+            assert (y1 - y0, x1 - x0) == (min(2 * rf, dims[0]), min(2 * rf, dims[1]))
+            core_count[cy0:cy1, cx0:cx1] += 1
+        assert (core_count == 1).all()
+
+
+def test_merge_components():
+    from workflow_miniscope.segmentation import merge_components
+
+    rng = np.random.default_rng(0)
+    trace = rng.random(200)
+
+    def component(y0, x0, trace):
+        ypix, xpix = np.mgrid[y0:y0 + 4, x0:x0 + 4]
+        return {'ypix': ypix.ravel(), 'xpix': xpix.ravel(), 'weights': np.ones(16),
+                'trace': trace, 'spikes': np.zeros_like(trace)}
+
+    components = [component(10, 10, trace),
+                  component(12, 12, trace + 0.01 * rng.random(200)),  # same cell, other patch
+                  component(12, 8, rng.random(200)),  # overlapping, uncorrelated
+                  component(30, 30, trace)]  # correlated, not overlapping
+
+    merged = merge_components(components, (40, 40), merge_thr=0.8)
+
+    assert len(merged) == 3
+    union = merged[0]
+    assert len(union['weights']) == 16 + 16 - 4
+    assert set(zip(union['ypix'], union['xpix'])) == (
+        set(zip(components[0]['ypix'], components[0]['xpix']))
+        | set(zip(components[1]['ypix'], components[1]['xpix'])))
+    assert np.corrcoef(union['trace'], trace)[0, 1] > 0.99
+
+
+def test_extract_patches(tmp_path):
+    from workflow_miniscope.framestore import commit_frame_store, get_frame_store_paths
+    from workflow_miniscope.segmentation import split_patches, extract_patches, read_patch
+
+    movie = np.random.default_rng(0).integers(0, 256, (50, 40, 30), dtype=np.uint8)
+    data_path, _ = get_frame_store_paths(tmp_path / 'movie')
+    tmp_data_path = data_path.with_name(data_path.name + '.tmp')
+    movie.tofile(tmp_data_path)
+    commit_frame_store(tmp_path / 'movie', tmp_data_path,
+                       {'shape': list(movie.shape), 'dtype': 'uint8', 'source_files': []})
+
+    patches = split_patches(movie.shape[1:], rf=10, stride=4)
+    patch_dir = tmp_path / 'patches'
+    patch_dir.mkdir()
+    patch_files = extract_patches(tmp_path / 'movie', patches, patch_dir, block_size=16)
+
+    for patch_file, ((y0, y1, x0, x1), _) in zip(patch_files, patches):
+        assert patch_file[2] == 'uint8'
+        assert patch_file[0].stat().st_size == movie[:, y0:y1, x0:x1].nbytes
+        images = read_patch(patch_file, block_size=16)
+        assert images.dtype == np.float32
+        assert np.array_equal(images, movie[:, y0:y1, x0:x1])
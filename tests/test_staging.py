@@ -0,0 +1,45 @@
+import os
+
+import datajoint as dj
+
+from . import dj_config
+
+
+def test_scratch_stage(tmp_path):
+    from workflow_miniscope.paths import find_full_path, clear_path_cache
+    from workflow_miniscope.staging import ScratchStage
+
+    archive, scratch = tmp_path / 'archive', tmp_path / 'scratch'
+    for session in ('session0', 'session1'):
+        recording_dir = archive / 'LO012' / session / 'miniscope'
+        recording_dir.mkdir(parents=True)
+        (recording_dir / 'ms0.avi').write_bytes(b'0' * 1000)
+        (recording_dir / 'metaData.json').write_text('{}')
+        (recording_dir / 'caiman').mkdir()  # sub-directories are not staged
+
+    custom = dj.config['custom']
+    dj.config['custom'] = {**custom, 'miniscope_root_data_dir': str(archive),
+                           'miniscope_scratch_dir': str(scratch)}
+    try:
+        clear_path_cache()
+        stage = ScratchStage(scratch, max_bytes=1500)
+        assert find_full_path('LO012/session0/miniscope') == archive / 'LO012/session0/miniscope'
+
+        staged_dir = stage.stage('LO012/session0/miniscope')
+        assert sorted(os.listdir(staged_dir)) == ['.staged', 'metaData.json', 'ms0.avi']
+        assert find_full_path('LO012/session0/miniscope/ms0.avi') == staged_dir / 'ms0.avi'
+
+        # over budget: the least recently used recording is evicted, unless pinned - by
+        # any ScratchStage of the scratch directory
+        pin = ScratchStage(scratch, max_bytes=1500).pin('LO012/session0/miniscope')
+        stage.stage('LO012/session1/miniscope')
+        assert stage.is_staged('LO012/session0/miniscope')
+
+        ScratchStage.unpin(pin)
+        stage.evict()
+        assert not stage.is_staged('LO012/session0/miniscope')
+        assert stage.is_staged('LO012/session1/miniscope')
+        assert find_full_path('LO012/session0/miniscope') == archive / 'LO012/session0/miniscope'
+    finally:
+        dj.config['custom'] = custom
+        clear_path_cache()
@@ -0,0 +1,31 @@
+import numpy as np
+
+
+def test_compute_summary_images():
+    from workflow_miniscope.summary_images import compute_summary_images, seed_pixels
+
+    rng = np.random.default_rng(0)
+    movie = rng.normal(100, 5, (300, 20, 24)).astype(np.float32)
+    calcium = np.convolve(rng.random(300) > 0.97, np.exp(-np.arange(30) / 10))[:300]
+    movie[:, 5:8, 5:8] += 40 * calcium[:, None, None]  # one cell with calcium transients
+
+    images = compute_summary_images(movie, block_size=64)
+    in_memory = compute_summary_images(movie, block_size=len(movie))
+
+    for name, image in images.items():
+        assert np.allclose(image, in_memory[name]), name
+    assert np.allclose(images['average_image'], movie.mean(axis=0), atol=1e-3)
+    assert np.array_equal(images['max_proj_image'], movie.max(axis=0))
+
+    ypix, xpix = seed_pixels(images['correlation_image'], images['pnr_image'],
+                             min_corr=0.5, min_pnr=5)
+    assert set(zip(ypix, xpix)) <= {(y, x) for y in range(4, 9) for x in range(4, 9)}
+    assert (6, 6) in set(zip(ypix, xpix))
+
+
+def test_summary_gsig():
+    from workflow_miniscope.summary_images import summary_gsig
+
+    assert summary_gsig({'gSig': (3, 3)}) == 3
+    assert summary_gsig({'gSig': 2.5}) == 2.5
+    assert summary_gsig({'gSig': None}) == summary_gsig({}) == 0
@@ -0,0 +1,35 @@
+from . import dj_config, pipeline
+
+
+def test_expand_grid():
+    from workflow_miniscope.sweep import expand_grid
+
+    base_params = {'gSig': (3, 3), 'min_corr': 0.8, 'p': 1}
+    sweep = expand_grid(base_params, {'min_corr': [0.7, 0.8], 'gSig': [(3, 3), (4, 4)]})
+
+    assert len(sweep) == 4
+    assert [overrides for overrides, _ in sweep][0] == {'gSig': (3, 3), 'min_corr': 0.7}
+    assert all(params == {**base_params, **overrides} for overrides, params in sweep)
+    assert base_params == {'gSig': (3, 3), 'min_corr': 0.8, 'p': 1}
+
+
+def test_register_sweep(pipeline):
+    from workflow_miniscope.sweep import register_sweep
+
+    miniscope = pipeline['miniscope']
+    paramset_pk = miniscope.ProcessingParamSet.primary_key[0]
+    base_params = {'gSig': (3, 3), 'min_corr': 0.8, 'p': 1}
+    miniscope.ProcessingParamSet.insert_new_params('caiman', 100, 'Test - sweep base', base_params)
+    try:
+        paramsets = register_sweep(100, {'min_corr': [0.7, 0.8]})
+
+        assert sorted(paramsets.values(), key=str) == [{'min_corr': 0.7}, {'min_corr': 0.8}]
+        assert all(paramset_id > 100 for paramset_id in paramsets)
+        for paramset_id, overrides in paramsets.items():
+            params = (miniscope.ProcessingParamSet & {paramset_pk: paramset_id}).fetch1('params')
+            assert params == {**base_params, **overrides, 'patch_parallel': True}
+
+        # registered once
+        assert register_sweep(100, {'min_corr': [0.8, 0.7]}) == paramsets
+    finally:
+        (miniscope.ProcessingParamSet & f'{paramset_pk} >= 100').delete()
@@ -0,0 +1,23 @@
+import numpy as np
+import pytest
+
+
+def test_trace_matrix(tmp_path):
+    pytest.importorskip('h5py')
+    from workflow_miniscope.trace_matrix import write_trace_matrix, read_trace_matrix
+
+    traces = np.random.default_rng(0).normal(size=(70, 5000)).astype(np.float32)
+    filepath = write_trace_matrix(tmp_path / 'traces.h5', traces)
+
+    assert np.array_equal(read_trace_matrix(filepath), traces)
+    assert np.array_equal(read_trace_matrix(filepath, rows=slice(60, 70),
+                                            frames=slice(4000, 4500)), traces[60:, 4000:4500])
+    assert np.array_equal(read_trace_matrix(filepath, rows=[3, 65]), traces[[3, 65]])
+
+
+def test_empty_trace_matrix(tmp_path):
+    pytest.importorskip('h5py')
+    from workflow_miniscope.trace_matrix import write_trace_matrix, read_trace_matrix
+
+    filepath = write_trace_matrix(tmp_path / 'traces.h5', np.empty((0, 0)))
+    assert read_trace_matrix(filepath).shape == (0, 0)
@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+
+def test_lru_cache():
+    from workflow_miniscope.traces import LRUCache
+
+    cache = LRUCache(max_bytes=3 * 800)
+    for k in range(3):
+        cache.put(k, np.zeros(100))  # 800 bytes each
+    cache.get(0)  # 0 becomes the most recently used
+    cache.put(3, np.zeros(100))
+
+    assert 1 not in cache and all(k in cache for k in (0, 2, 3))
+    assert cache.nbytes == 3 * 800
+
+    cache.put(4, np.zeros(1000))  # larger than the cache: not cached
+    assert 4 not in cache and len(cache) == 3
+
+
+def _array_view(traces, has_trace_matrix, cache):
+    from workflow_miniscope.traces import TraceView
+
+    class ArrayView(TraceView):
+        # a TraceView of an in-memory array instead of a Fluorescence entry
+        def __init__(self):
+            self.key, self.extraction_method, self.fps = {}, None, 10
+            self.cache, self.block_shape = cache, (4, 16)
+            self.has_trace_matrix, self.shape = has_trace_matrix, traces.shape
+            self._cache_id, self.reads = 'test', 0
+
+        def _read_matrix(self, rows, frames):
+            self.reads += 1
+            return traces[rows, frames]
+
+        def _read_traces(self, rows):
+            self.reads += 1
+            return traces[rows]
+
+    return ArrayView()
+
+
+@pytest.mark.parametrize('has_trace_matrix', [True, False])
+def test_trace_view(has_trace_matrix):
+    from workflow_miniscope.traces import LRUCache
+
+    traces = np.arange(10 * 50, dtype=np.float32).reshape((10, 50))
+    view = _array_view(traces, has_trace_matrix, LRUCache(2 ** 20))
+
+    assert len(view) == 10
+    assert np.array_equal(view[:], traces)
+    assert np.array_equal(view[[3, 7], 10:40], traces[[3, 7], 10:40])
+    assert np.array_equal(view[2:9:3, ::7], traces[2:9:3, ::7])
+    assert np.array_equal(view[5], traces[5])
+    assert view[5, 17] == traces[5, 17]
+    assert np.array_equal(view.window(1, 2.05, rows=[0]), traces[[0], 10:21])
+
+    reads = view.reads
+    view[:]  # all the blocks are cached
+    assert view.reads == reads
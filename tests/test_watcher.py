@@ -0,0 +1,102 @@
+import datajoint as dj
+import pytest
+
+from . import dj_config, pipeline, subjects_csv, ingest_subjects
+
+
+class FakeClock:
+    def __init__(self):
+        self.time = 0.
+
+    def __call__(self):
+        return self.time
+
+
+def test_session_watcher_settle(tmp_path):
+    from workflow_miniscope.watcher import SessionWatcher
+
+    session_dir = tmp_path / 'LO012' / 'session0'
+    session_dir.mkdir(parents=True)
+    (session_dir / 'ms0.avi').write_bytes(b'0' * 10)
+    (tmp_path / 'LO012' / 'notes').mkdir()
+
+    custom = dj.config['custom']
+    dj.config['custom'] = {**custom, 'miniscope_root_data_dir': str(tmp_path)}
+    try:
+        clock = FakeClock()
+        watcher = SessionWatcher(settle_time=30, use_inotify=False, clock=clock)
+        watcher._discover()
+        assert list(watcher.pending) == [session_dir]
+        assert watcher._settled() == []
+
+        # a new file restarts the settle time
+        clock.time = 40
+        (session_dir / 'ms1.avi').write_bytes(b'0' * 10)
+        assert watcher._settled() == []
+        clock.time = 69
+        assert watcher._settled() == []
+        clock.time = 70
+        assert watcher._settled() == [session_dir]
+
+        # removed before settling
+        session_dir.joinpath('ms0.avi').unlink()
+        session_dir.joinpath('ms1.avi').unlink()
+        session_dir.rmdir()
+        assert watcher._settled() == [] and not watcher.pending
+    finally:
+        dj.config['custom'] = custom
+
+
+def test_session_watcher_inotify(tmp_path):
+    import asyncio
+    pytest.importorskip('inotify_simple')
+    from workflow_miniscope.watcher import SessionWatcher
+
+    custom = dj.config['custom']
+    dj.config['custom'] = {**custom, 'miniscope_root_data_dir': str(tmp_path)}
+    loop = asyncio.new_event_loop()
+    watcher = SessionWatcher(use_inotify=True)
+    try:
+        assert watcher._start_inotify(loop)
+        assert not watcher.pending
+
+        # a new subject and session directory, then its recording file
+        session_dir = tmp_path / 'LO012' / 'session0'
+        session_dir.mkdir(parents=True)
+        watcher._read_events()
+        (session_dir / 'ms0.avi').write_bytes(b'0' * 10)
+        watcher._read_events()
+        assert list(watcher.pending) == [session_dir]
+
+        # other files are ignored
+        (tmp_path / 'LO012' / 'notes.txt').write_text('')
+        watcher._read_events()
+        assert list(watcher.pending) == [session_dir]
+    finally:
+        watcher._stop_inotify(loop)
+        loop.close()
+        dj.config['custom'] = custom
+
+
+def test_ingest_session_dir(tmp_path, pipeline, ingest_subjects):
+    from workflow_miniscope.watcher import ingest_session_dir
+
+    session, miniscope = pipeline['session'], pipeline['miniscope']
+    for session_dir in ('LO012/session0', 'unknown/session0', '.'):
+        (tmp_path / session_dir).mkdir(parents=True, exist_ok=True)
+        (tmp_path / session_dir / 'ms0.avi').write_bytes(b'0' * 10)
+
+    session_key = ingest_session_dir(tmp_path / 'LO012' / 'session0', [tmp_path], populate=False)
+    assert (session.SessionDirectory & session_key).fetch1('session_dir') == 'LO012/session0'
+    assert (miniscope.Recording & session_key).fetch1('scanner', 'recording_directory') == (
+        'Miniscope-DAQ-V4', 'LO012/session0')
+
+    # idempotent
+    assert ingest_session_dir(tmp_path / 'LO012' / 'session0', [tmp_path],
+                              populate=False) == session_key
+    assert len(session.Session & session_key) == 1
+
+    # unknown subject, recording directly in the root
+    assert ingest_session_dir(tmp_path / 'unknown' / 'session0', [tmp_path],
+                              populate=False) is None
+    assert ingest_session_dir(tmp_path, [tmp_path], populate=False) is None
@@ -0,0 +1,88 @@
+import re
+import struct
+import pathlib
+
+
+def sorted_avi_files(recording_dir, pattern='ms*.avi'):
+    """
+    Raw Miniscope-DAQ-V4 files of a recording in acquisition order (ms0, ms1, ..., ms10)
+    """
+    return sorted(pathlib.Path(recording_dir).glob(pattern),
+                  key=lambda fp: [int(s) if s.isdigit() else s for s in re.split(r'(\d+)', fp.name)])
+
+
+def _iter_chunks(data):
+    """ Iterate over the (chunk id, payload) of the RIFF chunks in `data` """
+    position = 0
+    while position + 8 <= len(data):
+        ckid, cksize = struct.unpack_from('<4sI', data, position)
+        yield ckid, data[position + 8:position + 8 + cksize]
+        position += 8 + cksize + (cksize & 1)  # chunks are word-aligned
+
+
+def _parse_hdrl(data, header):
+    for ckid, payload in _iter_chunks(data):
+        if ckid == b'avih':
+            (header['microsec_per_frame'], _, _, _, header['avih_frames'], _, _, _,
+             header['px_width'], header['px_height']) = struct.unpack_from('<10I', payload)
+        elif ckid == b'strh' and payload[:4] == b'vids' and 'fps' not in header:
+            scale, rate, _, length = struct.unpack_from('<4I', payload, 20)
+            header['fps'] = rate / scale if scale else None
+            header['strh_frames'] = length
+            header['codec'] = payload[4:8].decode('ascii', 'replace').strip('\x00')
+        elif ckid == b'strf' and 'strf_width' not in header and len(payload) >= 12:
+            _, header['strf_width'], strf_height = struct.unpack_from('<Iii', payload)
+            header['strf_height'] = abs(strf_height)  # negative for top-down bitmaps
+        elif ckid == b'dmlh':
+            header['odml_frames'] = struct.unpack_from('<I', payload)[0]
+        elif ckid == b'LIST' and payload[:4] in (b'strl', b'odml'):
+            _parse_hdrl(payload[4:], header)
+
+
+def read_avi_header(filepath):
+    """
+    Read the number of frames and frame dimensions of an AVI file from its headers and
+    index chunks only - without decoding any frame.
+    The frame count is taken, by order of reliability, from the OpenDML `dmlh` header,
+    the video entries of the `idx1` index, the video stream header and the main header.
+    :return: dict with nframes, px_height, px_width, fps and codec
+    """
+    header = {}
+    with open(filepath, 'rb') as f:
+        riff, riff_size, form = struct.unpack('<4sI4s', f.read(12))
+        if riff != b'RIFF' or form != b'AVI ':
+            raise ValueError(f'Not an AVI file: {filepath}')
+
+        riff_end = 8 + riff_size
+        while f.tell() + 8 <= riff_end:
+            ckid, cksize = struct.unpack('<4sI', f.read(8))
+            list_type = f.read(4) if ckid == b'LIST' else None
+            if list_type == b'hdrl':
+                _parse_hdrl(f.read(cksize - 4), header)
+            elif ckid == b'idx1':
+                index = f.read(cksize)
+                # video frames are indexed as '##db' (uncompressed) or '##dc' (compressed)
+                header['idx1_frames'] = sum(1 for i in range(0, len(index) - 15, 16)
+                                            if index[i + 2:i + 4] in (b'db', b'dc'))
+            else:
+                # skip e.g. the `movi` list holding the frame data
+                f.seek(cksize - (4 if list_type else 0) + (cksize & 1), 1)
+
+    if 'avih_frames' not in header:
+        raise ValueError(f'Missing AVI main header in: {filepath}')
+
+    for frame_count in ('odml_frames', 'idx1_frames', 'strh_frames', 'avih_frames'):
+        if header.get(frame_count):
+            nframes = header[frame_count]
+            break
+    else:
+        nframes = 0
+
+    fps = header.get('fps') or (1e6 / header['microsec_per_frame']
+                                if header['microsec_per_frame'] else None)
+
+    return {'nframes': nframes,
+            'px_height': header.get('strf_height') or header['px_height'],
+            'px_width': header.get('strf_width') or header['px_width'],
+            'fps': fps,
+            'codec': header.get('codec')}
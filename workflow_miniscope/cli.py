@@ -0,0 +1,198 @@
+"""
+Command line of the workflow (console script `workflow-miniscope`):
+
+    workflow-miniscope ingest --subjects user_data/subjects.csv --sessions user_data/sessions.csv
+    workflow-miniscope ingest --sessions sessions.csv --dry-run
+    workflow-miniscope worker --processes 8
+    workflow-miniscope status
+    workflow-miniscope watch --settle-time 30
+
+The database connection is read from the local DataJoint configuration
+(`dj_local_conf.json` or the DJ_HOST/DJ_USER/DJ_PASS environment variables).
+"""
+import sys
+import json
+import time
+import signal
+import argparse
+import threading
+
+
+default_subject_csv_path = './user_data/subjects.csv'
+default_session_csv_path = './user_data/sessions.csv'
+
+
+def ingest(args):
+    # both default CSV files unless at least one is given
+    subject_csv_path, session_csv_path = args.subjects, args.sessions
+    if not subject_csv_path and not session_csv_path:
+        subject_csv_path, session_csv_path = default_subject_csv_path, default_session_csv_path
+
+    if args.dry_run:
+        from .ingest import dry_run
+
+        result = dry_run(subject_csv_path, session_csv_path, chunk_size=args.chunk_size,
+                         max_workers=args.max_workers)
+        return 1 if result['row_errors'] or result['session_errors'] else 0
+
+    from .ingest import ingest_subjects, ingest_sessions
+
+    if subject_csv_path:
+        ingest_subjects(subject_csv_path, stream=args.stream, chunk_size=args.chunk_size)
+    if session_csv_path:
+        ingest_sessions(session_csv_path, chunk_size=args.chunk_size,
+                        max_workers=args.max_workers, use_manifest=args.use_manifest,
+                        stream=args.stream)
+    return 0
+
+
+def worker(args):
+    """
+    Populate the processing stages in rounds until stopped (SIGINT/SIGTERM - the current
+    round is completed first), sleeping `args.interval` seconds after a round that
+    populated nothing, e.g. with only failed keys left
+    """
+    from . import process
+
+    stop = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: stop.set())
+
+    stages = args.stages or process.get_stages()
+
+    def count_populated():
+        return sum(counts['populated'] for counts in process.get_backlog(stages).values())
+
+    while not stop.is_set():
+        start_time = time.time()
+        backlog = process.get_backlog(stages)
+        progressed = False
+        if any(counts['pending'] for counts in backlog.values()):
+            if args.mode == 'pipelined':
+                errors = process.run_pipelined(workers=args.processes, stages=stages,
+                                               poll_interval=args.poll_interval,
+                                               prefetch=args.prefetch)
+            else:
+                errors = process.run(workers=args.processes and {stage: args.processes
+                                                                 for stage in stages},
+                                     stages=stages)
+            print(f'\n---- Completed a round in {time.time() - start_time:.1f}s:'
+                  f' {sum(len(e) for e in errors.values())} error(s) ----')
+            progressed = count_populated() > sum(counts['populated']
+                                                 for counts in backlog.values())
+
+        if args.once:
+            break
+        # start the next round right away while the previous one made progress
+        if not progressed:
+            stop.wait(args.interval)
+    return 0
+
+
+def status(args):
+    from .process import get_backlog
+
+    backlog = get_backlog(args.stages)
+    if args.json:
+        print(json.dumps(backlog, indent=2))
+        return 0
+
+    columns = ('populated', 'pending', 'reserved', 'error')
+    width = max(len(stage) for stage in backlog)
+    print(f'{"stage":<{width}}  ' + '  '.join(f'{c:>9}' for c in columns))
+    for stage, counts in backlog.items():
+        print(f'{stage:<{width}}  ' + '  '.join(f'{counts[c]:>9}' for c in columns))
+    return 0
+
+
+def watch(args):
+    from .watcher import watch as watch_sessions
+
+    watch_sessions(args.root, settle_time=args.settle_time, poll_interval=args.poll_interval,
+                   populate=not args.no_populate, use_inotify=not args.poll)
+    return 0
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(prog='workflow-miniscope', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    ingest_parser = subparsers.add_parser('ingest', help='insert subjects and sessions from'
+                                                         ' CSV files')
+    ingest_parser.add_argument('--subjects', help='subjects CSV file (default:'
+                                                  f' {default_subject_csv_path}, unless'
+                                                  ' only --sessions is given)')
+    ingest_parser.add_argument('--sessions', help='sessions CSV file (default:'
+                                                  f' {default_session_csv_path}, unless'
+                                                  ' only --subjects is given)')
+    ingest_parser.add_argument('--dry-run', action='store_true',
+                               help='only validate the CSV files and identify the recordings'
+                                    ' of the session directories, without the database')
+    ingest_parser.add_argument('--chunk-size', type=int, default=500,
+                               help='rows per insert transaction (and per validated chunk)')
+    ingest_parser.add_argument('--stream', action='store_true',
+                               help='stream the CSV files in chunks, resuming an interrupted'
+                                    ' run after its last committed chunk')
+    ingest_parser.add_argument('--max-workers', type=int, default=8,
+                               help='threads identifying the recordings of the session'
+                                    ' directories')
+    ingest_parser.add_argument('--use-manifest', action='store_true',
+                               help='only re-scan the session directories changed since the'
+                                    ' last run (see `custom/miniscope_scan_manifest`)')
+    ingest_parser.set_defaults(func=ingest)
+
+    worker_parser = subparsers.add_parser('worker', help='populate the processing stages'
+                                                         ' until stopped')
+    worker_parser.add_argument('--processes', type=int, default=None,
+                               help='worker processes (default: one per CPU core)')
+    worker_parser.add_argument('--stages', nargs='+', default=None,
+                               help='stages to populate, in dependency order (default: all, with'
+                                    ' the trace matrices if their store is configured)')
+    worker_parser.add_argument('--mode', choices=('pipelined', 'staged'), default='pipelined',
+                               help='push each recording through the stages as soon as'
+                                    ' possible (pipelined), or populate the stages one after'
+                                    ' the other (staged)')
+    worker_parser.add_argument('--interval', type=float, default=60,
+                               help='(s) sleep after a round that populated nothing')
+    worker_parser.add_argument('--poll-interval', type=float, default=5,
+                               help='(s) maximum time between two scheduling rounds'
+                                    ' (pipelined mode)')
+    worker_parser.add_argument('--prefetch', type=int, default=2,
+                               help='recordings staged ahead to the scratch directory'
+                                    ' (pipelined mode)')
+    worker_parser.add_argument('--once', action='store_true',
+                               help='exit after one round instead of waiting for new keys')
+    worker_parser.set_defaults(func=worker)
+
+    status_parser = subparsers.add_parser('status', help='backlog of the processing stages')
+    status_parser.add_argument('--stages', nargs='+', default=None)
+    status_parser.add_argument('--json', action='store_true', help='print JSON')
+    status_parser.set_defaults(func=status)
+
+    watch_parser = subparsers.add_parser('watch', help='ingest new session directories as'
+                                                       ' they are written')
+    watch_parser.add_argument('--root', help='directory watched (default: the primary root'
+                                             ' data directory)')
+    watch_parser.add_argument('--settle-time', type=float, default=30,
+                              help='(s) time without change of the files of a session'
+                                   ' directory before it is ingested')
+    watch_parser.add_argument('--poll-interval', type=float, default=60,
+                              help='(s) time between two walks of the tree without inotify')
+    watch_parser.add_argument('--poll', action='store_true',
+                              help='walk the tree even if inotify is available')
+    watch_parser.add_argument('--no-populate', action='store_true',
+                              help='only insert the recordings, leaving RecordingInfo to'
+                                   ' the workers')
+    watch_parser.set_defaults(func=watch)
+
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
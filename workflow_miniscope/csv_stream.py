@@ -0,0 +1,84 @@
+import os
+import csv
+import json
+import pathlib
+import itertools
+
+
+def read_csv_chunks(csv_path, chunk_size=10000, skip_rows=0):
+    """
+    Stream a CSV file as lists of at most `chunk_size` row dictionaries,
+    skipping the first `skip_rows` data rows
+    :return: generator of (index of the first row in the chunk, rows)
+    """
+    with open(csv_path, newline='') as f:
+        reader = csv.DictReader(f, delimiter=',')
+        for _ in itertools.islice(reader, skip_rows):
+            pass
+
+        row_index = skip_rows
+        while True:
+            rows = list(itertools.islice(reader, chunk_size))
+            if not rows:
+                return
+            yield row_index, rows
+            row_index += len(rows)
+
+
+def validate_rows(rows, required_fields, first_row=0):
+    """
+    Check that every row has a non-empty value for each of the `required_fields`
+    :raise ValueError: listing the offending rows (0-based data row index)
+    """
+    invalid = [(first_row + i, [field for field in required_fields if not row.get(field)])
+               for i, row in enumerate(rows)]
+    invalid = [(i, fields) for i, fields in invalid if fields]
+    if invalid:
+        raise ValueError('Missing required field(s) in row(s): ' + '; '.join(
+            f'{i} ({", ".join(fields)})' for i, fields in invalid[:10])
+            + (f'; ... ({len(invalid)} rows in total)' if len(invalid) > 10 else ''))
+
+
+def validate_csv(csv_path, required_fields, chunk_size=10000):
+    """
+    Validate a whole CSV file (see `validate_rows`) without loading it in memory
+    :return: number of data rows
+    """
+    nrows = 0
+    for first_row, rows in read_csv_chunks(csv_path, chunk_size=chunk_size):
+        validate_rows(rows, required_fields, first_row=first_row)
+        nrows += len(rows)
+    return nrows
+
+
+class Checkpoint:
+    """
+    Number of rows of a CSV file already committed to the database,
+    stored beside the CSV file as `<csv_path>.checkpoint`.
+    The checkpoint is ignored once the CSV file is modified.
+    """
+
+    def __init__(self, csv_path):
+        csv_path = pathlib.Path(csv_path)
+        self.path = csv_path.with_name(csv_path.name + '.checkpoint')
+        csv_stat = csv_path.stat()
+        self.signature = {'csv_size': csv_stat.st_size, 'csv_mtime_ns': csv_stat.st_mtime_ns}
+
+    def load(self):
+        if not self.path.exists():
+            return 0
+        with open(self.path) as f:
+            checkpoint = json.load(f)
+        if {k: checkpoint.get(k) for k in self.signature} != self.signature:
+            return 0
+        return checkpoint['committed_rows']
+
+    def save(self, committed_rows):
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump({**self.signature, 'committed_rows': committed_rows}, f)
+        os.replace(tmp_path, self.path)
+
+    def clear(self):
+        if self.path.exists():
+            self.path.unlink()
@@ -0,0 +1,299 @@
+import warnings
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy import fft, signal, linalg
+
+
+# AR model and noise estimates (CaImAn's `GetSn` and `estimate_time_constant`) -
+
+def estimate_noise(traces, noise_range=(0.25, 0.5)):
+    """
+    Noise level of each trace from the mean log power spectral density over `noise_range`
+    (fraction of the sampling rate)
+    :param traces: (ntraces, nframes) array
+    """
+    freqs, psd = signal.welch(traces, axis=-1)
+    psd = psd[:, (freqs > noise_range[0]) & (freqs <= noise_range[1])]
+    return np.sqrt(np.exp(np.mean(np.log(psd / 2), axis=1)))
+
+
+def _autocovariance(traces, maxlag):
+    """ (ntraces, maxlag + 1) biased autocovariance of each trace at lags 0..maxlag """
+    traces = traces - traces.mean(axis=1, keepdims=True)
+    nfft = fft.next_fast_len(2 * traces.shape[1] - 1)
+    spectrum = fft.rfft(traces, nfft, axis=1)
+    return fft.irfft(spectrum * spectrum.conj(), nfft, axis=1)[:, :maxlag + 1] / traces.shape[1]
+
+
+def _ar_from_roots(roots, fudge_factor):
+    """ AR coefficients from the (clamped) roots of the characteristic polynomial """
+    roots = np.clip(np.real(roots), 0, 1)
+    roots[roots == 1] = 0.95
+    roots = fudge_factor * roots
+    if roots.shape[1] == 1:
+        return roots
+    return np.stack([roots[:, 0] + roots[:, 1], -roots[:, 0] * roots[:, 1]], axis=1)
+
+
+def estimate_ar(traces, sn, p=2, lags=5, fudge_factor=0.96):
+    """
+    AR(`p`) coefficients of each trace from its noise-corrected autocovariance
+    (Yule-Walker least squares over `lags` + `p` lags), for all traces at once
+    :return: (ntraces, p) array
+    """
+    if p not in (1, 2):
+        raise NotImplementedError(f'Batch deconvolution of AR({p}) models is not implemented')
+    lags += p
+    xc = _autocovariance(traces, lags)
+    A = xc[:, np.abs(np.arange(lags)[:, None] - np.arange(p)[None, :])]  # Toeplitz (n, lags, p)
+    A[:, np.arange(p), np.arange(p)] -= sn[:, None] ** 2
+    b = xc[:, 1:lags + 1]
+    g = np.linalg.solve(np.einsum('nlp,nlq->npq', A, A),
+                        np.einsum('nlp,nl->np', A, b)[..., None])[..., 0]
+
+    if p == 1:
+        roots = g
+    else:
+        discriminant = np.sqrt((g[:, 0] ** 2 + 4 * g[:, 1]).astype(complex))
+        roots = np.stack([(g[:, 0] + discriminant) / 2, (g[:, 0] - discriminant) / 2], axis=1)
+    return _ar_from_roots(roots, fudge_factor)
+
+
+# Batched non-negative deconvolution -------------------------------------------
+# All the traces are solved together as one block-diagonal banded system: the
+# rows of different traces are never coupled, so each trace gets the result it
+# gets when deconvolved on its own.
+
+def _apply_ar(c, g):
+    """ Spikes s = G c of the calcium traces `c`: s_t = c_t - g_1 c_t-1 - g_2 c_t-2 """
+    s = c.copy()
+    s[:, 1:] -= g[:, [0]] * c[:, :-1]
+    s[:, 2:] -= g[:, [1]] * c[:, :-2]
+    return s
+
+
+def _apply_ar_transpose(v, g):
+    r = v.copy()
+    r[:, :-1] -= g[:, [0]] * v[:, 1:]
+    r[:, :-2] -= g[:, [1]] * v[:, 2:]
+    return r
+
+
+def ar_filter(s, g):
+    """
+    Calcium traces c = G^-1 s of the spikes `s` through the AR(2) recursion of each trace
+    (`g` of shape (ntraces, 2)), as one banded triangular solve for all the traces
+    """
+    ntraces, nframes = s.shape
+    ab = np.zeros((3, ntraces, nframes))
+    ab[0] = 1
+    ab[1, :, :-1] = -g[:, [0]]
+    ab[2, :, :-2] = -g[:, [1]]
+    return linalg.solve_banded((2, 0), ab.reshape(3, -1), s.ravel(), overwrite_ab=True,
+                               check_finite=False).reshape(ntraces, nframes)
+
+
+def _newton_step(y, b, c, s, g, penalty, z):
+    """
+    Newton direction of 1/2 ||y - b - c||^2 + penalty * sum(s) - z * sum(log(s)), s = G c,
+    from the pentadiagonal Hessian I + z G' diag(1 / s^2) G of all the traces
+    :return: (gradient, direction)
+    """
+    ntraces, nframes = c.shape
+    gradient = c + b[:, None] - y + _apply_ar_transpose(penalty[:, None] - z[:, None] / s, g)
+
+    d = np.pad(z[:, None] / s ** 2, ((0, 0), (0, 2)))
+    g1, g2 = g[:, [0]], g[:, [1]]
+    ab = np.zeros((3, ntraces, nframes))
+    ab[2] = 1 + d[:, :-2] + g1 ** 2 * d[:, 1:-1] + g2 ** 2 * d[:, 2:]
+    ab[1, :, 1:] = (-g1 * d[:, 1:-1] + g1 * g2 * d[:, 2:])[:, :-1]
+    ab[0, :, 2:] = (-g2 * d[:, 2:])[:, :-2]
+    direction = linalg.solveh_banded(ab.reshape(3, -1), -gradient.ravel(), overwrite_ab=True,
+                                     overwrite_b=True, check_finite=False)
+    return gradient, direction.reshape(ntraces, nframes)
+
+
+def _objective(y, b, c, g, penalty, z):
+    s = _apply_ar(c, g)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        barrier = np.where(s > 0, np.log(np.maximum(s, np.finfo(float).tiny)), -np.inf)
+    return (0.5 * np.sum((y - b[:, None] - c) ** 2, axis=1) + penalty * np.sum(s, axis=1)
+            - z * np.sum(barrier, axis=1))
+
+
+def deconvolve(traces, p=2, lags=5, fudge_factor=0.96, noise_range=(0.25, 0.5), sparsity=1.,
+               barrier_levels=5, max_iter=200, tol=1e-3):
+    """
+    Non-negative AR(1)/AR(2) deconvolution of all the traces at once:
+        min_{b, c} 1/2 ||y - b - c||^2 + penalty * sum(G c)   subject to G c >= 0
+    solved with a log-barrier interior point method - each Newton step of every trace is
+    one vectorized banded solve for all the traces.
+    :param traces: (ntraces, nframes) array
+    :param sparsity: L1 penalty in units of the noise level of the gradient
+    :param barrier_levels: number of barrier weights, from sn^2 down by factors of 10
+    :param tol: Newton decrement (relative to the barrier duality gap) ending a barrier level
+    :return: dict with spikes and calcium (ntraces, nframes), baseline, g, sn and converged
+     (False for the traces still within a barrier level after `max_iter` Newton steps, with
+     a warning)
+    """
+    y = np.atleast_2d(np.asarray(traces, dtype=np.float64))
+    ntraces, nframes = y.shape
+    sn = estimate_noise(y, noise_range)
+    g = estimate_ar(y, sn, p=p, lags=lags, fudge_factor=fudge_factor)
+    g = np.pad(g, ((0, 0), (0, 2 - g.shape[1])))
+
+    impulse = np.zeros((ntraces, min(nframes, 1000)))
+    impulse[:, 0] = 1
+    penalty = sparsity * sn * np.linalg.norm(ar_filter(impulse, g), axis=1)
+
+    c = ar_filter(np.repeat(0.01 * sn[:, None], nframes, axis=1), g)  # strictly feasible
+    b = (y - c).mean(axis=1)
+    z = sn ** 2
+    level = np.zeros(ntraces, dtype=int)
+
+    for _ in range(max_iter):
+        active = level < barrier_levels
+        if not active.any():
+            break
+        s = _apply_ar(c, g)
+        gradient, direction = _newton_step(y, b, c, s, g, penalty, z)
+        decrement = -np.sum(gradient * direction, axis=1)
+
+        # converged traces move on to the next barrier level
+        converged = active & (decrement / 2 <= tol * z * nframes)
+        level[converged] += 1
+        z = np.where(converged, z / 10, z)
+        stepping = active & ~converged
+
+        # longest step keeping G c > 0, then backtracking (Armijo) line search
+        ds = _apply_ar(direction, g)
+        with np.errstate(divide='ignore'):
+            max_step = np.where(ds < 0, -s / ds, np.inf).min(axis=1)
+        step = np.where(stepping, np.minimum(1, 0.99 * max_step), 0)
+        current = _objective(y, b, c, g, penalty, z)
+        for _ in range(30):
+            candidate = c + step[:, None] * direction
+            failed = stepping & (_objective(y, b, candidate, g, penalty, z)
+                                 > current - 0.25 * step * decrement)
+            if not failed.any():
+                break
+            step[failed] /= 2
+
+        c = candidate
+        b = (y - c).mean(axis=1)
+
+    converged = level >= barrier_levels
+    if not converged.all():
+        warnings.warn(f'{np.sum(~converged)} of {ntraces} trace(s) did not converge in'
+                      f' {max_iter} iterations', RuntimeWarning)
+
+    return {'spikes': np.maximum(_apply_ar(c, g), 0), 'calcium': c, 'baseline': b,
+            'g': g[:, :p], 'sn': sn, 'converged': converged}
+
+
+# parameters of `deconvolve` read from a processing parameter set
+deconvolution_params = ('p', 'lags', 'fudge_factor', 'noise_range', 'sparsity')
+
+
+def deconvolve_batch(traces, params=None, n_processes=None, batch_size=200):
+    """
+    `deconvolve` the traces in batches of `batch_size` fanned out over a pool of worker processes
+    :param params: deconvolution parameters - p, lags, fudge_factor, noise_range, sparsity
+    :return: (ntraces, nframes) spikes
+    """
+    params = {k: v for k, v in (params or {}).items() if k in deconvolution_params}
+    traces = np.atleast_2d(traces)
+    batches = [traces[first:first + batch_size] for first in range(0, len(traces), batch_size)]
+
+    # n_processes=1: run in-process, e.g. within a worker of `process.run`
+    with (ProcessPoolExecutor(max_workers=n_processes,
+                              mp_context=multiprocessing.get_context('spawn'))
+          if n_processes != 1 and len(batches) > 1 else contextlib.nullcontext()) as executor:
+        map_func = executor.map if executor else map
+        results = list(map_func(_deconvolve_spikes, batches, [params] * len(batches)))
+
+    return np.concatenate(results) if results else np.empty_like(traces)
+
+
+def _deconvolve_spikes(traces, params):
+    return deconvolve(traces, **params)['spikes']
+
+
+# Pipeline ---------------------------------------------------------------------
+# `pipeline` is imported within the functions so that the worker processes above
+# do not connect to the database
+
+# ActivityExtractionMethod of the Activity entries of `populate_activity` - computed for
+# every Fluorescence once registered, with
+# miniscope.ActivityExtractionMethod.insert1({'extraction_method': extraction_method})
+extraction_method = 'ar_batch_deconvolution'
+
+def make_activity(key, n_processes=None):
+    """
+    Deconvolve all the fluorescence traces of an Activity `key` with `deconvolve_batch`,
+    with the deconvolution parameters of its ProcessingParamSet (p, lags, fudge_factor,
+    noise_range - `method_deconvolution` is not used), and insert the spikes.
+    The spikes are looked up in the result cache, if configured, for the contents of the
+    traces and the parameters.
+    """
+    from .pipeline import miniscope
+    from .result_cache import cached_result, array_digest, params_digest
+
+    params = (miniscope.ProcessingParamSet * miniscope.ProcessingTask & key).fetch1('params')
+    trace_keys, fluorescence = (miniscope.Fluorescence.Trace & key).fetch(
+        'KEY', 'fluorescence', order_by='mask')
+
+    traces = np.stack(fluorescence)
+    spikes = cached_result(
+        'activity', lambda: deconvolve_batch(traces, params, n_processes=n_processes),
+        digests=(array_digest(traces), params_digest(
+            {k: v for k, v in params.items() if k in deconvolution_params})))
+
+    with miniscope.Activity.connection.transaction:
+        miniscope.Activity.insert1(key, allow_direct_insert=True)
+        miniscope.Activity.Trace.insert(
+            [dict(trace_key, extraction_method=key['extraction_method'], activity_trace=trace)
+             for trace_key, trace in zip(trace_keys, spikes)],
+            allow_direct_insert=True)
+
+
+def populate_activity(*restrictions, n_processes=None, reserve_jobs=False,
+                      suppress_errors=False):
+    """
+    Populate miniscope.Activity for the `extraction_method` of the batched deconvolution -
+    the element populates the other extraction methods, e.g. CaImAn's 'caiman_deconvolution'
+    :param reserve_jobs: reserve the keys in the jobs table of the `miniscope` schema
+    :return: list of (key, error message) of the failed keys if `suppress_errors`
+    """
+    import datajoint as dj
+    from .pipeline import miniscope
+    from .metrics import measure_stage
+
+    key_source = (miniscope.Fluorescence * miniscope.ActivityExtractionMethod
+                  & {'extraction_method': extraction_method}).proj()
+    keys = ((key_source & dj.AndList(restrictions)) - miniscope.Activity).fetch('KEY')
+
+    jobs, table_name = miniscope.schema.jobs, miniscope.Activity.table_name
+
+    errors = []
+    for key in keys:
+        if reserve_jobs and not jobs.reserve(table_name, key):
+            continue
+        try:
+            with measure_stage('Activity', key, miniscope.Activity):
+                make_activity(key, n_processes=n_processes)
+        except Exception as error:
+            error_message = f'{error.__class__.__name__}: {error}'
+            if reserve_jobs:
+                jobs.error(table_name, key, error_message=error_message)
+            if not suppress_errors:
+                raise
+            errors.append((key, error_message))
+        else:
+            if reserve_jobs:
+                jobs.complete(table_name, key)
+
+    return errors
@@ -0,0 +1,118 @@
+import os
+import pathlib
+import fnmatch
+import collections
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime, timedelta
+
+from .paths import get_miniscope_root_data_dirs
+
+
+# Supported acquisition softwares and the raw files identifying them (in that order)
+scan_patterns = {'Miniscope-DAQ-V4': 'ms*.avi'}
+
+SessionCandidate = collections.namedtuple(
+    'SessionCandidate', ['session_dir', 'acq_software', 'scan_filepaths', 'recording_time'])
+
+
+def round_to_second(timestamp):
+    """ Round a datetime to the second as MySQL does on insert into a `datetime` column
+    (half up), so that in-memory keys match the ones read back from the database """
+    return (timestamp + timedelta(microseconds=500000)).replace(microsecond=0)
+
+
+def _recording_time(filepath):
+    return round_to_second(datetime.fromtimestamp(pathlib.Path(filepath).stat().st_ctime))
+
+
+def find_recording(sess_dir):
+    """
+    Identify the acquisition software and raw files of one session directory
+    :return: SessionCandidate
+    """
+    sess_dir = pathlib.Path(sess_dir)
+
+    for acq_software, scan_pattern in scan_patterns.items():
+        scan_filepaths = sorted(fp.as_posix() for fp in sess_dir.glob(scan_pattern))
+        if len(scan_filepaths):
+            break
+    else:
+        raise FileNotFoundError(f'Unable to identify scan files from the supported acquisition softwares ({", ".join(scan_patterns)}) at: {sess_dir}')
+
+    if acq_software == 'Miniscope-DAQ-V4':
+        recording_time = _recording_time(scan_filepaths[0])
+    else:
+        raise NotImplementedError(f'Processing scan from acquisition software of type {acq_software} is not yet implemented')
+
+    return SessionCandidate(sess_dir, acq_software, scan_filepaths, recording_time)
+
+
+def _scan_directory(directory):
+    """
+    List one directory with a single `scandir` call. An unreadable directory (e.g. a
+    PermissionError) is reported and skipped rather than aborting the walk
+    :return: (sub-directories to descend into, SessionCandidate or None)
+    """
+    subdirs, filenames = [], []
+    try:
+        with os.scandir(directory) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif entry.is_file():
+                    filenames.append(entry.name)
+    except OSError as error:
+        print(f'---- Skipped unreadable directory {directory} ({error}) ----')
+        return [], None
+
+    for acq_software, scan_pattern in scan_patterns.items():
+        matched = sorted(fnmatch.filter(filenames, scan_pattern))
+        if matched:
+            scan_filepaths = [(pathlib.Path(directory) / f).as_posix() for f in matched]
+            candidate = SessionCandidate(pathlib.Path(directory), acq_software, scan_filepaths,
+                                         _recording_time(scan_filepaths[0]))
+            # sessions do not nest - no need to descend into e.g. processing outputs
+            return [], candidate
+
+    return subdirs, None
+
+
+def discover_sessions(root_data_dir=None, max_workers=8):
+    """
+    Walk the tree under the root data directory (default: all the root data directories)
+    with a bounded thread pool, one `scandir` per directory, and yield a SessionCandidate
+    for every directory holding raw recording files as soon as it is found
+    """
+    root_data_dirs = [root_data_dir] if root_data_dir else get_miniscope_root_data_dirs()
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    pending = {executor.submit(_scan_directory, pathlib.Path(root_dir))
+               for root_dir in root_data_dirs}
+    try:
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                subdirs, candidate = future.result()
+                pending.update(executor.submit(_scan_directory, d) for d in subdirs)
+                if candidate is not None:
+                    yield candidate
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+def scan_session_dirs(session_dirs, max_workers=8, find_func=find_recording):
+    """
+    Identify the recordings of many known session directories in parallel,
+    yielding the results of `find_func` in the order of `session_dirs`
+    with at most 2 x `max_workers` directories in flight
+    """
+    window = collections.deque()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for sess_dir in session_dirs:
+            window.append(executor.submit(find_func, sess_dir))
+            if len(window) >= 2 * max_workers:
+                yield window.popleft().result()
+        while window:
+            yield window.popleft().result()
@@ -0,0 +1,126 @@
+import numpy as np
+from scipy import sparse
+
+from .framestore import FrameStore
+
+
+def mask_matrix(mask_ypix, mask_xpix, mask_weights, dims):
+    """
+    Sparse (nmasks, height * width) CSR matrix of the ROI masks, each row normalised to sum
+    to 1 so that its product with a frame is the weighted mean fluorescence of the ROI
+    (the plain mean for a mask whose weights sum to 0)
+    """
+    if not len(mask_weights):
+        return sparse.csr_matrix((0, dims[0] * dims[1]), dtype=np.float32)
+
+    weights = [np.asarray(w, dtype=np.float32) for w in mask_weights]
+    weights = [w / np.sum(w) if np.sum(w) else np.full(len(w), 1 / max(len(w), 1), np.float32)
+               for w in weights]
+    return sparse.csr_matrix(
+        (np.concatenate(weights),
+         (np.concatenate([np.full(len(w), k) for k, w in enumerate(weights)]),
+          np.concatenate([np.ravel_multi_index((np.asarray(y), np.asarray(x)), dims)
+                          for y, x in zip(mask_ypix, mask_xpix)]))),
+        shape=(len(weights), dims[0] * dims[1]), dtype=np.float32)
+
+
+def extract_traces(frame_store, masks, block_size=1000):
+    """
+    Fluorescence traces of the ROIs `masks` (see `mask_matrix`) streamed over blocks of
+    `block_size` frames of the memory-mapped movie, with one sparse-dense matrix product
+    per block. The whole frames of each block are read - the frames are stored pixel after
+    pixel - but only the pixels within the masks are gathered, converted and multiplied.
+    :param frame_store: (nframes, height, width) array-like, e.g. a FrameStore
+    :return: (nmasks, nframes) array - without reading any frame if there is no mask
+    """
+    nframes = len(frame_store)
+    if not masks.shape[0]:
+        return np.empty((0, nframes), dtype=np.float32)
+
+    pixels = np.unique(masks.indices)
+    masks = masks[:, pixels]
+
+    traces = np.empty((masks.shape[0], nframes), dtype=np.float32)
+    for first in range(0, nframes, block_size):
+        frames = np.asarray(frame_store[first:first + block_size])
+        frames = frames.reshape(len(frames), -1)[:, pixels].astype(np.float32)
+        traces[:, first:first + len(frames)] = masks @ frames.T
+    return traces
+
+
+# Pipeline ---------------------------------------------------------------------
+
+def make_fluorescence(key, block_size=1000):
+    """
+    Extract the fluorescence traces of the masks of a Segmentation from its motion corrected
+    movie with `extract_traces` and insert them. The traces are looked up in the result
+    cache, if configured, for the contents of the recording files, the motion correction
+    parameters, the movie read and the masks. A Segmentation without masks gets a
+    Fluorescence entry without traces.
+    """
+    from .pipeline import miniscope
+    from .motion_correction import get_registered_movie_dir
+    from .result_cache import (cached_result, get_recording_files, get_motion_correction_digest,
+                               array_digest)
+
+    mask_ids, channels, ypix, xpix, weights = (miniscope.Segmentation.Mask & key).fetch(
+        'mask', 'segmentation_channel', 'mask_ypix', 'mask_xpix', 'mask_weights', order_by='mask')
+    if not len(mask_ids):
+        miniscope.Fluorescence.insert1(key, allow_direct_insert=True)
+        return
+
+    def extract():
+        frame_store = FrameStore(get_registered_movie_dir(key))
+        return extract_traces(frame_store,
+                              mask_matrix(ypix, xpix, weights, frame_store.shape[1:]),
+                              block_size=block_size)
+
+    traces = cached_result(
+        'fluorescence', extract, input_files=get_recording_files(key),
+        digests=(get_motion_correction_digest(key), 'registered',
+                 array_digest(*[np.concatenate(masks) for masks in (ypix, xpix, weights)],
+                              np.array([len(w) for w in weights]))))
+
+    with miniscope.Fluorescence.connection.transaction:
+        miniscope.Fluorescence.insert1(key, allow_direct_insert=True)
+        miniscope.Fluorescence.Trace.insert(
+            [dict(key, mask=mask_id, fluorescence_channel=channel, fluorescence=trace)
+             for mask_id, channel, trace in zip(mask_ids, channels, traces)],
+            allow_direct_insert=True)
+
+
+def populate_fluorescence(*restrictions, block_size=1000, reserve_jobs=False,
+                          suppress_errors=False):
+    """
+    Sparse, streaming alternative to miniscope.Fluorescence.populate() for the segmentations
+    of `segmentation.populate_segmentation` - the other keys (see
+    `segmentation.get_patch_keys`) are left to the element
+    :param reserve_jobs: reserve the keys in the jobs table of the `miniscope` schema
+    :return: list of (key, error message) of the failed keys if `suppress_errors`
+    """
+    from .pipeline import miniscope
+    from .metrics import measure_stage
+    from .segmentation import get_patch_keys
+
+    keys, _ = get_patch_keys(miniscope.Fluorescence, *restrictions)
+    jobs, table_name = miniscope.schema.jobs, miniscope.Fluorescence.table_name
+
+    errors = []
+    for key in keys:
+        if reserve_jobs and not jobs.reserve(table_name, key):
+            continue
+        try:
+            with measure_stage('Fluorescence', key, miniscope.Fluorescence):
+                make_fluorescence(key, block_size=block_size)
+        except Exception as error:
+            error_message = f'{error.__class__.__name__}: {error}'
+            if reserve_jobs:
+                jobs.error(table_name, key, error_message=error_message)
+            if not suppress_errors:
+                raise
+            errors.append((key, error_message))
+        else:
+            if reserve_jobs:
+                jobs.complete(table_name, key)
+
+    return errors
@@ -0,0 +1,174 @@
+import os
+import json
+import uuid
+import pathlib
+import contextlib
+
+import numpy as np
+
+from .avi import sorted_avi_files, read_avi_header
+
+
+def get_frame_store_paths(recording_dir):
+    """
+    The frame store of a recording lives beside the recording directory:
+    <recording_dir>.frames.dat (raw frames) and <recording_dir>.frames.json (header)
+    """
+    recording_dir = pathlib.Path(recording_dir)
+    return (recording_dir.with_name(recording_dir.name + '.frames.dat'),
+            recording_dir.with_name(recording_dir.name + '.frames.json'))
+
+
+def _source_files(avi_files):
+    return [{'file_path': fp.name, 'file_size': fp.stat().st_size} for fp in avi_files]
+
+
+def _iter_decoded_frames(avi_files):
+    # OpenCV decodes the frames as 8-bit BGR - the Miniscope sensor is 8-bit grayscale
+    import cv2
+
+    for avi_file in avi_files:
+        video = cv2.VideoCapture(pathlib.Path(avi_file).as_posix())
+        while True:
+            success, frame = video.read()
+            if not success:
+                break
+            yield frame[..., 0] if frame.ndim == 3 else frame  # grayscale sensor
+        video.release()
+
+
+def _read_header(header_path):
+    with open(header_path) as f:
+        return json.load(f)
+
+
+def commit_frame_store(recording_dir, tmp_data_path, header):
+    """
+    Publish a frame store whose frames were written to `tmp_data_path`. The header is the
+    commit point: the previous header is removed before the data file is replaced, and
+    the new one, with a new `build_id`, is renamed into place last - a reader (see
+    FrameStore) never pairs a header with the data file of another build.
+    """
+    data_path, header_path = get_frame_store_paths(recording_dir)
+    tmp_header_path = header_path.with_name(f'{header_path.name}.{os.getpid()}.tmp')
+    with open(tmp_header_path, 'w') as f:
+        json.dump({**header, 'build_id': uuid.uuid4().hex}, f, indent=2)
+
+    header_path.unlink(missing_ok=True)
+    os.replace(tmp_data_path, data_path)
+    os.replace(tmp_header_path, header_path)
+
+
+class FrameStore:
+    """
+    Read-only, memory-mapped (nframes, height, width) array of the frames of one recording.
+    Indexing returns views of the file - no frame is copied or decoded.
+    """
+
+    def __init__(self, recording_dir):
+        self.recording_dir = pathlib.Path(recording_dir)
+        self.data_path, self.header_path = get_frame_store_paths(recording_dir)
+
+        # the header is read again once the data is mapped: a different build id means the
+        # store was rebuilt in between (see `commit_frame_store`)
+        for _ in range(3):
+            self.header = _read_header(self.header_path)
+            shape, dtype = tuple(self.header['shape']), self.header['dtype']
+            if not np.prod(shape):  # an empty file cannot be memory-mapped
+                self.frames = np.empty(shape, dtype=dtype)
+            else:
+                self.frames = np.memmap(self.data_path, mode='r', dtype=dtype, shape=shape)
+            with contextlib.suppress(FileNotFoundError):
+                if _read_header(self.header_path).get('build_id') == self.header.get('build_id'):
+                    return
+        raise RuntimeError(f'The frame store of {recording_dir} keeps being rebuilt')
+
+    @property
+    def shape(self):
+        return self.frames.shape
+
+    @property
+    def dtype(self):
+        return self.frames.dtype
+
+    def __len__(self):
+        return self.frames.shape[0]
+
+    def __getitem__(self, item):
+        return self.frames[item]
+
+    def iter_blocks(self, block_size=1000, start=0, stop=None):
+        """ Yield (first frame index, frames[first:first + block_size]) views """
+        stop = len(self) if stop is None else min(stop, len(self))
+        for first in range(start, stop, block_size):
+            yield first, self.frames[first:min(first + block_size, stop)]
+
+    def is_stale(self):
+        """ True if the AVI files of the recording changed since the store was built """
+        return self.header['source_files'] != _source_files(sorted_avi_files(self.recording_dir))
+
+
+def build_frame_store(recording_dir):
+    """
+    Decode the AVI files of a recording once into its uint8 frame store (see
+    `get_frame_store_paths`). The store is pre-allocated from the AVI headers and filled
+    frame by frame, so the recording never has to fit in memory; it is written to a
+    temporary file and published once complete (see `commit_frame_store`).
+    :return: FrameStore
+    """
+    recording_dir = pathlib.Path(recording_dir)
+    data_path, _ = get_frame_store_paths(recording_dir)
+
+    avi_files = sorted_avi_files(recording_dir)
+    if not avi_files:
+        raise FileNotFoundError(f'No .avi files found in {recording_dir}')
+
+    avi_headers = [read_avi_header(fp) for fp in avi_files]
+    nframes = sum(h['nframes'] for h in avi_headers)
+    px_height, px_width = avi_headers[0]['px_height'], avi_headers[0]['px_width']
+
+    if not nframes:
+        raise ValueError(f'No frame indexed in the AVI headers of {recording_dir}')
+
+    dtype = np.uint8
+    tmp_data_path = data_path.with_name(f'{data_path.name}.{os.getpid()}.tmp')
+    frames = np.memmap(tmp_data_path, mode='w+', dtype=dtype, shape=(nframes, px_height, px_width))
+    frame_count = 0
+    try:
+        for frame in _iter_decoded_frames(avi_files):
+            if frame_count == nframes:
+                raise ValueError(f'More frames decoded than indexed in the AVI headers of {recording_dir}')
+            frames[frame_count] = frame
+            frame_count += 1
+        frames.flush()
+        del frames
+        if not frame_count:
+            raise ValueError(f'Unable to decode any frame from the AVI files of {recording_dir}')
+    except BaseException:
+        tmp_data_path.unlink(missing_ok=True)
+        raise
+    if frame_count < nframes:  # truncated recording - drop the unused tail
+        with open(tmp_data_path, 'r+b') as f:
+            f.truncate(frame_count * px_height * px_width * np.dtype(dtype).itemsize)
+
+    commit_frame_store(recording_dir, tmp_data_path,
+                       {'shape': [frame_count, px_height, px_width],
+                        'dtype': np.dtype(dtype).name,
+                        'fps': avi_headers[0]['fps'],
+                        'source_files': _source_files(avi_files)})
+
+    return FrameStore(recording_dir)
+
+
+def open_frame_store(recording_dir, build=True):
+    """
+    Open the frame store of a recording, building it first if missing or stale and `build`
+    """
+    _, header_path = get_frame_store_paths(recording_dir)
+    if header_path.exists():
+        frame_store = FrameStore(recording_dir)
+        if not frame_store.is_stale():
+            return frame_store
+    if not build:
+        raise FileNotFoundError(f'No up-to-date frame store for {recording_dir}')
+    return build_frame_store(recording_dir)
@@ -1,74 +1,309 @@
-import pathlib
 import csv
-from datetime import datetime
+import time
 
-from .pipeline import subject, miniscope, session, Equipment
-from .paths import get_miniscope_root_data_dir
+from .paths import get_miniscope_root_data_dirs, get_relative_path, get_scan_manifest_path
+from .discovery import discover_sessions, scan_session_dirs, find_recording
+from .manifest import ScanManifest
+from .csv_stream import read_csv_chunks, validate_rows, Checkpoint
+from .metrics import measure_stage
 
+# `pipeline` is imported within the functions: this module imports without connecting
+# to the database, e.g. to validate the CSV files or for a dry run
 
-def ingest_subjects(subject_csv_path='./user_data/subjects.csv'):
-    # -------------- Insert new "Subject" --------------
-    with open(subject_csv_path, newline= '') as f:
-        input_subjects = list(csv.DictReader(f, delimiter=','))
 
-    print(f'\n---- Insert {len(input_subjects)} entry(s) into subject.Subject ----')
-    subject.Subject.insert(input_subjects, skip_duplicates=True)
+subject_required_fields = ('subject', 'sex', 'subject_birth_date')
+session_required_fields = ('subject', 'session_dir')
 
+
+def ingest_subjects(subject_csv_path='./user_data/subjects.csv', stream=False, chunk_size=10000):
+    from .pipeline import subject
+
+    with measure_stage('ingest_subjects'):
+        if stream:
+            return _stream_subjects(subject_csv_path, chunk_size=chunk_size)
+
+        # -------------- Insert new "Subject" --------------
+        with open(subject_csv_path, newline= '') as f:
+            input_subjects = list(csv.DictReader(f, delimiter=','))
+
+        print(f'\n---- Insert {len(input_subjects)} entry(s) into subject.Subject ----')
+        subject.Subject.insert(input_subjects, skip_duplicates=True)
+
+        print('\n---- Successfully completed ingest_subjects ----')
+
+
+def _stream_ingest(csv_path, insert_chunk, required_fields, chunk_size):
+    """
+    Read, validate and insert a CSV file in chunks of `chunk_size` rows, one transaction
+    per chunk, checkpointing the committed rows so that an interrupted run resumes
+    after the last committed chunk
+    :param insert_chunk: function inserting one validated list of rows
+    :return: number of rows committed in this run
+    """
+    from .pipeline import session
+
+    checkpoint = Checkpoint(csv_path)
+    committed_rows = checkpoint.load()
+    if committed_rows:
+        print(f'\n---- Resuming {csv_path} after {committed_rows} committed row(s) ----')
+
+    start_time, row_count = time.time(), 0
+    connection = session.Session.connection
+    for first_row, rows in read_csv_chunks(csv_path, chunk_size=chunk_size, skip_rows=committed_rows):
+        validate_rows(rows, required_fields, first_row=first_row)
+        with connection.transaction:
+            insert_chunk(rows)
+        checkpoint.save(first_row + len(rows))
+
+        row_count += len(rows)
+        print(f'---- Committed rows {first_row}-{first_row + len(rows) - 1}'
+              f' ({row_count / max(time.time() - start_time, 1e-9):.1f} rows/s) ----')
+
+    checkpoint.clear()
+    return row_count
+
+
+def _stream_subjects(subject_csv_path, chunk_size=10000):
+    from .pipeline import subject
+
+    def insert_chunk(rows):
+        subject.Subject.insert(rows, skip_duplicates=True)
+
+    row_count = _stream_ingest(subject_csv_path, insert_chunk, subject_required_fields, chunk_size)
+    print(f'\n---- Streamed {row_count} row(s) into subject.Subject ----')
     print('\n---- Successfully completed ingest_subjects ----')
 
 
-def ingest_sessions(session_csv_path='./user_data/sessions.csv'):
-    root_data_dir = get_miniscope_root_data_dir()
+def insert_sessions(session_list, session_dir_list, chunk_size=500, scanner_list=()):
+    """
+    Insert Session and SessionDirectory entries in multi-row transactions of `chunk_size`,
+    and the Equipment entries of `scanner_list` within the first one
+    :return: number of inserted sessions
+    """
+    from .pipeline import session, Equipment
 
-    # ---------- Insert new "Session" and "Scan" ---------
-    with open(session_csv_path, newline='') as f:
-        input_sessions = list(csv.DictReader(f, delimiter=','))
+    connection = session.Session.connection
+    for start in range(0, len(session_list), chunk_size):
+        with connection.transaction:
+            if not start:
+                Equipment.insert(scanner_list, skip_duplicates=True)
+            session.Session.insert(session_list[start:start + chunk_size])
+            session.SessionDirectory.insert(session_dir_list[start:start + chunk_size])
+    return len(session_list)
 
+
+def _fetch_session_keys():
+    from .pipeline import session
+
+    return set(zip(*session.Session.fetch('subject', 'session_datetime')))
+
+
+def _recording_scanner(recording):
+    """ Scanner (Equipment) of a SessionCandidate - the DAQ software writes no model yet """
+    return 'Miniscope-DAQ-V4'
+
+
+def _new_session_entries(subject_recordings, root_data_dirs, existing_keys):
+    """
+    Diff (subject, SessionCandidate) pairs against the `existing_keys` in memory,
+    adding the new keys to `existing_keys`
+    :return: (number of pairs, scanner_list, session_list, session_dir_list)
+    """
     # Folder structure: root / subject / session / .avi (raw)
     session_list, session_dir_list, scan_list, scanner_list = [], [], [], []
 
-    for sess in input_sessions:
-        sess_dir = pathlib.Path(sess['session_dir'])
-
-        # Search for Miniscope-DAQ-V3 files (in that order)
-        for scan_pattern, scan_type, glob_func in zip(['ms*.avi'],
-                                                      ['Miniscope-DAQ-V4'],
-                                                      [sess_dir.glob]):
-            scan_filepaths = [fp.as_posix() for fp in glob_func(scan_pattern)]
-            if len(scan_filepaths):
-                acq_software = scan_type
-                break
-        else:
-            raise FileNotFoundError(f'Unable to identify scan files from the supported acquisition softwares (Miniscope-DAQ-V3) at: {sess_dir}')
+    row_count = 0
+    for row_count, (subject_name, recording) in enumerate(subject_recordings, start=1):
+        acq_software, recording_time = recording.acq_software, recording.recording_time
+        scanner = _recording_scanner(recording)
 
-        if acq_software == 'Miniscope-DAQ-V4':
-            daq_v3_fp = pathlib.Path(scan_filepaths[0])
-            recording_time = datetime.fromtimestamp(daq_v3_fp.stat().st_ctime)
-            scanner = 'Miniscope-DAQ-V4'
-        else:
-            raise NotImplementedError(f'Processing scan from acquisition software of type {acq_software} is not yet implemented')
-
-        session_key = {'subject': sess['subject'], 'session_datetime': recording_time}
-        if session_key not in session.Session():
+        session_key = {'subject': subject_name, 'session_datetime': recording_time}
+        if (subject_name, recording_time) not in existing_keys:
+            existing_keys.add((subject_name, recording_time))
             scanner_list.append({'scanner': scanner})
             session_list.append(session_key)
             scan_list.append({**session_key, 'scan_id': 0, 'scanner': scanner, 'acq_software': acq_software})
 
-            session_dir_list.append({**session_key, 'session_dir': sess_dir.relative_to(root_data_dir).as_posix()})
-
-    print(f'\n---- Insert {len(set(val for dic in scanner_list for val in dic.values()))} entry(s) into experiment.Equipment ----')
-    Equipment.insert(scanner_list, skip_duplicates=True)
-
-    print(f'\n---- Insert {len(session_list)} entry(s) into session.Session ----')
-    session.Session.insert(session_list)
-    session.SessionDirectory.insert(session_dir_list)
+            session_dir_list.append({**session_key, 'session_dir': get_relative_path(recording.session_dir, root_data_dirs).as_posix()})
 
     # print(f'\n---- Insert {len(scan_list)} entry(s) into scan.Scan ----')
     # miniscope.RecordingInfo.insert(scan_list)
 
+    scanner_list = [{'scanner': s} for s in sorted(set(s['scanner'] for s in scanner_list))]
+    return row_count, scanner_list, session_list, session_dir_list
+
+
+def _ingest_recordings(subject_recordings, root_data_dirs, chunk_size=500):
+    """
+    Insert the new sessions among (subject, SessionCandidate) pairs
+    :return: number of processed pairs
+    """
+    # Fetch all existing session keys once and diff against them in memory
+    row_count, scanner_list, session_list, session_dir_list = _new_session_entries(
+        subject_recordings, root_data_dirs, _fetch_session_keys())
+
+    print(f'\n---- Insert {len(scanner_list)} entry(s) into experiment.Equipment'
+          f' and {len(session_list)} entry(s) into session.Session ----')
+    insert_start = time.time()
+    insert_sessions(session_list, session_dir_list, chunk_size=chunk_size,
+                    scanner_list=scanner_list)
+    print(f'\n---- Inserted at {len(session_list) / max(time.time() - insert_start, 1e-9):.1f} rows/s ----')
+
+    return row_count
+
+
+def ingest_sessions(session_csv_path='./user_data/sessions.csv', chunk_size=500, max_workers=8,
+                    use_manifest=False, stream=False):
+    with measure_stage('ingest_sessions'):
+        root_data_dirs = get_miniscope_root_data_dirs()
+        start_time = time.time()
+
+        if stream:
+            return _stream_sessions(session_csv_path, root_data_dirs, chunk_size=chunk_size,
+                                    max_workers=max_workers, use_manifest=use_manifest)
+
+        # ---------- Insert new "Session" and "Scan" ---------
+        with open(session_csv_path, newline='') as f:
+            input_sessions = list(csv.DictReader(f, delimiter=','))
+
+        # Identify the recordings of all session directories in parallel,
+        # only re-scanning directories changed since the last run if `use_manifest`
+        session_dirs = [sess['session_dir'] for sess in input_sessions]
+        manifest = ScanManifest(get_scan_manifest_path()) if use_manifest else None
+        try:
+            recordings = (manifest.scan_session_dirs(session_dirs, max_workers=max_workers)
+                          if manifest else scan_session_dirs(session_dirs, max_workers=max_workers))
+            row_count = _ingest_recordings(zip([sess['subject'] for sess in input_sessions], recordings),
+                                           root_data_dirs, chunk_size=chunk_size)
+        finally:
+            if manifest:
+                print(f'\n---- Re-scanned {manifest.rescanned_count} changed session directory(s) ----')
+                manifest.close()
+
+        duration = time.time() - start_time
+        print(f'\n---- Processed {row_count} row(s) in {duration:.2f}s'
+              f' ({row_count / max(duration, 1e-9):.1f} rows/s) ----')
+        print('\n---- Successfully completed ingest_sessions ----')
+
+
+def _stream_sessions(session_csv_path, root_data_dirs, chunk_size=500, max_workers=8,
+                     use_manifest=False):
+    from .pipeline import session, Equipment
+
+    existing_keys = _fetch_session_keys()
+    manifest = ScanManifest(get_scan_manifest_path()) if use_manifest else None
+
+    def insert_chunk(rows):
+        session_dirs = [sess['session_dir'] for sess in rows]
+        recordings = (manifest.scan_session_dirs(session_dirs, max_workers=max_workers)
+                      if manifest else scan_session_dirs(session_dirs, max_workers=max_workers))
+        _, scanner_list, session_list, session_dir_list = _new_session_entries(
+            zip([sess['subject'] for sess in rows], recordings), root_data_dirs, existing_keys)
+
+        Equipment.insert(scanner_list, skip_duplicates=True)
+        session.Session.insert(session_list)
+        session.SessionDirectory.insert(session_dir_list)
+
+    try:
+        row_count = _stream_ingest(session_csv_path, insert_chunk, session_required_fields, chunk_size)
+    finally:
+        if manifest:
+            manifest.close()
+
+    print(f'\n---- Streamed {row_count} row(s) into session.Session ----')
     print('\n---- Successfully completed ingest_sessions ----')
 
 
+def ingest_discovered_sessions(root_data_dir=None, chunk_size=500, max_workers=8):
+    """
+    Ingest all sessions found under the root data directory (root / subject / ... / .avi),
+    by default under all the root data directories, for subjects already present in
+    subject.Subject
+    """
+    from .pipeline import subject
+
+    root_data_dirs = [root_data_dir] if root_data_dir else get_miniscope_root_data_dirs()
+    start_time = time.time()
+
+    known_subjects = set(subject.Subject.fetch('subject'))
+    subject_recordings, unknown_subjects, misplaced_dirs = [], set(), []
+    for recording in discover_sessions(root_data_dir, max_workers=max_workers):
+        relative_dir = get_relative_path(recording.session_dir, root_data_dirs)
+        if not relative_dir.parts:  # recording files directly in a root data directory
+            misplaced_dirs.append(recording.session_dir.as_posix())
+            continue
+        subject_name = relative_dir.parts[0]
+        if subject_name in known_subjects:
+            subject_recordings.append((subject_name, recording))
+        else:
+            unknown_subjects.add(subject_name)
+
+    print(f'\n---- Discovered {len(subject_recordings)} session(s) in {time.time() - start_time:.2f}s ----')
+    if unknown_subjects:
+        print(f'\n---- Skipped session(s) of unknown subject(s): {sorted(unknown_subjects)} ----')
+    if misplaced_dirs:
+        print(f'\n---- Skipped recording(s) outside a subject directory: {misplaced_dirs} ----')
+
+    _ingest_recordings(subject_recordings, root_data_dirs, chunk_size=chunk_size)
+    print('\n---- Successfully completed ingest_discovered_sessions ----')
+
+
+def _check_session_dir(session_dir, root_data_dirs):
+    """ :return: error message of one session directory, None if its recording is found """
+    try:
+        find_recording(session_dir)
+        get_relative_path(session_dir, root_data_dirs)
+    except (OSError, ValueError, NotImplementedError) as error:
+        return f'{session_dir}: {error}'
+
+
+def _valid_rows(csv_path, rows, required_fields, first_row, row_errors):
+    """ The rows of a chunk with all the `required_fields`, the others reported in `row_errors` """
+    try:
+        validate_rows(rows, required_fields, first_row=first_row)
+    except ValueError as error:
+        row_errors.append(f'{csv_path}: {error}')
+        return [row for row in rows if all(row.get(field) for field in required_fields)]
+    return rows
+
+
+def dry_run(subject_csv_path=None, session_csv_path=None, chunk_size=10000, max_workers=8):
+    """
+    Validate the CSV files and identify the recordings of the session directories
+    without connecting to the database
+    :return: dict of the number of valid subject and session rows, the error messages of the
+             invalid rows, and of the session directories without a recording or outside the
+             root data directories
+    """
+    result = {'subjects': 0, 'sessions': 0, 'row_errors': [], 'session_errors': []}
+    if subject_csv_path:
+        for first_row, rows in read_csv_chunks(subject_csv_path, chunk_size=chunk_size):
+            result['subjects'] += len(_valid_rows(subject_csv_path, rows, subject_required_fields,
+                                                  first_row, result['row_errors']))
+        print(f'\n---- {subject_csv_path}: {result["subjects"]} valid row(s) ----')
+
+    if session_csv_path:
+        root_data_dirs = get_miniscope_root_data_dirs()
+        for first_row, rows in read_csv_chunks(session_csv_path, chunk_size=chunk_size):
+            rows = _valid_rows(session_csv_path, rows, session_required_fields, first_row,
+                               result['row_errors'])
+            result['session_errors'].extend(error for error in scan_session_dirs(
+                [sess['session_dir'] for sess in rows], max_workers=max_workers,
+                find_func=lambda session_dir: _check_session_dir(session_dir, root_data_dirs))
+                if error)
+            result['sessions'] += len(rows)
+
+        print(f'\n---- {session_csv_path}: {result["sessions"]} valid row(s),'
+              f' {len(result["session_errors"])} session directory(s) with errors ----')
+        for error in result['session_errors'][:10]:
+            print(f'---- {error} ----')
+
+    for error in result['row_errors']:
+        print(f'---- Invalid row(s) - {error} ----')
+
+    return result
+
+
 if __name__ == '__main__':
     ingest_subjects()
     ingest_sessions()
@@ -0,0 +1,103 @@
+import os
+import pathlib
+import sqlite3
+from datetime import datetime
+
+from .discovery import SessionCandidate, find_recording, scan_session_dirs
+
+
+class ScanManifest:
+    """
+    On-disk (SQLite) record of the scanned session directories: directory mtime,
+    raw files with their sizes and the derived recording time.
+    A session directory is only re-scanned when its mtime has changed.
+    """
+
+    def __init__(self, manifest_path):
+        self.manifest_path = pathlib.Path(manifest_path)
+        self.connection = sqlite3.connect(self.manifest_path.as_posix())
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS session_dir (
+                session_dir    TEXT PRIMARY KEY,
+                mtime_ns       INTEGER NOT NULL,
+                acq_software   TEXT NOT NULL,
+                recording_time TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS scan_file (
+                session_dir    TEXT NOT NULL,
+                file_path      TEXT NOT NULL,
+                file_size      INTEGER NOT NULL,
+                PRIMARY KEY (session_dir, file_path)
+            );
+        """)
+
+        # Load the whole manifest once - lookups from worker threads are then read-only
+        scan_files = {}
+        for sess_dir, file_path in self.connection.execute(
+                'SELECT session_dir, file_path FROM scan_file ORDER BY session_dir, file_path'):
+            scan_files.setdefault(sess_dir, []).append(file_path)
+
+        self._entries = {
+            sess_dir: (mtime_ns, SessionCandidate(pathlib.Path(sess_dir), acq_software,
+                                                  scan_files.get(sess_dir, []),
+                                                  datetime.fromisoformat(recording_time)))
+            for sess_dir, mtime_ns, acq_software, recording_time in self.connection.execute(
+                'SELECT session_dir, mtime_ns, acq_software, recording_time FROM session_dir')}
+        self.rescanned_count = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def lookup(self, sess_dir):
+        """
+        :return: (SessionCandidate, mtime_ns, changed) - `changed` is False when the
+         directory is unchanged since the last scan and the cached entry is returned
+        """
+        sess_dir = pathlib.Path(sess_dir)
+        mtime_ns = os.stat(sess_dir).st_mtime_ns
+
+        mtime_cached, candidate = self._entries.get(sess_dir.as_posix(), (None, None))
+        if mtime_cached == mtime_ns:
+            return candidate, mtime_ns, False
+
+        return find_recording(sess_dir), mtime_ns, True
+
+    def update(self, candidate, mtime_ns):
+        sess_dir = pathlib.Path(candidate.session_dir).as_posix()
+        file_sizes = [(sess_dir, fp, os.stat(fp).st_size) for fp in candidate.scan_filepaths]
+
+        with self.connection:
+            self.connection.execute('DELETE FROM scan_file WHERE session_dir = ?', (sess_dir,))
+            self.connection.execute('INSERT OR REPLACE INTO session_dir VALUES (?, ?, ?, ?)',
+                                    (sess_dir, mtime_ns, candidate.acq_software,
+                                     candidate.recording_time.isoformat()))
+            self.connection.executemany('INSERT INTO scan_file VALUES (?, ?, ?)', file_sizes)
+
+        self._entries[sess_dir] = (mtime_ns, candidate)
+
+    def file_sizes(self, sess_dir):
+        return dict(self.connection.execute(
+            'SELECT file_path, file_size FROM scan_file WHERE session_dir = ?',
+            (pathlib.Path(sess_dir).as_posix(),)))
+
+    def scan_session_dirs(self, session_dirs, max_workers=8):
+        """
+        Same as `discovery.scan_session_dirs`, only re-scanning the directories
+        whose mtime changed since the last run and recording them in the manifest
+        """
+        self.rescanned_count = 0
+        for candidate, mtime_ns, changed in scan_session_dirs(
+                session_dirs, max_workers=max_workers, find_func=self.lookup):
+            if changed:
+                self.update(candidate, mtime_ns)
+                self.rescanned_count += 1
+            yield candidate
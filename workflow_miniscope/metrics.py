@@ -0,0 +1,238 @@
+import os
+import time
+import socket
+import pathlib
+import datetime
+import contextlib
+
+import datajoint as dj
+
+
+# Configuration (dj.config['custom']):
+#   miniscope_metrics            - record the metrics of every stage call (default: True)
+#   miniscope_metrics_prom_file  - also accumulate them in this Prometheus text-format file
+#   miniscope_profile            - 'cprofile' or 'pyinstrument' to profile every stage call...
+#   miniscope_profile_dir        - ...and keep the profiles of the slowest keys in this directory
+#   miniscope_profile_top        - number of profiles kept per stage (default: 5)
+
+def _config(name, default=None):
+    return dj.config.get('custom', {}).get(name, default)
+
+
+# Process resource usage -------------------------------------------------------
+
+def _cpu_time():
+    """ User + system time of the process and its terminated children """
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def _reset_peak_rss():
+    # writing 5 to clear_refs resets the peak RSS (VmHWM) - Linux only
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss():
+    """ (bytes) peak resident set size of the process since `_reset_peak_rss`, Linux only """
+    try:
+        with open('/proc/self/status') as f:
+            return next(int(line.split()[1]) * 1024 for line in f if line.startswith('VmHWM:'))
+    except (OSError, StopIteration):
+        return None
+
+
+def _bytes_read():
+    """ Bytes read from storage by the process (including memory-mapped pages), Linux only """
+    try:
+        with open('/proc/self/io') as f:
+            return next(int(line.split()[1]) for line in f if line.startswith('read_bytes:'))
+    except (OSError, StopIteration):
+        return None
+
+
+def _count_rows(table, key):
+    """ Entries of `key` in `table` and its part tables """
+    parts = [getattr(table, name) for name in dir(type(table))
+             if isinstance(getattr(type(table), name), type)
+             and issubclass(getattr(type(table), name), dj.Part)]
+    return sum(len(t & key) for t in (table, *parts))
+
+
+# Prometheus text file ---------------------------------------------------------
+
+def _format_value(value):
+    # counts as full integers, times with all the digits of the float - no rounding
+    return str(value) if isinstance(value, int) else repr(float(value))
+
+
+def _parse_value(value):
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+
+def update_prometheus_file(filepath, stage, record):
+    """
+    Add a stage call to the per-stage totals of a Prometheus text-format file (e.g. for the
+    node exporter's textfile collector), shared by the processes of the node via a lock file
+    """
+    filepath = pathlib.Path(filepath)
+    filepath.parent.mkdir(parents=True, exist_ok=True)
+    increments = {'miniscope_stage_calls_total': 1,
+                  'miniscope_stage_errors_total': int(record['error'] is not None),
+                  'miniscope_stage_wall_seconds_total': record['wall_time'],
+                  'miniscope_stage_cpu_seconds_total': record['cpu_time'],
+                  'miniscope_stage_bytes_read_total': record['bytes_read'] or 0,
+                  'miniscope_stage_rows_inserted_total': record['rows_inserted'] or 0}
+    maxima = {'miniscope_stage_peak_rss_bytes': record['peak_rss'] or 0,
+              'miniscope_stage_max_wall_seconds': record['wall_time']}
+
+    with open(filepath.with_name(filepath.name + '.lock'), 'w') as lock:
+        try:
+            import fcntl
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        except ImportError:  # Windows - no lock
+            pass
+
+        samples = {}
+        if filepath.exists():
+            for line in filepath.read_text().splitlines():
+                if line and not line.startswith('#'):
+                    sample, value = line.rsplit(' ', 1)
+                    samples[sample] = _parse_value(value)
+
+        for name, value in {**increments, **maxima}.items():
+            sample = f'{name}{{stage="{stage}"}}'
+            samples[sample] = (samples.get(sample, 0) + value if name in increments
+                               else max(samples.get(sample, 0), value))
+
+        lines = []
+        for name in (*increments, *maxima):
+            lines.append(f'# TYPE {name} {"counter" if name in increments else "gauge"}')
+            lines.extend(f'{sample} {_format_value(value)}'
+                         for sample, value in sorted(samples.items())
+                         if sample.startswith(name + '{'))
+
+        tmp_path = filepath.with_name(f'{filepath.name}.{os.getpid()}.tmp')
+        tmp_path.write_text('\n'.join(lines) + '\n')
+        os.replace(tmp_path, filepath)
+
+
+# Profiling --------------------------------------------------------------------
+
+@contextlib.contextmanager
+def _profile(profiler_name):
+    """ Profile the block with cProfile or pyinstrument; yields a function saving the profile """
+    if profiler_name == 'pyinstrument':
+        from pyinstrument import Profiler
+
+        profiler = Profiler()
+        profiler.start()
+        saved = {}
+        try:
+            yield lambda filepath: saved.setdefault('filepath', filepath)
+        finally:
+            profiler.stop()
+            if 'filepath' in saved:
+                pathlib.Path(saved['filepath']).with_suffix('.html').write_text(
+                    profiler.output_html())
+    else:
+        import cProfile
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+        saved = {}
+        try:
+            yield lambda filepath: saved.setdefault('filepath', filepath)
+        finally:
+            profiler.disable()
+            if 'filepath' in saved:
+                profiler.dump_stats(pathlib.Path(saved['filepath']).with_suffix('.prof'))
+
+
+def _keep_slowest_profiles(profile_dir, stage, top):
+    # profile file names: <stage>_<wall time in ms, zero-padded>_<key hash>.<suffix>
+    profiles = sorted(profile_dir.glob(f'{stage}_*'), reverse=True)
+    for filepath in profiles[top:]:
+        filepath.unlink(missing_ok=True)
+
+
+# Stage metrics ----------------------------------------------------------------
+
+@contextlib.contextmanager
+def measure_stage(stage, key=None, table=None):
+    """
+    Record the wall time, CPU time, peak RSS, bytes read and rows inserted (into `table`
+    and its part tables for `key`) of one call of a workflow stage in StageMetrics, and
+    optionally in a Prometheus text file and a profile of the slowest keys (see above).
+    The metrics never fail the stage: recording errors are only reported.
+    :param stage: name of the stage, e.g. 'Segmentation' or 'ingest_sessions'
+    :param key: key (or restriction) processed by the call, None for a whole-table call -
+     whose rows are not counted: counting the whole table is slow and includes the rows
+     inserted concurrently by other workers; the call may set `rows_inserted` itself
+    :yield: dict of the metrics, filled in on exit
+    """
+    if not _config('miniscope_metrics', True):
+        yield {}
+        return
+
+    key = dict(key) if key else None
+    count_rows = table is not None and key is not None
+    rows_before = _count_rows(table, key) if count_rows else None
+    record = {'stage': stage, 'key': key, 'error': None}
+
+    profiler_name, profile_dir = _config('miniscope_profile'), _config('miniscope_profile_dir')
+    profile = contextlib.nullcontext(None)
+    if profiler_name and profile_dir:
+        pathlib.Path(profile_dir).mkdir(parents=True, exist_ok=True)
+        profile = _profile(profiler_name)
+
+    has_peak_rss = _reset_peak_rss()
+    bytes_read, cpu_time = _bytes_read(), _cpu_time()
+    start_time, wall_start = datetime.datetime.now(), time.perf_counter()
+    try:
+        with profile as save_profile:
+            try:
+                yield record
+            finally:
+                record['wall_time'] = time.perf_counter() - wall_start
+                if save_profile is not None:
+                    save_profile(pathlib.Path(profile_dir)
+                                 / f'{stage}_{int(record["wall_time"] * 1000):012d}_'
+                                   f'{dj.hash.key_hash(key or {})}')
+    except Exception as error:
+        record['error'] = f'{error.__class__.__name__}: {error}'[:1000]
+        raise
+    finally:
+        record.update(
+            start_time=start_time, cpu_time=_cpu_time() - cpu_time,
+            peak_rss=_peak_rss() if has_peak_rss else None,
+            bytes_read=None if bytes_read is None else _bytes_read() - bytes_read)
+        try:
+            record['rows_inserted'] = (_count_rows(table, key) - rows_before
+                                       if count_rows else record.get('rows_inserted'))
+            _save_record(record)
+            if profile_dir and profiler_name:
+                _keep_slowest_profiles(pathlib.Path(profile_dir), stage,
+                                       _config('miniscope_profile_top', 5))
+        except Exception as error:
+            print(f'---- Failed to record the metrics of {stage}'
+                  f' ({error.__class__.__name__}: {error}) ----')
+
+
+def _save_record(record):
+    from .pipeline import StageMetrics
+
+    StageMetrics.insert1(dict(record, key_hash=dj.hash.key_hash(record['key'] or {}),
+                              hostname=socket.gethostname()[:64]),
+                         ignore_extra_fields=True)
+
+    prom_file = _config('miniscope_metrics_prom_file')
+    if prom_file:
+        update_prometheus_file(prom_file, record['stage'], record)
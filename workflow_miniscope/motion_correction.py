@@ -0,0 +1,389 @@
+import os
+import math
+import pathlib
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy import fft
+
+from .framestore import (FrameStore, open_frame_store, get_frame_store_paths, commit_frame_store,
+                         _read_header)
+
+
+# Rigid registration backends --------------------------------------------------
+# register(frames, template, max_shifts) -> (nframes, 2) (y, x) shifts
+# apply_shifts(frames, shifts) -> registered float32 frames
+
+def _caiman_register(frames, template, max_shifts):
+    from caiman.motion_correction import register_translation
+
+    return np.array([register_translation(template, frame.astype(np.float32),
+                                          upsample_factor=4, max_shifts=max_shifts)[0]
+                     for frame in frames])
+
+
+def _caiman_apply_shifts(frames, shifts):
+    from caiman.motion_correction import apply_shift_iteration
+
+    return np.stack([apply_shift_iteration(frame.astype(np.float32), shift)
+                     for frame, shift in zip(frames, shifts)])
+
+
+def _frequencies(shape):
+    return (np.fft.fftfreq(shape[0])[:, None], np.fft.fftfreq(shape[1])[None, :])
+
+
+def _upsampled_dft(data, region_size, upsample_factor, offsets):
+    """
+    Batched, matrix-multiply DFT of `data` (n, h, w) upsampled by `upsample_factor` in a
+    `region_size` square starting at the (n, 2) `offsets` (Guizar-Sicairos et al. 2008)
+    """
+    _, height, width = data.shape
+    column_kernel = np.exp(
+        (-2j * np.pi / (width * upsample_factor))
+        * (np.fft.ifftshift(np.arange(width)) - width // 2)[None, :, None]
+        * (np.arange(region_size)[None, None, :] - offsets[:, 1, None, None]))
+    row_kernel = np.exp(
+        (-2j * np.pi / (height * upsample_factor))
+        * (np.arange(region_size)[None, :, None] - offsets[:, 0, None, None])
+        * (np.fft.ifftshift(np.arange(height)) - height // 2)[None, None, :])
+    return row_kernel @ data @ column_kernel
+
+
+def fft_register(frames, template, max_shifts, upsample_factor=10):
+    """
+    Batched rigid registration by FFT cross-correlation: integer peak search within
+    `max_shifts` over all frames at once, refined to 1/`upsample_factor` pixel by an
+    upsampled DFT around each peak
+    :return: (nframes, 2) (y, x) shifts registering each frame to the template
+    """
+    frames = np.asarray(frames, dtype=np.float32)
+    nframes, height, width = frames.shape
+    image_product = (fft.fft2(np.asarray(template, dtype=np.float32))[None]
+                     * fft.fft2(frames, workers=-1).conj())
+
+    # integer shifts - peak of the cross-correlation within +/- max_shifts
+    cross_correlation = fft.ifft2(image_product, workers=-1).real
+    row_shifts = np.fft.fftfreq(height, 1 / height)
+    column_shifts = np.fft.fftfreq(width, 1 / width)
+    out_of_range = (np.abs(row_shifts)[:, None] > max_shifts[0]) | (np.abs(column_shifts)[None, :] > max_shifts[1])
+    cross_correlation[:, out_of_range] = -np.inf
+    peaks = cross_correlation.reshape(nframes, -1).argmax(axis=1)
+    shifts = np.stack([row_shifts[peaks // width], column_shifts[peaks % width]], axis=1)
+
+    if upsample_factor > 1:
+        region_size = int(np.ceil(upsample_factor * 1.5))
+        dftshift = np.fix(region_size / 2)
+        upsampled = _upsampled_dft(image_product.conj(), region_size, upsample_factor,
+                                   dftshift - shifts * upsample_factor).conj()
+        peaks = np.abs(upsampled).reshape(nframes, -1).argmax(axis=1)
+        shifts = shifts + (np.stack([peaks // region_size, peaks % region_size], axis=1)
+                           - dftshift) / upsample_factor
+
+    return shifts
+
+
+def fft_apply_shifts(frames, shifts):
+    """
+    Translate each frame by its (y, x) shift with a Fourier phase ramp (circular borders)
+    """
+    frames = np.asarray(frames, dtype=np.float32)
+    row_frequencies, column_frequencies = _frequencies(frames.shape[1:])
+    phase_ramp = np.exp(-2j * np.pi * (shifts[:, 0, None, None] * row_frequencies
+                                       + shifts[:, 1, None, None] * column_frequencies))
+    return fft.ifft2(fft.fft2(frames, workers=-1) * phase_ramp.astype(np.complex64),
+                     workers=-1).real.astype(np.float32)
+
+
+backends = {'caiman': (_caiman_register, _caiman_apply_shifts),
+            'numpy': (fft_register, fft_apply_shifts)}
+
+
+# Chunked motion correction ----------------------------------------------------
+
+def split_blocks(nframes, splits_rig=14, num_frames_split=80, max_block_size=2000):
+    """
+    Split a recording into `splits_rig` blocks (more if a block would exceed
+    `max_block_size` frames) overlapping by `num_frames_split` frames
+    :return: list of (start, stop, core_start, core_stop) - frames [start, stop) are
+     registered; each frame belongs to the [core_start, core_stop) of exactly one block
+    """
+    nblocks = max(splits_rig or 1, math.ceil(nframes / max_block_size))
+    core_size = math.ceil(nframes / nblocks)
+    blocks = []
+    for core_start in range(0, nframes, core_size):
+        core_stop = min(core_start + core_size, nframes)
+        blocks.append((max(core_start - num_frames_split, 0), core_stop, core_start, core_stop))
+    return blocks
+
+
+def _iter_batches(frames, batch_size):
+    for first in range(0, len(frames), batch_size):
+        yield first, frames[first:first + batch_size]
+
+
+def _estimate_block_shifts(recording_dir, block, template, max_shifts, niter_rig, backend,
+                           batch_size):
+    """
+    Register the frames of one block to the template, refining the template from the
+    registered block frames for `niter_rig` iterations
+    :return: (nframes in block, 2) shifts
+    """
+    register, apply_shifts = backends[backend]
+    start, stop, _, _ = block
+    frames = FrameStore(recording_dir)[start:stop]
+
+    for iteration in range(niter_rig):
+        shifts = np.concatenate([register(batch, template, max_shifts)
+                                 for _, batch in _iter_batches(frames, batch_size)])
+        if iteration < niter_rig - 1:
+            template = sum(apply_shifts(batch, shifts[first:first + len(batch)]).sum(axis=0)
+                           for first, batch in _iter_batches(frames, batch_size)) / len(frames)
+    return shifts
+
+
+def _apply_block_shifts(recording_dir, output_path, block, shifts, backend, batch_size):
+    """
+    Write the registered core frames of one block to the output frame store
+    :return: (sum, max) images of the registered core frames
+    """
+    _, apply_shifts = backends[backend]
+    _, _, core_start, core_stop = block
+    frame_store = FrameStore(recording_dir)
+    output = np.memmap(output_path, mode='r+', dtype=frame_store.dtype, shape=frame_store.shape)
+
+    dtype_info = np.iinfo(frame_store.dtype)
+    sum_image = np.zeros(frame_store.shape[1:])
+    max_image = np.full(frame_store.shape[1:], -np.inf)
+    for first, batch in _iter_batches(frame_store[core_start:core_stop], batch_size):
+        registered = apply_shifts(batch, shifts[first:first + len(batch)])
+        output[core_start + first:core_start + first + len(batch)] = np.clip(
+            np.round(registered), dtype_info.min, dtype_info.max)
+        sum_image += registered.sum(axis=0)
+        max_image = np.maximum(max_image, registered.max(axis=0))
+    output.flush()
+    return sum_image, max_image
+
+
+def stitch_shifts(blocks, block_shifts):
+    """
+    Stitch the shifts of overlapping blocks: the shifts of each block are offset by the
+    median difference with its predecessor over their overlapping frames
+    :return: (nframes, 2) shifts
+    """
+    shifts = np.zeros((blocks[-1][1], 2))
+    for (start, stop, core_start, core_stop), block_shift in zip(blocks, block_shifts):
+        if core_start > start:  # overlap with the core of the previous block
+            offset = np.median(shifts[start:core_start] - block_shift[:core_start - start], axis=0)
+            block_shift = block_shift + offset
+        shifts[core_start:core_stop] = block_shift[core_start - start:]
+    return shifts
+
+
+def motion_correct_chunked(recording_dir, output_dir, params, n_processes=None, backend='caiman',
+                           batch_size=100, shifts=None, result_key=None):
+    """
+    Rigid motion correction of a recording split into overlapping frame blocks
+    (see `split_blocks`), corrected in a pool of worker processes reading from the
+    recording's frame store. Runs in two passes over the blocks: shift estimation,
+    stitching of the block shifts, then registration of the frames.
+    Peak memory per worker is bounded by `batch_size` frames.
+    :param shifts: (nframes, 2) shifts of a previous run - only register the frames
+    :param result_key: result cache key of the run, recorded in the registered movie header
+    :param params: motion correction parameters - max_shifts, niter_rig, splits_rig,
+     num_frames_split
+    :return: dict with the shifts, reference, average and max images; the registered
+     frames are written as the frame store `FrameStore(output_dir / 'motion_corrected')`
+    """
+    if backend not in backends:
+        raise NotImplementedError(f'Chunked motion correction with {backend} is not yet implemented')
+
+    frame_store = open_frame_store(recording_dir)
+    output_dir = pathlib.Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    blocks = split_blocks(len(frame_store), splits_rig=params.get('splits_rig', 14),
+                          num_frames_split=params.get('num_frames_split', 80))
+    max_shifts = tuple(params.get('max_shifts', (6, 6)))
+    niter_rig = params.get('niter_rig', 1)
+
+    # shared template: mean of the first frames
+    template = frame_store[:min(len(frame_store), 200)].mean(axis=0)
+
+    # the registered frames are written to a temporary file, published once complete
+    output_path = get_frame_store_paths(output_dir / 'motion_corrected')[0]
+    output_path = output_path.with_name(f'{output_path.name}.{os.getpid()}.tmp')
+    np.memmap(output_path, mode='w+', dtype=frame_store.dtype, shape=frame_store.shape).flush()
+
+    try:
+        # n_processes=1: run in-process, e.g. within a worker of `process.run`
+        with (ProcessPoolExecutor(max_workers=n_processes,
+                                  mp_context=multiprocessing.get_context('spawn'))
+              if n_processes != 1 else contextlib.nullcontext()) as executor:
+            map_func = executor.map if executor else map
+            if shifts is None:
+                block_shifts = list(map_func(
+                    _estimate_block_shifts, *zip(*[(recording_dir, block, template, max_shifts,
+                                                     niter_rig, backend, batch_size)
+                                                    for block in blocks])))
+                shifts = stitch_shifts(blocks, block_shifts)
+
+            summary = list(map_func(
+                _apply_block_shifts, *zip(*[(recording_dir, output_path, block,
+                                             shifts[block[2]:block[3]], backend, batch_size)
+                                            for block in blocks])))
+    except BaseException:
+        output_path.unlink(missing_ok=True)
+        raise
+
+    commit_frame_store(output_dir / 'motion_corrected', output_path,
+                       {'shape': list(frame_store.shape), 'dtype': frame_store.dtype.name,
+                        'fps': frame_store.header.get('fps'), 'source_files': [],
+                        'source': pathlib.Path(recording_dir).as_posix(),
+                        'result_key': result_key})
+    np.save(output_dir / 'shifts_rig.npy', shifts)
+
+    return {'shifts': shifts,
+            'ref_image': template,
+            'average_image': sum(s for s, _ in summary) / len(frame_store),
+            'max_proj_image': np.max([m for _, m in summary], axis=0)}
+
+
+# Pipeline ---------------------------------------------------------------------
+# `pipeline` is imported within the functions so that the worker processes above
+# do not connect to the database
+
+def get_registered_movie(key):
+    """
+    The chunked motion correction of `key` with a registered movie - the first one, by
+    primary key, if there are several
+    :return: (MotionCorrectionTask key, frame store directory of its registered movie)
+    :raise FileNotFoundError: if there is none, e.g. the motion correction was run by the
+     element - the raw, unregistered frames are never processed instead
+    """
+    from .pipeline import miniscope
+    from .paths import get_output_dir
+
+    task_keys, output_dirs = (miniscope.MotionCorrectionTask & key).fetch(
+        'KEY', 'motion_correction_output_dir', order_by='KEY')
+    for task_key, output_dir in zip(task_keys, output_dirs):
+        movie_dir = get_output_dir(pathlib.Path(output_dir) / 'motion_corrected')
+        if get_frame_store_paths(movie_dir)[1].exists():
+            return task_key, movie_dir
+
+    raise FileNotFoundError(f'No registered movie of the chunked motion correction for {key}:'
+                            f' only the motion corrections of `populate_motion_correction`'
+                            f' can be processed by the workflow\'s chunked stages')
+
+
+def get_registered_movie_dir(key):
+    """
+    Frame store directory of the registered movie of the chunked motion correction of `key`
+    (see `get_registered_movie`)
+    """
+    return get_registered_movie(key)[1]
+
+
+def _registered_result_key(output_dir):
+    """ :return: the result cache key of the registered movie in `output_dir`, None if none """
+    try:
+        return _read_header(get_frame_store_paths(output_dir / 'motion_corrected')[1]).get(
+            'result_key')
+    except FileNotFoundError:
+        return None
+
+
+def make_motion_correction(key, n_processes=None, backend=None):
+    """
+    Run a 'trigger' miniscope.MotionCorrectionTask in chunked mode and insert its results.
+    The results are looked up in the result cache, if configured, for the contents of the
+    recording files and the motion correction parameters: on a hit, the frames are only
+    registered again with the cached shifts if the output directory does not hold the
+    registered movie of this result yet.
+    """
+    from .pipeline import miniscope
+    from .paths import find_full_path, get_output_dir
+    from .result_cache import get_result_cache, get_recording_files, params_digest
+
+    recording_dir = (miniscope.Recording & key).fetch1('recording_directory')
+    output_dir, method, params = (miniscope.MotionCorrectionTask
+                                  * miniscope.MotionCorrectionParamSet & key).fetch1(
+        'motion_correction_output_dir', 'motion_correction_method', 'motion_correction_params')
+
+    output_dir = get_output_dir(output_dir)
+    cache, cache_key, cached = get_result_cache(), None, None
+    if cache is not None:
+        cache_key = cache.result_key('motion_correction', get_recording_files(key),
+                                     params_digest([backend or method, params]))
+        cached = cache.load('motion_correction', cache_key)
+
+    if (cached is not None and 'ref_image' in cached
+            and _registered_result_key(output_dir) == cache_key
+            and (output_dir / 'shifts_rig.npy').exists()):
+        print(f'---- Registered movie of {cache_key[:12]} already in {output_dir} ----')
+        results = cached
+    else:
+        results = motion_correct_chunked(find_full_path(recording_dir), output_dir, params,
+                                         n_processes=n_processes, backend=backend or method,
+                                         shifts=cached['shifts'] if cached else None,
+                                         result_key=cache_key)
+        if cache is not None and (cached is None or 'ref_image' not in cached):
+            cache.save('motion_correction', cache_key, results)
+
+    shifts = results['shifts']
+    with miniscope.MotionCorrection.connection.transaction:
+        miniscope.MotionCorrection.insert1(dict(key, motion_correct_channel=0),
+                                           ignore_extra_fields=True, allow_direct_insert=True)
+        miniscope.MotionCorrection.RigidMotionCorrection.insert1(
+            dict(key, outlier_frames=None, y_shifts=shifts[:, 0], x_shifts=shifts[:, 1],
+                 y_std=np.nanstd(shifts[:, 0]), x_std=np.nanstd(shifts[:, 1])),
+            ignore_extra_fields=True, allow_direct_insert=True)
+        miniscope.MotionCorrection.Summary.insert1(
+            dict(key, ref_image=results['ref_image'], average_image=results['average_image'],
+                 max_proj_image=results['max_proj_image']),
+            ignore_extra_fields=True, allow_direct_insert=True)
+
+
+def populate_motion_correction(*restrictions, methods=None, n_processes=None, backend=None,
+                               reserve_jobs=False, suppress_errors=False):
+    """
+    Chunked alternative to miniscope.MotionCorrection.populate() for 'trigger' tasks
+    :param methods: only run the tasks of these motion correction methods
+    :param reserve_jobs: reserve the keys in the jobs table of the `miniscope` schema
+    :return: list of (key, error message) of the failed keys if `suppress_errors`
+    """
+    import datajoint as dj
+    from .pipeline import miniscope
+    from .metrics import measure_stage
+
+    tasks = (miniscope.MotionCorrectionTask * miniscope.MotionCorrectionParamSet
+             & 'motion_correction_task_mode = "trigger"')
+    if methods:
+        tasks &= [{'motion_correction_method': method} for method in methods]
+
+    keys = ((miniscope.MotionCorrection.key_source & dj.AndList(restrictions) & tasks.proj())
+            - miniscope.MotionCorrection).fetch('KEY')
+
+    jobs, table_name = miniscope.schema.jobs, miniscope.MotionCorrection.table_name
+
+    errors = []
+    for key in keys:
+        if reserve_jobs and not jobs.reserve(table_name, key):
+            continue
+        try:
+            with measure_stage('MotionCorrection', key, miniscope.MotionCorrection):
+                make_motion_correction(key, n_processes=n_processes, backend=backend)
+        except Exception as error:
+            error_message = f'{error.__class__.__name__}: {error}'
+            if reserve_jobs:
+                jobs.error(table_name, key, error_message=error_message)
+            if not suppress_errors:
+                raise
+            errors.append((key, error_message))
+        else:
+            if reserve_jobs:
+                jobs.complete(table_name, key)
+
+    return errors
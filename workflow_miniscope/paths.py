@@ -1,8 +1,169 @@
+import os
+import pathlib
 import datajoint as dj
 
 
+# Network file systems - the roots on these are slower than the local ones
+NETWORK_FS_TYPES = {'nfs', 'nfs4', 'cifs', 'smbfs', 'smb3', 'fuse.sshfs', 'afs', 'lustre',
+                    'gpfs', 'beegfs', 'glusterfs', 'fuse.glusterfs', 'ceph', 'fuse.ceph',
+                    '9p', 'fuse.s3fs', 'fuse.rclone'}
+
+
+def get_miniscope_root_data_dirs():
+    """
+    All root data directories, fastest first: `custom/miniscope_root_data_dir` is one path
+    or a list of paths (e.g. a local SSD cache and an NFS archive holding the same relative
+    layout). Local roots come before network roots, else the configured order is kept.
+    """
+    root_data_dirs = dj.config.get('custom', {}).get('miniscope_root_data_dir', None)
+    if root_data_dirs is None:
+        return []
+    if isinstance(root_data_dirs, (str, os.PathLike)):
+        root_data_dirs = [root_data_dirs]
+
+    root_data_dirs = [pathlib.Path(root_dir) for root_dir in root_data_dirs]
+    return sorted(root_data_dirs, key=is_network_path)  # stable: keeps the configured order
+
+
 def get_miniscope_root_data_dir():
+    """ Primary root data directory - the first configured one, where new outputs are written """
     root_data_dirs = dj.config.get('custom', {}).get('miniscope_root_data_dir', None)
+    if isinstance(root_data_dirs, (list, tuple)):
+        return root_data_dirs[0] if root_data_dirs else None
 
     return root_data_dirs
 
+
+def get_miniscope_scratch_dir():
+    """
+    Node-local scratch directory of the staged recordings (see `staging`), None (the default)
+    to disable staging - read first by `find_full_path`, but not a root data directory
+    """
+    return dj.config.get('custom', {}).get('miniscope_scratch_dir', None)
+
+
+def get_scan_manifest_path():
+    """
+    SQLite scan manifest of `ingest`: `custom/miniscope_scan_manifest`, else in the primary
+    root data directory - the first configured one
+    :raise ValueError: if neither is configured
+    """
+    manifest_path = dj.config.get('custom', {}).get('miniscope_scan_manifest', None)
+    if manifest_path is None:
+        root_data_dir = get_miniscope_root_data_dir()
+        if root_data_dir is None:
+            raise ValueError('No scan manifest path: configure custom/miniscope_scan_manifest'
+                             ' or custom/miniscope_root_data_dir')
+        manifest_path = pathlib.Path(root_data_dir) / '.scan_manifest.sqlite'
+
+    return pathlib.Path(manifest_path)
+
+
+# Locality-aware path resolution -----------------------------------------------
+
+_mount_types = None
+_resolved_paths = {}
+
+
+def _read_mount_types():
+    """ {mount point: file system type} from /proc/mounts, empty if unavailable """
+    try:
+        with open('/proc/mounts') as f:
+            mounts = [line.split()[1:3] for line in f if len(line.split()) >= 3]
+    except OSError:
+        return {}
+    return {mount_point.replace('\\040', ' '): fs_type  # escaped spaces
+            for mount_point, fs_type in mounts}
+
+
+def is_network_path(path):
+    """ Whether `path` is on a network file system - from its mount point on Linux, else False """
+    global _mount_types
+    if _mount_types is None:
+        _mount_types = _read_mount_types()
+
+    path = pathlib.Path(os.path.abspath(path))
+    for directory in (path, *path.parents):
+        if directory.as_posix() in _mount_types:
+            return _mount_types[directory.as_posix()] in NETWORK_FS_TYPES
+    return False
+
+
+def _get_read_dirs():
+    # the staged copies first, then the roots
+    scratch_dir = get_miniscope_scratch_dir()
+    root_data_dirs = get_miniscope_root_data_dirs()
+    return [pathlib.Path(scratch_dir), *root_data_dirs] if scratch_dir else root_data_dirs
+
+
+def find_full_path(relative_path, root_data_dirs=None):
+    """
+    Full path of `relative_path` under the fastest root data directory holding it,
+    by default the scratch directory first if configured.
+    The lookups are cached: a relative path is searched for across the roots once,
+    until its cached full path disappears (see `clear_path_cache`) - except in the scratch
+    directory, searched first every time as copies are staged to it meanwhile.
+    :raises FileNotFoundError: if no root holds `relative_path`
+    """
+    root_data_dirs = tuple(root_data_dirs or _get_read_dirs())
+    relative_path = pathlib.Path(relative_path)
+    if relative_path.is_absolute():
+        return relative_path
+
+    cache_key = (root_data_dirs, relative_path)
+    full_path = _resolved_paths.get(cache_key)
+    if full_path is not None:
+        scratch_dir = get_miniscope_scratch_dir()
+        if scratch_dir and pathlib.Path(scratch_dir) in root_data_dirs:
+            staged_path = pathlib.Path(scratch_dir) / relative_path
+            if staged_path.exists():
+                _resolved_paths[cache_key] = staged_path
+                return staged_path
+        if full_path.exists():
+            return full_path
+
+    for root_dir in root_data_dirs:
+        full_path = pathlib.Path(root_dir) / relative_path
+        if full_path.exists():
+            _resolved_paths[cache_key] = full_path
+            return full_path
+
+    raise FileNotFoundError(f'{relative_path} not found under any of the root data'
+                            f' directories: {[str(root_dir) for root_dir in root_data_dirs]}')
+
+
+def get_output_dir(relative_path):
+    """
+    Full path of the output directory `relative_path`: under the fastest root holding it,
+    else under the primary root (see `get_miniscope_root_data_dir`)
+    """
+    try:
+        return find_full_path(relative_path)
+    except FileNotFoundError:
+        return pathlib.Path(get_miniscope_root_data_dir()) / relative_path
+
+
+def get_relative_path(full_path, root_data_dirs=None):
+    """
+    `full_path` relative to the (innermost) root data directory, or scratch directory,
+    holding it
+    :raises ValueError: if `full_path` is under none of the roots
+    """
+    full_path = pathlib.Path(full_path)
+    root_data_dirs = root_data_dirs or _get_read_dirs()
+    for root_dir in sorted(root_data_dirs, key=lambda d: len(pathlib.Path(d).parts),
+                           reverse=True):
+        try:
+            return full_path.relative_to(root_dir)
+        except ValueError:
+            continue
+
+    raise ValueError(f'{full_path} is not under any of the root data directories:'
+                     f' {[str(root_dir) for root_dir in root_data_dirs]}')
+
+
+def clear_path_cache():
+    """ Forget the cached path lookups and file system types, e.g. after adding a root copy """
+    global _mount_types
+    _mount_types = None
+    _resolved_paths.clear()
@@ -1,3 +1,5 @@
+import threading
+
 import datajoint as dj
 from element_lab import lab
 from element_animal import subject
@@ -17,14 +19,10 @@ if 'custom' not in dj.config:
 db_prefix = dj.config['custom'].get('database.prefix', '')
 
 
-# Activate `lab`, `subject`, `session` schema ----------------------------------
-
-lab.activate(db_prefix + 'lab')
-
-subject.activate(db_prefix + 'subject', linking_module=__name__)
-
-session.activate(db_prefix + 'session', linking_module=__name__)
-
+# The schemas are activated - connecting to the database - on the first use of one of the
+# tables or element modules below, e.g. `from workflow_miniscope.pipeline import miniscope`,
+# not when this module is imported (see `activate`). Until then, the tables declared here
+# are queued by the schema decorators.
 
 # Declare table `Equipment` for use in element_miniscope -----------------------
 
@@ -35,6 +33,166 @@ class Equipment(dj.Manual):
     """
 
 
-# Activate `miniscope` schema --------------------------------------------------
+# Declare tables `SummaryImagesFilter` and `SummaryImages` - summary images for QC, ----
+# previews of the seed pixels of CNMF-E parameters and optional patch skipping
+
+@miniscope.schema
+class SummaryImagesFilter(dj.Lookup):
+    definition = """
+    # High-pass filter widths of the correlation and PNR images, e.g. the gSig of a sweep
+    gsig : decimal(5, 2)  # (pixels) 0 if unfiltered
+    """
+    contents = [(0,)]
+
+
+@miniscope.schema
+class SummaryImages(dj.Computed):
+    definition = """
+    # Summary images of the motion corrected movie, computed in one streaming pass
+    -> miniscope.MotionCorrection
+    -> SummaryImagesFilter
+    ---
+    average_image     : longblob  # mean of the frames
+    max_proj_image    : longblob  # max projection of the frames
+    correlation_image : longblob  # mean correlation of each pixel with its 8 neighbours
+    pnr_image         : longblob  # peak-to-noise ratio of each pixel
+    """
+
+    def make(self, key):
+        from .framestore import FrameStore
+        from .motion_correction import get_registered_movie_dir
+        from .summary_images import compute_summary_images
+
+        # measured around `populate` (see `metrics`): a measure within `make` would be
+        # rolled back with the transaction of a failed key
+        gsig = float(key['gsig'])
+        frame_store = FrameStore(get_registered_movie_dir(key))
+        self.insert1(dict(key, **compute_summary_images(frame_store, gSig=gsig or None)))
+
+
+# Declare table `StageMetrics` - resource usage of the workflow stages (see `metrics`) --
+
+@miniscope.schema
+class StageMetrics(dj.Manual):
+    definition = """
+    # Resource usage of one call of a workflow stage (populate of a key, or ingestion)
+    stage              : varchar(32)
+    key_hash           : char(32)          # hash of the key, of {} for a whole-table call
+    start_time         : datetime(6)
+    ---
+    key=null           : longblob          # key or restriction of the call
+    hostname           : varchar(64)
+    wall_time          : float             # (s)
+    cpu_time           : float             # (s) user + system time of the process and its terminated children
+    peak_rss=null      : bigint unsigned   # (bytes) peak resident set size of the process
+    bytes_read=null    : bigint unsigned   # bytes read from storage by the process
+    rows_inserted=null : int               # entries inserted into the table and its part tables
+    error=null         : varchar(1000)     # error raised by the call, if any
+    """
+
+
+# Declare tables `TraceMatrix` and `ActivityMatrix` - optional columnar storage ---
+# of the traces of each session as one (ROIs x frames) array file, in addition to the
+# per-ROI blobs of the element. The files are kept in the external store named by
+# dj.config['custom']['miniscope_trace_store'] if configured when the tables are first
+# declared, else in the database. They are populated by `process` if the store is configured.
+
+trace_store = dj.config['custom'].get('miniscope_trace_store', None)
+trace_file_type = f'attach@{trace_store}' if trace_store else 'attach'
+
+
+@miniscope.schema
+class TraceMatrix(dj.Computed):
+    definition = """
+    # Fluorescence traces of all the masks as one chunked, compressed HDF5 array
+    -> miniscope.Fluorescence
+    ---
+    nrois      : int
+    nframes    : int
+    trace_file : {}  # (ROIs x frames) dataset 'traces'
+    """.format(trace_file_type)
+
+    class Row(dj.Part):
+        definition = """
+        # Row of each mask in the trace matrices of the session
+        -> master
+        -> miniscope.Fluorescence.Trace
+        ---
+        trace_row : int
+        """
+
+    def make(self, key):
+        from .trace_matrix import make_trace_matrix
+
+        row_keys, traces = (miniscope.Fluorescence.Trace & key).fetch(
+            'KEY', 'fluorescence', order_by='mask')
+        make_trace_matrix(self, key, traces)
+        self.Row.insert([dict(row_key, trace_row=row)
+                         for row, row_key in enumerate(row_keys)])
+
+
+@miniscope.schema
+class ActivityMatrix(dj.Computed):
+    definition = """
+    # Activity traces of all the masks, in the rows of TraceMatrix
+    -> miniscope.Activity
+    -> TraceMatrix
+    ---
+    nrois      : int
+    nframes    : int
+    trace_file : {}  # (ROIs x frames) dataset 'traces'
+    """.format(trace_file_type)
+
+    def make(self, key):
+        from .trace_matrix import make_trace_matrix
+
+        traces = (miniscope.Activity.Trace * TraceMatrix.Row & key).fetch(
+            'activity_trace', order_by='trace_row')
+        make_trace_matrix(self, key, traces)
+
+
+# Activate `lab`, `subject`, `session` and `miniscope` schemas on first use ----
+
+_lazy_names = ('lab', 'subject', 'session', 'miniscope',
+               'Source', 'Lab', 'Protocol', 'User', 'Location', 'Project', 'Subject', 'Session',
+               'Equipment', 'SummaryImagesFilter', 'SummaryImages', 'StageMetrics',
+               'TraceMatrix', 'ActivityMatrix')
+# unbound until activated, so that their first use goes through `__getattr__`
+_lazy_objects = {name: globals().pop(name) for name in _lazy_names}
+_activated = False
+_activation_lock = threading.Lock()  # e.g. the staging thread of `process.run_pipelined`
+
+__all__ = ['dj', 'db_prefix', 'trace_store', 'trace_file_type', 'get_miniscope_root_data_dir',
+           *_lazy_names]
+
+
+def activate():
+    """
+    Activate the schemas and declare the tables, once - called on the first use of one of
+    the tables or element modules of this module (see `__getattr__`)
+    """
+    global _activated
+    with _activation_lock:
+        if _activated:
+            return
+
+        # the elements look up the upstream tables in the globals of their linking module
+        globals().update(_lazy_objects)
+
+        lab.activate(db_prefix + 'lab')  # and declare `Equipment`
+
+        subject.activate(db_prefix + 'subject', linking_module=__name__)
+
+        session.activate(db_prefix + 'session', linking_module=__name__)
+
+        # and declare the tables of this module
+        miniscope.activate(db_prefix + 'miniscope',  linking_module=__name__)
+
+        _activated = True
+
 
-miniscope.activate(db_prefix + 'miniscope',  linking_module=__name__)
+def __getattr__(name):
+    if name in _lazy_objects:
+        activate()
+        return globals()[name]
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
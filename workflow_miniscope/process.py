@@ -0,0 +1,248 @@
+import os
+import time
+import signal
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import datajoint as dj
+
+# `pipeline` is imported within the functions: the spawned workers and the command line
+# only connect to the database once they process
+
+
+# Processing stages of the `miniscope` schema, in dependency order
+stages = ('RecordingInfo', 'MotionCorrection', 'Segmentation', 'MaskClassification',
+          'Fluorescence', 'Activity')
+
+# Columnar copies of the traces declared by `pipeline` (see `trace_matrix`) - populated
+# after the stages above by default only if `custom/miniscope_trace_store` is configured
+matrix_stages = ('TraceMatrix', 'ActivityMatrix')
+
+# Stages reading the raw recording files - staged to node-local scratch if configured
+raw_stages = ('RecordingInfo', 'MotionCorrection')
+
+
+def get_stages():
+    """ :return: the stages populated by default, in dependency order """
+    if dj.config.get('custom', {}).get('miniscope_trace_store'):
+        return stages + matrix_stages
+    return stages
+
+
+def get_table(stage):
+    """ :return: the table of a stage - of `miniscope`, or declared by `pipeline` """
+    from workflow_miniscope import pipeline
+
+    return getattr(pipeline if stage in matrix_stages else pipeline.miniscope, stage)
+
+
+def init_worker(config):
+    """
+    Initializer of the spawned worker processes, e.g. of a ProcessPoolExecutor with
+    `initargs=(dict(dj.config),)`: the workers open their own database connection with the
+    parent's settings. SIGINT is ignored: the parent handles Ctrl+C (e.g. `cli.worker`
+    completes its round), not each worker with a KeyboardInterrupt.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    dj.config.update(config)
+
+
+def _populate_worker(stage, populate_settings, restriction=None, n_processes=1):
+    from workflow_miniscope import pipeline
+    from workflow_miniscope.metrics import measure_stage
+
+    if stage == 'RecordingInfo':
+        # read from the file headers instead of decoding the videos - milliseconds per key
+        from workflow_miniscope.recording_info import populate_recording_info
+        return populate_recording_info(restriction or {}, reserve_jobs=True,
+                                       suppress_errors=True, **populate_settings)
+
+    table = get_table(stage)
+    restrictions = [restriction or {}]
+
+    errors = []
+    if stage == 'MotionCorrection':
+        # the CPU-only NumPy backend is run by the workflow, not by the element
+        from workflow_miniscope.motion_correction import populate_motion_correction
+        errors += populate_motion_correction(*restrictions, methods=('numpy',), n_processes=1,
+                                             reserve_jobs=True, suppress_errors=True)
+        restrictions.append((pipeline.miniscope.MotionCorrectionTask
+                             * pipeline.miniscope.MotionCorrectionParamSet
+                             & 'motion_correction_method != "numpy"').proj())
+    elif stage == 'Segmentation':
+        # the patch-parallel CNMF-E, fanning each key out over `n_processes` processes
+        from workflow_miniscope.segmentation import (populate_segmentation,
+                                                     get_element_restriction)
+        errors += populate_segmentation(*restrictions, n_processes=n_processes,
+                                        reserve_jobs=True, suppress_errors=True)
+        restrictions.append(get_element_restriction(table, *restrictions))
+    elif stage == 'Fluorescence':
+        # the sparse, streaming extraction of the patch-parallel segmentations
+        from workflow_miniscope.fluorescence import populate_fluorescence
+        from workflow_miniscope.segmentation import get_element_restriction
+        errors += populate_fluorescence(*restrictions, reserve_jobs=True, suppress_errors=True)
+        restrictions.append(get_element_restriction(table, *restrictions))
+    elif stage == 'Activity':
+        # the batched deconvolution, if registered as an ActivityExtractionMethod
+        from workflow_miniscope.deconvolution import populate_activity, extraction_method
+        errors += populate_activity(*restrictions, n_processes=1, reserve_jobs=True,
+                                    suppress_errors=True)
+        restrictions.append(f'extraction_method != "{extraction_method}"')
+
+    # the element's populate: one record per call, not per key
+    with measure_stage(stage, restriction, table):
+        errors += table.populate(*restrictions, reserve_jobs=True, suppress_errors=True,
+                                 **populate_settings) or []
+    return errors
+
+
+def _worker_errors(future, key=None):
+    """
+    :return: the (key, error message) of the failed jobs of a `_populate_worker` future - of
+     the whole call, for `key` (or {}), if the worker raised, e.g. after losing its connection
+    """
+    try:
+        return future.result()
+    except Exception as error:
+        return [(key or {}, f'{error.__class__.__name__}: {error}')]
+
+
+def run(workers=None, stages=None, populate_settings=None):
+    """
+    Populate the processing stages for all pending keys with a pool of worker processes.
+    Within a stage, the workers share the keys through DataJoint's jobs reservation;
+    a stage only starts once all workers of its upstream stage are done.
+    :param workers: number of worker processes per stage, e.g. {'Segmentation': 4}
+                    (default: one per CPU core) - the patch-parallel segmentation of each
+                    key runs on (CPU cores / workers) processes
+    :param stages: stages (tables of `miniscope`) to populate, in dependency order
+                   (default: `get_stages`)
+    :param populate_settings: extra keyword arguments to `populate`
+    :return: dictionary of the (key, error message) of the failed jobs per stage - with
+     the key {} for a worker that raised
+    """
+    stages = stages or get_stages()
+    workers = {**{stage: os.cpu_count() for stage in stages}, **(workers or {})}
+    populate_settings = {'order': 'random', **(populate_settings or {})}
+
+    errors = {}
+    with ProcessPoolExecutor(max_workers=max(workers[stage] for stage in stages),
+                             mp_context=multiprocessing.get_context('spawn'),
+                             initializer=init_worker, initargs=(dict(dj.config),)) as executor:
+        for stage in stages:
+            start_time = time.time()
+            futures = [executor.submit(_populate_worker, stage, populate_settings,
+                                       n_processes=max(os.cpu_count() // workers[stage], 1))
+                       for _ in range(workers[stage])]
+            errors[stage] = [error for future in futures for error in _worker_errors(future)]
+
+            table = get_table(stage)
+            print(f'\n---- Populated miniscope.{stage} with {workers[stage]} worker(s)'
+                  f' in {time.time() - start_time:.1f}s: {len(table())} entry(s),'
+                  f' {len(errors[stage])} error(s) ----')
+
+    return errors
+
+
+def get_backlog(stages=None):
+    """
+    :return: dictionary per stage of the number of populated keys, pending keys (in the
+             key source but not populated yet), and of reserved and failed jobs
+    """
+    from .pipeline import miniscope
+
+    stages = stages or get_stages()
+    backlog = {}
+    for stage in stages:
+        table = get_table(stage)
+        jobs = miniscope.schema.jobs & {'table_name': table.table_name}
+        backlog[stage] = {'populated': len(table()),
+                          'pending': len(table.key_source - table),
+                          'reserved': len(jobs & 'status = "reserved"'),
+                          'error': len(jobs & 'status = "error"')}
+    return backlog
+
+
+def _key_id(stage, key):
+    return stage, tuple(sorted(key.items()))
+
+
+def run_pipelined(workers=None, stages=None, populate_settings=None, poll_interval=5,
+                  prefetch=2):
+    """
+    Push every recording through the processing stages on its own: as soon as a key
+    lands in one stage, its downstream keys are queued for the next stage, without
+    waiting for the other recordings. Downstream stages are served first to drain the
+    wavefront; each key is attempted at most once per stage and run.
+    With a scratch directory configured (`custom/miniscope_scratch_dir`), the recordings
+    of the queued keys of the `raw_stages` are staged to it in the background, `prefetch`
+    recordings ahead, and only submitted once staged - the workers then read the local copies.
+    :param workers: total number of worker processes (default: one per CPU core)
+    :param stages: stages (tables of `miniscope`) to populate, in dependency order
+                   (default: `get_stages`)
+    :param populate_settings: extra keyword arguments to `populate`
+    :param poll_interval: (s) maximum time between two scheduling rounds
+    :param prefetch: number of queued recordings staged ahead
+    :return: dictionary of the (key, error message) of the failed jobs per stage
+    """
+    from .staging import get_scratch_stage, Prefetcher
+
+    stages = stages or get_stages()
+    workers = workers or os.cpu_count()
+    populate_settings = {**(populate_settings or {}), 'display_progress': False}
+    scratch_stage = get_scratch_stage()
+    prefetcher = Prefetcher(scratch_stage, depth=max(prefetch, 1)) if scratch_stage else None
+
+    in_flight, attempted = {}, set()
+    errors = {stage: [] for stage in stages}
+    queue_depths = None
+    with ProcessPoolExecutor(max_workers=workers,
+                             mp_context=multiprocessing.get_context('spawn'),
+                             initializer=init_worker, initargs=(dict(dj.config),)) as executor:
+        while True:
+            # queue the pending keys of every stage, most downstream stage first
+            depths = {}
+            for stage in reversed(stages):
+                table = get_table(stage)
+                pending = [key for key in (table.key_source - table).fetch('KEY')
+                           if _key_id(stage, key) not in attempted]
+                ready = (prefetcher.ready(pending) if prefetcher and stage in raw_stages
+                         else pending)
+                submitted = ready[:max(workers - len(in_flight), 0)]
+                for key in submitted:
+                    attempted.add(_key_id(stage, key))
+                    if prefetcher and stage in raw_stages:
+                        prefetcher.acquire(key)
+                    in_flight[executor.submit(_populate_worker, stage, populate_settings, key)] = (
+                        stage, key)
+                depths[stage] = (len(pending) - len(submitted),
+                                 sum(s == stage for s, _ in in_flight.values()))
+
+            if depths != queue_depths:
+                queue_depths = depths
+                print('---- Queue depth (pending/running): ' + ', '.join(
+                    f'{stage}: {depths[stage][0]}/{depths[stage][1]}' for stage in stages) + ' ----')
+
+            staging = prefetcher.pending() if prefetcher else []
+            if not in_flight and not staging:
+                break
+
+            done, _ = wait([*in_flight, *staging], timeout=poll_interval,
+                           return_when=FIRST_COMPLETED)
+            for future in done:
+                if future in in_flight:
+                    stage, key = in_flight.pop(future)
+                    errors[stage].extend(_worker_errors(future, key))
+                    if prefetcher and stage in raw_stages:
+                        prefetcher.release(key)
+
+    if prefetcher:
+        prefetcher.close()
+
+    print(f'\n---- Completed pipelined processing: '
+          f'{sum(len(e) for e in errors.values())} error(s) ----')
+    return errors
+
+
+if __name__ == '__main__':
+    run()
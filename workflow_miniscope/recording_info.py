@@ -0,0 +1,170 @@
+import csv
+import json
+import pathlib
+
+import datajoint as dj
+import numpy as np
+
+from .paths import find_full_path, get_relative_path
+from .avi import sorted_avi_files, read_avi_header
+from .metrics import measure_stage
+
+
+def read_daq_v4_metadata(recording_dir):
+    """
+    Read the Miniscope-DAQ-V4 `metaData.json` and `timeStamps.csv` of a recording
+    :return: dict with nframes, px_height, px_width, fps, gain, led_power and time_stamps
+    """
+    recording_dir = pathlib.Path(recording_dir)
+
+    with open(recording_dir / 'metaData.json') as f:
+        metadata = json.load(f)
+
+    with open(recording_dir / 'timeStamps.csv', newline='') as f:
+        reader = csv.reader(f, delimiter=',')
+        next(reader)  # header
+        time_stamps = np.array([list(map(float, row)) for row in reader if row])
+
+    return {'nframes': len(time_stamps),
+            'px_height': int(metadata['ROI']['height']),
+            'px_width': int(metadata['ROI']['width']),
+            'fps': float(str(metadata['frameRate']).replace('FPS', '')),
+            'gain': metadata.get('gain'),
+            'led_power': metadata.get('led0'),
+            'time_stamps': time_stamps}
+
+
+def decode_recording_info(avi_files):
+    """
+    Count the frames of a recording by decoding every frame - slow fallback of `get_recording_info`
+    :return: dict with nframes, px_height and px_width
+    """
+    import cv2
+
+    nframes, dimensions = 0, set()
+    for avi_file in avi_files:
+        video = cv2.VideoCapture(pathlib.Path(avi_file).as_posix())
+        dimensions.add((int(video.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+                        int(video.get(cv2.CAP_PROP_FRAME_WIDTH))))
+        while video.grab():
+            nframes += 1
+        video.release()
+
+    if len(dimensions) != 1:
+        raise ValueError(f'Inconsistent frame dimensions across the AVI files: {sorted(dimensions)}')
+
+    px_height, px_width = dimensions.pop()
+    return {'nframes': nframes, 'px_height': px_height, 'px_width': px_width}
+
+
+def get_recording_info(recording_dir, decode_fallback=True):
+    """
+    Recording information of a Miniscope-DAQ-V4 recording from the AVI headers/index and the
+    DAQ metadata files, only decoding the frames if these are inconsistent with each other
+    """
+    avi_files = sorted_avi_files(recording_dir)
+    if not avi_files:
+        raise FileNotFoundError(f'No .avi files found in {recording_dir}')
+
+    recording_info = read_daq_v4_metadata(recording_dir)
+    avi_headers = [read_avi_header(fp) for fp in avi_files]
+
+    is_consistent = (
+        sum(h['nframes'] for h in avi_headers) == recording_info['nframes']
+        and all((h['px_height'], h['px_width']) == (recording_info['px_height'],
+                                                    recording_info['px_width'])
+                for h in avi_headers))
+
+    if not is_consistent:
+        if not decode_fallback:
+            raise ValueError(f'AVI headers inconsistent with the DAQ metadata in {recording_dir}')
+        recording_info.update(decode_recording_info(avi_files))
+
+    recording_info['avi_files'] = avi_files
+    return recording_info
+
+
+def make_recording_info(key, decode_fallback=True):
+    """
+    Insert the miniscope.RecordingInfo entry of a recording `key` via `get_recording_info`
+    """
+    from .pipeline import miniscope
+
+    recording_dir = find_full_path((miniscope.Recording & key).fetch1('recording_directory'))
+
+    recording_info = get_recording_info(recording_dir, decode_fallback=decode_fallback)
+
+    with miniscope.RecordingInfo.connection.transaction:
+        miniscope.RecordingInfo.insert1(
+            dict(key,
+                 nchannels=1,  # Assumes a single channel
+                 nframes=recording_info['nframes'],
+                 px_height=recording_info['px_height'],
+                 px_width=recording_info['px_width'],
+                 fps=recording_info['fps'],
+                 gain=recording_info['gain'],
+                 spatial_downsample=1,  # Assumes no spatial downsampling
+                 led_power=recording_info['led_power'],
+                 time_stamps=recording_info['time_stamps'],
+                 recording_duration=recording_info['nframes'] / recording_info['fps']),
+            ignore_extra_fields=True, allow_direct_insert=True)
+        miniscope.RecordingInfo.File.insert(
+            [dict(key, file_id=i, file_path=get_relative_path(fp).as_posix())
+             for i, fp in enumerate(recording_info['avi_files'])],
+            allow_direct_insert=True)
+
+
+def populate_recording_info(*restrictions, decode_fallback=True, reserve_jobs=False,
+                            suppress_errors=False, order='original', limit=None,
+                            max_calls=None, display_progress=False):
+    """
+    Fast alternative to miniscope.RecordingInfo.populate() reading the recording
+    information from the file headers instead of decoding the videos
+    :param reserve_jobs: reserve the keys in the jobs table of the `miniscope` schema
+    :param order, limit, max_calls: as for populate() - 'original', 'reverse' or 'random'
+                                    key order, at most `limit` keys and `max_calls` calls
+    :param display_progress: accepted for compatibility with populate(), unused
+    :return: list of (key, error message) of the failed keys if `suppress_errors`
+    """
+    import random
+    from .pipeline import miniscope
+
+    if order not in ('original', 'reverse', 'random'):
+        raise dj.DataJointError(f'The order argument must be one of original, reverse or random,'
+                                f' not {order}')
+
+    keys = ((miniscope.RecordingInfo.key_source & dj.AndList(restrictions))
+            - miniscope.RecordingInfo).fetch('KEY', limit=limit)
+    if order == 'reverse':
+        keys.reverse()
+    elif order == 'random':
+        random.shuffle(keys)
+
+    jobs, table_name = miniscope.schema.jobs, miniscope.RecordingInfo.table_name
+
+    errors, calls = [], 0
+    for key in keys:
+        if max_calls is not None and calls >= max_calls:
+            break
+        if reserve_jobs and not jobs.reserve(table_name, key):
+            continue
+        calls += 1
+        try:
+            with measure_stage('RecordingInfo', key, miniscope.RecordingInfo):
+                make_recording_info(key, decode_fallback=decode_fallback)
+        except dj.errors.DuplicateError:
+            # populated concurrently by a worker not reserving jobs
+            if reserve_jobs:
+                jobs.complete(table_name, key)
+        except Exception as error:
+            error_message = f'{error.__class__.__name__}: {error}'
+            if reserve_jobs:
+                jobs.error(table_name, key, error_message=error_message)
+            if not suppress_errors:
+                raise
+            errors.append((key, error_message))
+        else:
+            if reserve_jobs:
+                jobs.complete(table_name, key)
+
+    return errors
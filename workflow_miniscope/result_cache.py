@@ -0,0 +1,157 @@
+import os
+import json
+import pickle
+import hashlib
+import pathlib
+
+import datajoint as dj
+import numpy as np
+
+
+def get_result_cache_dir():
+    """ Shared directory of the result cache, None (the default) to disable the cache """
+    return dj.config.get('custom', {}).get('miniscope_result_cache_dir', None)
+
+
+# Content hashes ---------------------------------------------------------------
+
+def _json_default(value):
+    # arrays by their full contents - str() elides the middle of large arrays
+    if isinstance(value, np.ndarray):
+        return {'ndarray': array_digest(value)}
+    if isinstance(value, np.generic):
+        return value.item()
+    return str(value)
+
+
+def params_digest(params):
+    """ Hash of a parameter set - independent of the order of its keys """
+    return hashlib.sha256(json.dumps(params, sort_keys=True,
+                                     default=_json_default).encode()).hexdigest()
+
+
+def array_digest(*arrays):
+    """ Hash of the contents (dtype, shape and data) of arrays """
+    digest = hashlib.sha256()
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        digest.update(f'{array.dtype.str}{array.shape}'.encode())
+        digest.update(array.data)
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    Content-addressed cache of stage results in a (shared) directory:
+        <cache_dir>/<stage>/<key[:2]>/<key>.pkl
+    with `key` the hash of the stage inputs (see `result_key`). Results are written to a
+    temporary file then renamed, so concurrent writers on different nodes never expose a
+    partial result.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = pathlib.Path(cache_dir)
+
+    def file_digest(self, filepath, block_size=2 ** 24):
+        """
+        sha256 of the contents of a file, memoized in the cache directory for the file's
+        (path, size, modification time) - each file is only read once
+        """
+        filepath = pathlib.Path(filepath).resolve()
+        stat = filepath.stat()
+        memo_path = (self.cache_dir / 'files'
+                     / f'{hashlib.sha256(filepath.as_posix().encode()).hexdigest()}.json')
+        identity = {'file_size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+        if memo_path.exists():
+            with open(memo_path) as f:
+                memo = json.load(f)
+            if {k: memo.get(k) for k in identity} == identity:
+                return memo['digest']
+
+        digest = hashlib.sha256()
+        with open(filepath, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                digest.update(block)
+
+        self._write_atomic(memo_path, json.dumps(dict(identity, digest=digest.hexdigest())).encode())
+        return digest.hexdigest()
+
+    def result_key(self, stage, input_files=(), *digests):
+        """ Hash of a stage, the contents of its input files and other input digests """
+        key = hashlib.sha256(stage.encode())
+        for file_digest in sorted(self.file_digest(fp) for fp in input_files):
+            key.update(file_digest.encode())
+        for digest in digests:
+            key.update(str(digest).encode())
+        return key.hexdigest()
+
+    def path(self, stage, key):
+        return self.cache_dir / stage / key[:2] / f'{key}.pkl'
+
+    def load(self, stage, key):
+        """ :return: the cached result, None if missing """
+        try:
+            with open(self.path(stage, key), 'rb') as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            return None
+
+    def save(self, stage, key, result):
+        self._write_atomic(self.path(stage, key), pickle.dumps(result))
+
+    @staticmethod
+    def _write_atomic(filepath, data):
+        filepath.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = filepath.with_name(f'{filepath.name}.{os.getpid()}.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, filepath)
+
+
+def get_result_cache():
+    """ :return: ResultCache of `get_result_cache_dir`, None if not configured """
+    cache_dir = get_result_cache_dir()
+    return ResultCache(cache_dir) if cache_dir else None
+
+
+def cached_result(stage, compute, input_files=(), digests=()):
+    """
+    Result of `compute()` for a stage, loaded from the result cache if an identical
+    computation (same stage, input file contents and input digests) was cached, else
+    computed and cached. Without a configured cache, `compute()` is simply called.
+    """
+    cache = get_result_cache()
+    if cache is None:
+        return compute()
+
+    key = cache.result_key(stage, input_files, *digests)
+    result = cache.load(stage, key)
+    if result is not None:
+        print(f'---- Loaded {stage} result {key[:12]} from the result cache ----')
+        return result
+
+    result = compute()
+    cache.save(stage, key, result)
+    return result
+
+
+# Pipeline ---------------------------------------------------------------------
+
+def get_recording_files(key):
+    """ The AVI files of the recording of `key` """
+    from .pipeline import miniscope
+    from .paths import find_full_path
+
+    return [find_full_path(fp) for fp in (miniscope.RecordingInfo.File & key).fetch(
+        'file_path', order_by='file_id')]
+
+
+def get_motion_correction_digest(key):
+    """ Hash of the motion correction method and parameters of the tasks of `key` """
+    from .pipeline import miniscope
+
+    return params_digest(sorted(
+        (params_digest([method, params]) for method, params in
+         (miniscope.MotionCorrectionTask * miniscope.MotionCorrectionParamSet & key).fetch(
+             'motion_correction_method', 'motion_correction_params'))))
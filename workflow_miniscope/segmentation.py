@@ -0,0 +1,372 @@
+import pathlib
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import datajoint as dj
+import numpy as np
+from scipy import sparse
+
+from .framestore import FrameStore
+from .summary_images import seed_pixels, summary_gsig
+
+
+def split_patches(dims, rf=64, stride=16):
+    """
+    Tile a field of view into square patches of 2 x `rf` pixels overlapping by `stride`
+    pixels (CaImAn's `rf` and `stride` conventions)
+    :return: list of ((y0, y1, x0, x1), (core_y0, core_y1, core_x0, core_x1)) - each pixel
+     belongs to the core of exactly one patch, split half-way across the overlaps
+    """
+    def split_axis(size):
+        patch_size = min(2 * rf, size)
+        starts = list(range(0, max(size - patch_size, 0) + 1, max(patch_size - stride, 1)))
+        if starts[-1] + patch_size < size:
+            starts.append(size - patch_size)
+        bounds = [(start, start + patch_size) for start in starts]
+        cores = [(0 if i == 0 else (bounds[i - 1][1] + start) // 2,
+                  size if i == len(bounds) - 1 else (stop + bounds[i + 1][0]) // 2)
+                 for i, (start, stop) in enumerate(bounds)]
+        return list(zip(bounds, cores))
+
+    return [((y0, y1, x0, x1), (cy0, cy1, cx0, cx1))
+            for (y0, y1), (cy0, cy1) in split_axis(dims[0])
+            for (x0, x1), (cx0, cx1) in split_axis(dims[1])]
+
+
+# parameters of the workflow's patch-parallel segmentation, not passed to CaImAn:
+# `patch_parallel: True` selects it for the ProcessingParamSet (see `get_patch_tasks`)
+workflow_params = ('patch_parallel',)
+
+
+def _cnmfe_fit(images, params):
+    """
+    Run CaImAn CNMF-E on an in-memory (nframes, height, width) movie
+    :return: (spatial footprints (height * width, ncomponents) in C order, traces, spikes)
+    """
+    from caiman.source_extraction.cnmf import cnmf
+    from caiman.source_extraction.cnmf.params import CNMFParams
+
+    params = {**{k: v for k, v in params.items() if k not in workflow_params},
+              'dims': images.shape[1:], 'rf': None, 'stride': None,
+              'n_processes': 1, 'only_init': True}
+    cnm = cnmf.CNMF(n_processes=1, params=CNMFParams(params_dict=params), dview=None)
+    cnm.fit(images)
+
+    height, width = images.shape[1:]
+    spatial = cnm.estimates.A.toarray().reshape((height, width, -1), order='F')
+    traces = np.asarray(cnm.estimates.C)
+    # no deconvolution, e.g. with p=0
+    spikes = (np.zeros_like(traces) if cnm.estimates.S is None
+              else np.asarray(cnm.estimates.S))
+    return spatial.reshape((height * width, -1)), traces, spikes
+
+
+def extract_patches(movie_dir, patches, patch_dir, block_size=1000):
+    """
+    Copy the patches of the movie to their own memory-mapped files, in the dtype of the
+    frame store (e.g. uint8), in a single pass over the movie reading `block_size` frames
+    at a time - each patch is then read contiguously instead of striding over the whole movie
+    :return: list of (patch file path, patch movie shape, dtype)
+    """
+    frame_store = FrameStore(movie_dir)
+    dtype = frame_store.dtype
+    patch_files = [(pathlib.Path(patch_dir) / f'patch{i}.dat', (len(frame_store), y1 - y0, x1 - x0),
+                    dtype.name)
+                   for i, ((y0, y1, x0, x1), _) in enumerate(patches)]
+    patch_movies = [np.memmap(filepath, mode='w+', dtype=dtype, shape=shape)
+                    for filepath, shape, _ in patch_files]
+
+    for first, block in frame_store.iter_blocks(block_size):
+        block = np.asarray(block)
+        for patch_movie, ((y0, y1, x0, x1), _) in zip(patch_movies, patches):
+            patch_movie[first:first + len(block)] = block[:, y0:y1, x0:x1]
+
+    for patch_movie in patch_movies:
+        patch_movie.flush()
+    return patch_files
+
+
+def read_patch(patch_file, block_size=1000):
+    """
+    Read a patch movie of `extract_patches` as float32, converted `block_size` frames at a time
+    :return: (nframes, height, width) float32 array
+    """
+    filepath, shape, dtype = patch_file
+    patch_movie = np.memmap(filepath, mode='r', dtype=dtype, shape=shape)
+    images = np.empty(shape, dtype=np.float32)
+    for first in range(0, shape[0], block_size):
+        images[first:first + block_size] = patch_movie[first:first + block_size]
+    return images
+
+
+def _fit_patch(patch_file, patch, params):
+    """
+    Fit one patch of the movie, read from its patch file (see `extract_patches`),
+    and keep the components centred in the patch core
+    :return: list of components - dict with ypix, xpix, weights (global pixel
+     coordinates), trace and spikes
+    """
+    (y0, y1, x0, x1), (cy0, cy1, cx0, cx1) = patch
+
+    spatial, traces, spikes = _cnmfe_fit(read_patch(patch_file), params)
+
+    components = []
+    for k in range(spatial.shape[1]):
+        pixels = np.flatnonzero(spatial[:, k])
+        if not len(pixels):
+            continue
+        weights = spatial[pixels, k]
+        ypix, xpix = np.unravel_index(pixels, (y1 - y0, x1 - x0))
+        center_y = y0 + np.average(ypix, weights=weights)
+        center_x = x0 + np.average(xpix, weights=weights)
+        if cy0 <= center_y < cy1 and cx0 <= center_x < cx1:
+            components.append({'ypix': ypix + y0, 'xpix': xpix + x0, 'weights': weights,
+                               'trace': traces[k], 'spikes': spikes[k]})
+    return components
+
+
+def merge_components(components, dims, merge_thr=0.8):
+    """
+    Merge the components that share pixels and whose traces correlate above `merge_thr`
+    - e.g. one cell detected in two overlapping patches
+    """
+    if len(components) < 2:
+        return components
+
+    footprints = sparse.csc_matrix(
+        (np.concatenate([c['weights'] for c in components]),
+         (np.concatenate([np.ravel_multi_index((c['ypix'], c['xpix']), dims) for c in components]),
+          np.concatenate([np.full(len(c['weights']), k) for k, c in enumerate(components)]))),
+        shape=(dims[0] * dims[1], len(components)))
+    overlaps = sparse.triu((footprints.T @ footprints) > 0, k=1).tocoo()
+
+    traces = np.stack([c['trace'] for c in components])
+    traces = traces - traces.mean(axis=1, keepdims=True)
+    traces /= np.linalg.norm(traces, axis=1, keepdims=True) + np.finfo(float).eps
+
+    # union-find over the overlapping pairs of correlated components
+    parents = list(range(len(components)))
+
+    def find(k):
+        while parents[k] != k:
+            parents[k] = parents[parents[k]]
+            k = parents[k]
+        return k
+
+    for i, j in zip(overlaps.row, overlaps.col):
+        if traces[i] @ traces[j] > merge_thr:
+            parents[find(j)] = find(i)
+
+    groups = {}
+    for k in range(len(components)):
+        groups.setdefault(find(k), []).append(k)
+
+    merged = []
+    for group in groups.values():
+        if len(group) == 1:
+            merged.append(components[group[0]])
+            continue
+        footprint = footprints[:, group]
+        weights = np.asarray(footprint.max(axis=1).todense()).ravel()
+        pixels = np.flatnonzero(weights)
+        ypix, xpix = np.unravel_index(pixels, dims)
+        norms = np.asarray(footprint.sum(axis=0)).ravel()
+        merged.append({'ypix': ypix, 'xpix': xpix, 'weights': weights[pixels],
+                       'trace': np.average([components[k]['trace'] for k in group],
+                                           axis=0, weights=norms),
+                       'spikes': np.average([components[k]['spikes'] for k in group],
+                                            axis=0, weights=norms)})
+    return merged
+
+
+def segment_patches(movie_dir, params, n_processes=None, rf=None, stride=None,
+                    summary_images=None):
+    """
+    Patch-parallel CNMF-E: tile the field of view of the movie frame store into overlapping
+    patches (see `split_patches`), copied to their own files in one pass over the movie
+    (see `extract_patches`) beside the movie frame store, fit each patch with CNMF-E in a
+    pool of worker processes, then merge the components across patches
+    :param rf, stride: patch half-size and overlap (pixels) - default to `params`, else 64/16
+    :param summary_images: dict with the correlation_image and pnr_image of the movie
+     filtered with the `gSig` of `params` - the patches without any pixel above `min_corr`
+     and `min_pnr` in these images are skipped. CNMF-E still computes its own images of
+     each fitted patch, and the summary images only approximate them (see
+     `compute_summary_images`): a skipped patch may have seeded a faint component.
+    :return: list of components - dict with ypix, xpix, weights, trace and spikes
+    """
+    frame_store = FrameStore(movie_dir)
+    dims = frame_store.shape[1:]
+    patches = split_patches(dims, rf=rf or params.get('rf') or 64,
+                            stride=stride or params.get('stride') or 16)
+
+    if summary_images is not None and 'min_corr' in params and 'min_pnr' in params:
+        seeds = np.zeros(dims, dtype=bool)
+        seeds[seed_pixels(summary_images['correlation_image'], summary_images['pnr_image'],
+                          params['min_corr'], params['min_pnr'])] = True
+        patch_count = len(patches)
+        patches = [patch for patch in patches
+                   if seeds[patch[0][0]:patch[0][1], patch[0][2]:patch[0][3]].any()]
+        print(f'---- {patch_count - len(patches)} patch(es) without seed pixels skipped ----')
+
+    if not patches:
+        return []
+
+    with tempfile.TemporaryDirectory(prefix='patches_',
+                                     dir=pathlib.Path(movie_dir).parent) as patch_dir:
+        patch_files = extract_patches(movie_dir, patches, patch_dir)
+        with ProcessPoolExecutor(max_workers=n_processes,
+                                 mp_context=multiprocessing.get_context('spawn')) as executor:
+            patch_components = list(executor.map(
+                _fit_patch, patch_files, patches, [params] * len(patches)))
+
+    components = [c for patch in patch_components for c in patch]
+    print(f'---- {len(components)} component(s) found in {len(patches)} patch(es) ----')
+    return merge_components(components, dims, merge_thr=params.get('merge_thr', 0.8))
+
+
+# Pipeline ---------------------------------------------------------------------
+# `pipeline` is imported within the functions so that the worker processes above
+# do not connect to the database
+
+def make_segmentation(key, n_processes=None, skip_patches=None):
+    """
+    Segment the motion corrected movie of a ProcessingTask with `segment_patches`,
+    insert the masks and save the component traces in the processing output directory.
+    The components are looked up in the result cache, if configured, for the contents of
+    the recording files, the motion correction and processing parameters, the movie read
+    and whether patches were skipped.
+    :param skip_patches: skip the patches without seed pixels in the SummaryImages of the
+     movie filtered with the `gSig` of the parameters, if populated - approximate, see
+     `segment_patches` (default: `custom/miniscope_skip_empty_patches`, else False)
+    """
+    from .pipeline import miniscope, SummaryImages
+    from .paths import get_output_dir
+    from .motion_correction import get_registered_movie, get_registered_movie_dir
+    from .result_cache import (cached_result, get_recording_files, get_motion_correction_digest,
+                               params_digest)
+
+    params, output_dir = (miniscope.ProcessingTask * miniscope.ProcessingParamSet & key).fetch1(
+        'params', 'processing_output_dir')
+
+    if skip_patches is None:
+        skip_patches = dj.config['custom'].get('miniscope_skip_empty_patches', False)
+    summary_images = None
+    if skip_patches:
+        # the images of the motion correction segmented
+        task_key, _ = get_registered_movie(key)
+        summary_images = next(iter((SummaryImages & task_key
+                                    & {'gsig': summary_gsig(params)}).fetch(
+            'correlation_image', 'pnr_image', as_dict=True)), None)
+
+    components = cached_result(
+        'segmentation',
+        lambda: segment_patches(get_registered_movie_dir(key), params, n_processes=n_processes,
+                                summary_images=summary_images),
+        input_files=get_recording_files(key),
+        digests=(get_motion_correction_digest(key), params_digest(params),
+                 params_digest({'movie': 'registered',
+                                'skipped_patches_gsig': None if summary_images is None
+                                else summary_gsig(params)})))
+
+    output_dir = get_output_dir(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    np.savez(output_dir / 'patch_cnmfe.npz',
+             traces=np.array([c['trace'] for c in components]),
+             spikes=np.array([c['spikes'] for c in components]))
+
+    with miniscope.Segmentation.connection.transaction:
+        miniscope.Segmentation.insert1(key, allow_direct_insert=True)
+        miniscope.Segmentation.Mask.insert(
+            [dict(key, mask=mask_id, segmentation_channel=0,
+                  mask_npix=len(c['weights']),
+                  mask_center_x=int(round(np.average(c['xpix'], weights=c['weights']))),
+                  mask_center_y=int(round(np.average(c['ypix'], weights=c['weights']))),
+                  mask_xpix=c['xpix'], mask_ypix=c['ypix'], mask_weights=c['weights'])
+             for mask_id, c in enumerate(components)],
+            ignore_extra_fields=True, allow_direct_insert=True)
+
+
+def get_patch_tasks():
+    """
+    :return: the 'trigger' ProcessingTasks of the patch-parallel ProcessingParamSets - with
+     `patch_parallel: True` in their params
+    """
+    from .pipeline import miniscope
+
+    paramset_keys, params = miniscope.ProcessingParamSet.fetch('KEY', 'params')
+    patch_paramsets = [paramset_key for paramset_key, p in zip(paramset_keys, params)
+                       if p.get('patch_parallel')]
+    return (miniscope.ProcessingTask & 'task_mode = "trigger"' & patch_paramsets).proj()
+
+
+def get_patch_keys(table, *restrictions):
+    """
+    :param table: miniscope.Segmentation, or a downstream table of the workflow's stages,
+     e.g. miniscope.Fluorescence
+    :return: (keys processed by the workflow, keys left to the element) - the pending keys of
+     `table` of the `get_patch_tasks` with, and without, the registered movie of a chunked
+     motion correction (see `motion_correction.get_registered_movie`)
+    """
+    from .motion_correction import get_registered_movie
+
+    keys = ((table.key_source & dj.AndList(restrictions) & get_patch_tasks())
+            - table).fetch('KEY')
+
+    patch_keys, element_keys = [], []
+    for key in keys:
+        try:
+            get_registered_movie(key)
+        except FileNotFoundError:
+            element_keys.append(key)
+        else:
+            patch_keys.append(key)
+    return patch_keys, element_keys
+
+
+def get_element_restriction(table, *restrictions):
+    """
+    :return: restriction of `table` to the keys left to the element - of the other tasks than
+     the `get_patch_tasks`, or without a chunked motion correction (see `get_patch_keys`)
+    """
+    from .pipeline import miniscope
+
+    _, element_keys = get_patch_keys(table, *restrictions)
+    return [(miniscope.ProcessingTask - get_patch_tasks()).proj(), *element_keys]
+
+
+def populate_segmentation(*restrictions, n_processes=None, reserve_jobs=False,
+                          suppress_errors=False):
+    """
+    Patch-parallel alternative to miniscope.Segmentation.populate() for the 'trigger' tasks of
+    the patch-parallel paramsets, motion corrected by `populate_motion_correction` - the other
+    keys (see `get_patch_keys`) are left to the element
+    :param n_processes: worker processes fitting the patches of each key
+    :param reserve_jobs: reserve the keys in the jobs table of the `miniscope` schema
+    :return: list of (key, error message) of the failed keys if `suppress_errors`
+    """
+    from .pipeline import miniscope
+    from .metrics import measure_stage
+
+    keys, _ = get_patch_keys(miniscope.Segmentation, *restrictions)
+    jobs, table_name = miniscope.schema.jobs, miniscope.Segmentation.table_name
+
+    errors = []
+    for key in keys:
+        if reserve_jobs and not jobs.reserve(table_name, key):
+            continue
+        try:
+            with measure_stage('Segmentation', key, miniscope.Segmentation):
+                make_segmentation(key, n_processes=n_processes)
+        except Exception as error:
+            error_message = f'{error.__class__.__name__}: {error}'
+            if reserve_jobs:
+                jobs.error(table_name, key, error_message=error_message)
+            if not suppress_errors:
+                raise
+            errors.append((key, error_message))
+        else:
+            if reserve_jobs:
+                jobs.complete(table_name, key)
+
+    return errors
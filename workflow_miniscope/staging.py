@@ -0,0 +1,221 @@
+import os
+import uuid
+import fcntl
+import shutil
+import hashlib
+import pathlib
+from concurrent.futures import ThreadPoolExecutor
+
+import datajoint as dj
+
+from .paths import (get_miniscope_scratch_dir, get_miniscope_root_data_dirs, find_full_path,
+                    clear_path_cache)
+from .framestore import get_frame_store_paths
+
+
+STAGED_MARKER = '.staged'  # last use time of a staged recording directory
+PINS_DIR = '.pins'  # lock files of the recording directories, see `ScratchStage.pin`
+
+
+def _link_or_copy(source, destination):
+    # a hard link is free on the same file system, else copy
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+
+def _tree_size(path):
+    if path.is_file():
+        return path.stat().st_size
+    return sum(os.path.getsize(os.path.join(directory, f))
+               for directory, _, filenames in os.walk(path) for f in filenames)
+
+
+class ScratchStage:
+    """
+    Node-local copies of recording directories (their files, not their sub-directories)
+    under `scratch_dir`, with the relative layout of the root data directories so that
+    `paths.find_full_path` reads them first:
+        <scratch_dir>/<recording_directory>/{ms*.avi, metaData.json, timeStamps.csv}
+    A recording is copied to a temporary directory then renamed, so a staged directory
+    is always complete. The least recently used recordings (and their frame stores) are
+    evicted to keep the scratch directory within `max_bytes`, except the pinned ones (see
+    `pin`) - by any process sharing the scratch directory.
+    """
+
+    def __init__(self, scratch_dir, max_bytes):
+        self.scratch_dir = pathlib.Path(scratch_dir)
+        self.max_bytes = max_bytes
+
+    def path(self, recording_dir):
+        return self.scratch_dir / recording_dir
+
+    def _lock_path(self, recording_dir):
+        name = hashlib.sha1(pathlib.Path(recording_dir).as_posix().encode()).hexdigest()
+        return self.scratch_dir / PINS_DIR / f'{name}.lock'
+
+    def _open_lock(self, recording_dir):
+        lock_path = self._lock_path(recording_dir)
+        lock_path.parent.mkdir(parents=True, exist_ok=True)
+        return open(lock_path, 'a')
+
+    def pin(self, recording_dir):
+        """
+        Keep the recording directory `recording_dir` from being evicted until the returned pin
+        is released with `unpin`: a shared (POSIX) lock on its lock file in the scratch
+        directory - released by the system if the process exits first
+        :return: pin - the open lock file
+        """
+        pin = self._open_lock(recording_dir)
+        fcntl.flock(pin, fcntl.LOCK_SH)
+        return pin
+
+    @staticmethod
+    def unpin(pin):
+        pin.close()
+
+    def is_staged(self, recording_dir):
+        return (self.path(recording_dir) / STAGED_MARKER).exists()
+
+    def stage(self, recording_dir):
+        """
+        Stage the recording directory `recording_dir` (relative to the root data directories)
+        :return: path of the staged directory
+        """
+        staged_dir = self.path(recording_dir)
+        if self.is_staged(recording_dir):
+            (staged_dir / STAGED_MARKER).touch()
+            return staged_dir
+
+        source_dir = find_full_path(recording_dir, get_miniscope_root_data_dirs())
+        with os.scandir(source_dir) as it:
+            files = [entry for entry in it if entry.is_file()]
+        self.evict(sum(entry.stat().st_size for entry in files))
+
+        tmp_dir = self.scratch_dir / '.staging' / uuid.uuid4().hex
+        tmp_dir.mkdir(parents=True)
+        try:
+            for entry in files:
+                _link_or_copy(entry.path, tmp_dir / entry.name)
+            (tmp_dir / STAGED_MARKER).touch()
+            staged_dir.parent.mkdir(parents=True, exist_ok=True)
+            os.rename(tmp_dir, staged_dir)
+        except OSError:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            if not self.is_staged(recording_dir):  # else staged concurrently by another node
+                raise
+
+        clear_path_cache()
+        return staged_dir
+
+    def staged(self):
+        """ :return: list of (last use time, relative recording directory, size in bytes) """
+        staged = []
+        for directory, subdirs, filenames in os.walk(self.scratch_dir):
+            subdirs[:] = [d for d in subdirs if d not in ('.staging', PINS_DIR)]
+            if STAGED_MARKER in filenames:
+                staged_dir = pathlib.Path(directory)
+                staged.append((os.path.getmtime(staged_dir / STAGED_MARKER),
+                               staged_dir.relative_to(self.scratch_dir),
+                               sum(_tree_size(p) for p in (staged_dir,
+                                                           *get_frame_store_paths(staged_dir))
+                                   if p.exists())))
+        return staged
+
+    def evict(self, nbytes=0):
+        """ Evict the least recently used recordings until `nbytes` more fit in the budget """
+        staged = sorted(self.staged())
+        total_bytes = sum(size for _, _, size in staged)
+        for _, recording_dir, size in staged:
+            if total_bytes + nbytes <= self.max_bytes:
+                break
+            with self._open_lock(recording_dir) as lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue  # pinned
+                staged_dir = self.path(recording_dir)
+                for frame_store_path in get_frame_store_paths(staged_dir):
+                    frame_store_path.unlink(missing_ok=True)
+                shutil.rmtree(staged_dir, ignore_errors=True)
+            total_bytes -= size
+        clear_path_cache()
+
+
+def get_scratch_stage():
+    """ ScratchStage of `custom/miniscope_scratch_dir` within `custom/miniscope_scratch_mb`
+    (default: 50 GB), None if no scratch directory is configured """
+    scratch_dir = get_miniscope_scratch_dir()
+    if not scratch_dir:
+        return None
+    max_mb = dj.config.get('custom', {}).get('miniscope_scratch_mb', 50 * 1024)
+    return ScratchStage(scratch_dir, max_mb * 2 ** 20)
+
+
+class Prefetcher:
+    """
+    Stage the recordings of queued keys in a background thread, up to `depth` recordings
+    ahead, while the current ones are processed. Staging errors are reported and the
+    recording is then read from its root data directory.
+    """
+
+    def __init__(self, stage, depth=2):
+        self.stage = stage
+        self.depth = depth
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._futures = {}  # recording directory: staging future
+        self._recording_dirs = {}
+        self._pins = {}  # key: pins of `acquire`
+
+    def _recording_dir(self, key):
+        from .pipeline import miniscope
+
+        key_id = tuple(sorted(key.items()))
+        if key_id not in self._recording_dirs:
+            self._recording_dirs[key_id] = pathlib.Path(
+                (miniscope.Recording & key).fetch1('recording_directory')).as_posix()
+        return self._recording_dirs[key_id]
+
+    def _stage(self, recording_dir):
+        try:
+            self.stage.stage(recording_dir)
+        except Exception as error:
+            print(f'---- Failed to stage {recording_dir} ({error.__class__.__name__}: {error}),'
+                  f' reading it from the root data directory ----')
+            return False
+        return True
+
+    def ready(self, keys):
+        """
+        Queue the staging of the first `depth` recordings of the queued `keys`
+        :return: the keys of `keys` whose recording is staged (or failed to)
+        """
+        recording_dirs = list(dict.fromkeys(self._recording_dir(key) for key in keys))
+        for recording_dir in recording_dirs[:self.depth]:
+            future = self._futures.get(recording_dir)
+            # (re-)stage unless queued, failed, or still staged
+            if future is None or (future.done() and future.result()
+                                  and not self.stage.is_staged(recording_dir)):
+                self._futures[recording_dir] = self._executor.submit(self._stage, recording_dir)
+
+        return [key for key in keys if self._futures.get(self._recording_dir(key))
+                and self._futures[self._recording_dir(key)].done()]
+
+    def acquire(self, key):
+        """ Keep the recording of `key` staged until `release` (see `ScratchStage.pin`) """
+        key_id = tuple(sorted(key.items()))
+        self._pins.setdefault(key_id, []).append(self.stage.pin(self._recording_dir(key)))
+
+    def release(self, key):
+        key_id = tuple(sorted(key.items()))
+        self.stage.unpin(self._pins[key_id].pop())
+        if not self._pins[key_id]:
+            del self._pins[key_id]
+
+    def pending(self):
+        """ :return: the staging futures not done yet """
+        return [future for future in self._futures.values() if not future.done()]
+
+    def close(self):
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,114 @@
+import numpy as np
+from scipy import ndimage
+
+
+# neighbour offsets of the local correlation (the other 4 are symmetric)
+_neighbours = ((0, 1), (1, -1), (1, 0), (1, 1))
+
+
+def _shifted_pair(frames, dy, dx):
+    """ Views of `frames` and of their (dy, dx) neighbour pixels, cropped to their overlap """
+    height, width = frames.shape[1:]
+    y0, y1 = max(-dy, 0), height - max(dy, 0)
+    x0, x1 = max(-dx, 0), width - max(dx, 0)
+    return (frames[:, y0:y1, x0:x1],
+            frames[:, y0 + dy:y1 + dy, x0 + dx:x1 + dx],
+            (slice(y0, y1), slice(x0, x1)),
+            (slice(y0 + dy, y1 + dy), slice(x0 + dx, x1 + dx)))
+
+
+def high_pass(frames, gSig):
+    """
+    Zero-mean Gaussian filtering of each frame (Gaussian of `gSig` minus a box of the
+    kernel size, replicated borders) - the filtering of CaImAn's `correlation_pnr` with
+    `center_psf`, as in its CNMF-E initialisation
+    """
+    sigma = gSig[0] if np.ndim(gSig) else gSig
+    size = int(2 * sigma) * 2 + 1
+    return (ndimage.gaussian_filter(frames, (0, sigma, sigma), mode='nearest',
+                                    truncate=(size // 2) / sigma)
+            - ndimage.uniform_filter(frames, (1, size, size), mode='nearest'))
+
+
+def summary_gsig(params):
+    """
+    :return: the `gSig` of CNMF-E parameters as the `gsig` of SummaryImagesFilter, 0 if none
+    """
+    gsig = params.get('gSig')
+    return round(float((gsig[0] if np.ndim(gsig) else gsig) or 0), 2)
+
+
+def compute_summary_images(frame_store, gSig=None, block_size=1000):
+    """
+    Mean, max, local correlation and peak-to-noise ratio (PNR) images of a movie in one
+    streaming pass over blocks of `block_size` frames, from running sums only.
+    The correlation and PNR images are computed on the movie high-pass filtered by
+    `gSig` (see `high_pass`) if given. They approximate, but are not, the images of
+    CaImAn's `correlation_pnr` that CNMF-E seeds from - a single pass cannot estimate the
+    noise from the power spectrum of each pixel, nor zero the samples below 3 noise levels
+    before the correlation:
+    - correlation: mean correlation of each pixel with its 8 neighbours
+    - PNR: (max - mean) / noise, clipped at 0, with the noise the std of the
+      frame-to-frame differences over sqrt(2)
+    :param frame_store: (nframes, height, width) array-like, e.g. a FrameStore
+    :return: dict with average_image, max_proj_image, correlation_image and pnr_image
+    """
+    nframes, height, width = frame_store.shape
+    sum_raw = np.zeros((height, width))
+    max_raw = np.full((height, width), -np.inf)
+    sum_x, sum_xx = np.zeros((height, width)), np.zeros((height, width))
+    max_x = np.full((height, width), -np.inf)
+    sum_dd = np.zeros((height, width))
+    sum_xy = [np.zeros(_shifted_pair(np.empty((1, height, width)), dy, dx)[0].shape[1:])
+              for dy, dx in _neighbours]
+
+    offset, previous = None, None
+    for first in range(0, nframes, block_size):
+        raw = np.asarray(frame_store[first:first + block_size], dtype=np.float32)
+        sum_raw += raw.sum(axis=0, dtype=np.float64)
+        max_raw = np.maximum(max_raw, raw.max(axis=0))
+
+        frames = high_pass(raw, gSig) if gSig is not None else raw
+        if offset is None:  # sums of the frames minus their first-block mean do not cancel out
+            offset = frames.mean(axis=0, dtype=np.float64).astype(np.float32)
+        frames = frames - offset
+        sum_x += frames.sum(axis=0, dtype=np.float64)
+        sum_xx += (frames.astype(np.float64) ** 2).sum(axis=0)
+        max_x = np.maximum(max_x, frames.max(axis=0))
+        for accumulator, (dy, dx) in zip(sum_xy, _neighbours):
+            x, y, _, _ = _shifted_pair(frames, dy, dx)
+            accumulator += np.einsum('tij,tij->ij', x, y, dtype=np.float64)
+
+        differences = np.diff(frames if previous is None else np.concatenate([previous, frames]),
+                              axis=0)
+        sum_dd += (differences.astype(np.float64) ** 2).sum(axis=0)
+        previous = frames[-1:]
+
+    mean = sum_x / nframes
+    std = np.sqrt(np.maximum(sum_xx / nframes - mean ** 2, 0))
+
+    correlation_sum, neighbour_count = np.zeros((height, width)), np.zeros((height, width))
+    for accumulator, (dy, dx) in zip(sum_xy, _neighbours):
+        _, _, pixels, neighbours = _shifted_pair(np.empty((1, height, width)), dy, dx)
+        covariance = accumulator / nframes - mean[pixels] * mean[neighbours]
+        correlation = covariance / (std[pixels] * std[neighbours] + np.finfo(float).eps)
+        for region in (pixels, neighbours):  # symmetric
+            correlation_sum[region] += correlation
+            neighbour_count[region] += 1
+
+    noise = np.sqrt(sum_dd / max(nframes - 1, 1) / 2)
+
+    return {'average_image': sum_raw / nframes,
+            'max_proj_image': max_raw,
+            'correlation_image': correlation_sum / neighbour_count,
+            'pnr_image': np.maximum((max_x - mean) / (noise + np.finfo(float).eps), 0)}
+
+
+def seed_pixels(correlation_image, pnr_image, min_corr, min_pnr):
+    """
+    Candidate CNMF-E seed pixels for a `min_corr`/`min_pnr` setting, from the summary images
+    - a quick preview of the effect of these parameters without a pass over the movie,
+    approximate as the images are (see `compute_summary_images`)
+    :return: (ypix, xpix)
+    """
+    return np.nonzero((correlation_image >= min_corr) & (pnr_image >= min_pnr))
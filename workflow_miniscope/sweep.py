@@ -0,0 +1,196 @@
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import datajoint as dj
+import numpy as np
+
+from .process import init_worker
+from .result_cache import params_digest
+
+# `pipeline` is imported within the functions, as in `process`
+
+
+def expand_grid(base_params, grid):
+    """
+    Parameter sets of a sweep: `base_params` updated with every combination of the
+    values in `grid`, e.g. {'min_corr': [0.7, 0.8], 'gSig': [(3, 3), (4, 4)]}
+    :return: list of (overrides, params)
+    """
+    names = sorted(grid)
+    return [(overrides, {**base_params, **overrides})
+            for overrides in (dict(zip(names, values))
+                              for values in itertools.product(*[grid[name] for name in names]))]
+
+
+def register_sweep(base_paramset, grid):
+    """
+    Register a ProcessingParamSet for each parameter set of a sweep (see `expand_grid`)
+    of the parameter set `base_paramset`, segmented by the patch-parallel CNMF-E
+    (`patch_parallel: True`); existing identical parameter sets of the same processing
+    method are reused
+    :return: dict of {paramset id: overrides}
+    :raise ValueError: if the parameters of a sweep are those of a parameter set of another
+     processing method - the parameter sets are unique across methods
+    """
+    from .pipeline import miniscope
+
+    paramset_pk = miniscope.ProcessingParamSet.primary_key[0]
+    method, description, base_params = (miniscope.ProcessingParamSet
+                                        & {paramset_pk: base_paramset}).fetch1(
+        'processing_method', 'paramset_desc', 'params')
+    base_params = {**base_params, 'patch_parallel': True}
+
+    paramset_ids, methods, params = miniscope.ProcessingParamSet.fetch(
+        paramset_pk, 'processing_method', 'params')
+    existing = {params_digest(paramset_params): (paramset_method, paramset_id)
+                for paramset_id, paramset_method, paramset_params in zip(paramset_ids, methods,
+                                                                         params)}
+    next_id = max(paramset_ids, default=0) + 1
+
+    paramsets = {}
+    for overrides, params in expand_grid(base_params, grid):
+        digest = params_digest(params)
+        if digest not in existing:
+            miniscope.ProcessingParamSet.insert_new_params(
+                method, next_id, f'{description} - sweep: ' + ', '.join(
+                    f'{name}={value}' for name, value in overrides.items()), params)
+            existing[digest], next_id = (method, next_id), next_id + 1
+        paramset_method, paramset_id = existing[digest]
+        if paramset_method != method:
+            raise ValueError(f'The parameters of the sweep {overrides} are those of the'
+                             f' parameter set {paramset_id} of the {paramset_method} method')
+        paramsets[paramset_id] = overrides
+
+    return paramsets
+
+
+def create_sweep_tasks(base_paramset, paramsets, *restrictions):
+    """
+    Copy each ProcessingTask of `base_paramset` (within `restrictions`) to the parameter
+    sets of a sweep, in 'trigger' mode with the output in a sub-directory per parameter set
+    :return: list of the keys of the sweep tasks
+    """
+    from .pipeline import miniscope
+
+    paramset_pk = miniscope.ProcessingParamSet.primary_key[0]
+    base_tasks = (miniscope.ProcessingTask & {paramset_pk: base_paramset}
+                  & dj.AndList(restrictions)).fetch(as_dict=True)
+
+    tasks = [dict(task, **{paramset_pk: paramset_id, 'task_mode': 'trigger',
+                           'processing_output_dir': f'{task["processing_output_dir"]}'
+                                                    f'/sweep_paramset_{paramset_id}'})
+             for task in base_tasks for paramset_id in paramsets]
+    miniscope.ProcessingTask.insert(tasks, skip_duplicates=True, ignore_extra_fields=True)
+    return (miniscope.ProcessingTask & [{k: task[k] for k in miniscope.ProcessingTask.primary_key}
+                                        for task in tasks]).fetch('KEY')
+
+
+def _segmentation_worker(key):
+    from workflow_miniscope.pipeline import miniscope
+    from workflow_miniscope.segmentation import make_segmentation
+    from workflow_miniscope.metrics import measure_stage
+
+    try:
+        with measure_stage('Segmentation', key, miniscope.Segmentation):
+            make_segmentation(key, n_processes=1)  # each worker runs one variant
+    except Exception as error:
+        return key, f'{error.__class__.__name__}: {error}'
+
+
+def run_sweep(base_paramset, grid, *restrictions, workers=None):
+    """
+    Parameter sweep of the segmentation: register the parameter sets of `grid` (see
+    `register_sweep`) and their tasks for the recordings of the tasks of `base_paramset`,
+    run the shared upstream steps once per recording - motion correction and the summary
+    images - then segment every (recording, parameter set) in a pool of `workers` processes
+    reading the same memory-mapped registered movies
+    :return: (summary DataFrame ranked by `summarize_sweep`, list of (key, error message))
+    :raise ValueError: if a recording is motion corrected with another method than 'numpy' -
+     the sweep segments the registered movies of `populate_motion_correction`
+    """
+    from .pipeline import miniscope, SummaryImagesFilter, SummaryImages
+    from .motion_correction import populate_motion_correction
+    from .summary_images import summary_gsig
+    from .metrics import measure_stage
+
+    paramset_pk = miniscope.ProcessingParamSet.primary_key[0]
+    base_tasks = (miniscope.ProcessingTask & {paramset_pk: base_paramset}
+                  & dj.AndList(restrictions))
+    methods = set((miniscope.MotionCorrectionTask * miniscope.MotionCorrectionParamSet
+                   & base_tasks.proj()).fetch('motion_correction_method'))
+    if methods - {'numpy'}:
+        raise ValueError(f'Sweeps only segment the recordings motion corrected with the "numpy"'
+                         f' method, not with: {", ".join(sorted(methods - {"numpy"}))}')
+
+    paramsets = register_sweep(base_paramset, grid)
+    tasks = create_sweep_tasks(base_paramset, paramsets, *restrictions)
+    recordings = (miniscope.Recording & tasks).fetch('KEY')
+    print(f'\n---- Sweep of {len(paramsets)} parameter set(s) over {len(recordings)}'
+          f' recording(s) ----')
+
+    # shared upstream steps, once per recording
+    errors = populate_motion_correction(recordings, methods=('numpy',), suppress_errors=True)
+    # the summary images filtered with each gSig of the sweep
+    gsigs = [{'gsig': summary_gsig(params)} for params in (
+        miniscope.ProcessingParamSet & [{paramset_pk: p} for p in paramsets]).fetch('params')]
+    SummaryImagesFilter.insert(gsigs, skip_duplicates=True)
+    with measure_stage('SummaryImages'):
+        errors += SummaryImages.populate(recordings, gsigs, suppress_errors=True) or []
+
+    keys = ((miniscope.Segmentation.key_source & tasks) - miniscope.Segmentation).fetch('KEY')
+    with ProcessPoolExecutor(max_workers=workers,
+                             mp_context=multiprocessing.get_context('spawn'),
+                             initializer=init_worker, initargs=(dict(dj.config),)) as executor:
+        errors += [error for error in executor.map(_segmentation_worker, keys) if error]
+
+    return summarize_sweep(paramsets, *restrictions), errors
+
+
+def summarize_sweep(paramsets, *restrictions, rank_by='mean_correlation'):
+    """
+    Summary of the segmentations of a sweep, one row per (recording, parameter set),
+    ranked by `rank_by` within each recording:
+        mask_count, median_npix, and the mean correlation and PNR of the masks at their
+        centres, in the SummaryImages of the segmented motion correction filtered with the
+        gSig of the parameter set
+    :param paramsets: dict of {paramset id: overrides} - see `register_sweep`
+    :return: pandas DataFrame
+    """
+    import pandas as pd
+    from .pipeline import miniscope, SummaryImages
+    from .motion_correction import get_registered_movie
+    from .summary_images import summary_gsig
+
+    paramset_pk = miniscope.ProcessingParamSet.primary_key[0]
+    recording_pk = miniscope.Recording.primary_key
+    gsigs = {paramset_id: summary_gsig(params) for paramset_id, params in zip(
+        *(miniscope.ProcessingParamSet & [{paramset_pk: p} for p in paramsets]).fetch(
+            paramset_pk, 'params'))}
+
+    rows = []
+    for key in (miniscope.Segmentation & [{paramset_pk: p} for p in paramsets]
+                & dj.AndList(restrictions)).fetch('KEY'):
+        npix, center_x, center_y = (miniscope.Segmentation.Mask & key).fetch(
+            'mask_npix', 'mask_center_x', 'mask_center_y')
+        row = {**{k: key[k] for k in recording_pk}, paramset_pk: key[paramset_pk],
+               **paramsets[key[paramset_pk]], 'mask_count': len(npix),
+               'median_npix': np.median(npix) if len(npix) else np.nan}
+
+        try:
+            task_key, _ = get_registered_movie(key)
+        except FileNotFoundError:
+            task_key = None
+        images = (SummaryImages & task_key & {'gsig': gsigs[key[paramset_pk]]}).fetch(
+            'correlation_image', 'pnr_image') if task_key else ([], [])
+        if len(images[0]) and len(npix):
+            row['mean_correlation'] = np.mean(images[0][0][center_y, center_x])
+            row['mean_pnr'] = np.mean(images[1][0][center_y, center_x])
+        rows.append(row)
+
+    summary = pd.DataFrame(rows)
+    if summary.empty or rank_by not in summary:
+        return summary
+    summary['rank'] = summary.groupby(recording_pk)[rank_by].rank(ascending=False,
+                                                                  method='min')
+    return summary.sort_values(recording_pk + ['rank']).reset_index(drop=True)
@@ -0,0 +1,98 @@
+import pathlib
+import tempfile
+
+import datajoint as dj
+import numpy as np
+
+
+# Trace matrix files -----------------------------------------------------------
+# One chunked, compressed HDF5 file per session holding its (ROIs x frames) traces
+# in the dataset 'traces'. Requires `h5py`. The files are a copy: the element's per-ROI
+# trace blobs are still inserted, so the traces are stored twice.
+
+def write_trace_matrix(filepath, traces, chunk_shape=(64, 4096), compression_level=4):
+    """
+    Write the (ROIs x frames) `traces` as a float32 HDF5 dataset chunked by `chunk_shape`
+    (clipped to the matrix shape) and gzip compressed
+    """
+    import h5py
+
+    traces = np.asarray(traces, dtype=np.float32)
+    chunks = tuple(max(1, min(c, s)) for c, s in zip(chunk_shape, traces.shape))
+    with h5py.File(filepath, 'w') as f:
+        if traces.size:
+            f.create_dataset('traces', data=traces, chunks=chunks, compression='gzip',
+                             compression_opts=compression_level, shuffle=True)
+        else:  # no ROIs
+            f.create_dataset('traces', data=traces)
+    return pathlib.Path(filepath)
+
+
+def read_trace_matrix(filepath, rows=slice(None), frames=slice(None)):
+    """
+    Read the `rows` (ROIs) x `frames` slice of a local trace matrix file - only the chunks
+    overlapping the slice are read and decompressed
+    :param rows: slice or increasing sequence of row indices
+    """
+    import h5py
+
+    with h5py.File(filepath, 'r') as f:
+        return f['traces'][rows, frames]
+
+
+# Pipeline ---------------------------------------------------------------------
+
+def get_trace_download_dir():
+    """ Local directory of the trace matrix files fetched from the external store """
+    download_dir = dj.config.get('custom', {}).get('miniscope_trace_download_dir', None)
+    if download_dir is None:
+        download_dir = pathlib.Path(tempfile.gettempdir()) / 'miniscope_traces'
+    download_dir = pathlib.Path(download_dir)
+    download_dir.mkdir(parents=True, exist_ok=True)
+    return download_dir
+
+
+def make_trace_matrix(table, key, traces):
+    """
+    Insert the `traces` (one per ROI, in row order) of `key` into `table` (TraceMatrix or
+    ActivityMatrix, within its `make`) as one trace matrix file, uploaded to the external store
+    """
+    traces = np.stack(traces) if len(traces) else np.empty((0, 0), dtype=np.float32)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        filepath = write_trace_matrix(
+            pathlib.Path(tmp_dir) / f'{type(table).__name__.lower()}_{dj.hash.key_hash(key)}.h5',
+            traces)
+        table.insert1(dict(key, nrois=traces.shape[0], nframes=traces.shape[1],
+                           trace_file=filepath))
+
+
+def get_trace_matrix_file(restriction, extraction_method=None):
+    """
+    Local path of the trace matrix file of one Fluorescence entry, or of its Activity
+    with `extraction_method`. The whole attached file is fetched to `get_trace_download_dir`
+    (from an external store, only if no identical copy is there yet) - the chunks are only
+    read selectively from the local copy.
+    """
+    from .pipeline import TraceMatrix, ActivityMatrix
+
+    if extraction_method is None:
+        table = TraceMatrix & restriction
+    else:
+        table = ActivityMatrix & restriction & {'extraction_method': extraction_method}
+    return pathlib.Path(table.fetch1('trace_file', download_path=get_trace_download_dir()))
+
+
+def fetch_trace_matrix(restriction, extraction_method=None, rows=slice(None),
+                       frames=slice(None)):
+    """
+    Fluorescence traces of one Fluorescence entry, or its activity traces with
+    `extraction_method`, as a single (ROIs x frames) array - the first call downloads the
+    whole file (see `get_trace_matrix_file`)
+    :return: (traces, row keys - the Fluorescence.Trace key of each row)
+    """
+    from .pipeline import TraceMatrix
+
+    row_keys = (TraceMatrix.Row & restriction).fetch('KEY', order_by='trace_row')
+    traces = read_trace_matrix(get_trace_matrix_file(restriction, extraction_method),
+                               rows=rows, frames=frames)
+    return traces, list(np.asarray(row_keys, dtype=object)[rows])
@@ -0,0 +1,179 @@
+import collections
+
+import datajoint as dj
+import numpy as np
+
+# `pipeline` is imported within the functions: importing the module does not connect to
+# the database
+
+
+class LRUCache:
+    """
+    Least-recently-used cache of arrays bounded by their total size in bytes
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._arrays = collections.OrderedDict()
+
+    def __contains__(self, key):
+        return key in self._arrays
+
+    def __len__(self):
+        return len(self._arrays)
+
+    def get(self, key):
+        self._arrays.move_to_end(key)
+        return self._arrays[key]
+
+    def put(self, key, array):
+        if key in self._arrays:
+            self.nbytes -= self._arrays.pop(key).nbytes
+        if array.nbytes > self.max_bytes:
+            return
+        self._arrays[key] = array
+        self.nbytes += array.nbytes
+        while self.nbytes > self.max_bytes:
+            self.nbytes -= self._arrays.popitem(last=False)[1].nbytes
+
+    def clear(self):
+        self._arrays.clear()
+        self.nbytes = 0
+
+
+def _default_cache():
+    max_mb = dj.config.get('custom', {}).get('miniscope_trace_cache_mb', 512)
+    return LRUCache(max_mb * 2 ** 20)
+
+
+trace_cache = _default_cache()
+
+
+class TraceView:
+    """
+    Lazy, sliceable (ROIs x frames) view of the fluorescence traces of one Fluorescence
+    entry, or of its activity traces for an `extraction_method`:
+        view[rows, frames] - e.g. view[:10], view[[3, 7], 1000:2000]
+        view.window(start, stop, rows) - frames between `start` and `stop` seconds
+    Only the blocks of `block_shape` (ROIs, frames) overlapping a slice are loaded, from the
+    trace matrix file if the entry has one (see `trace_matrix` - the whole file is downloaded
+    on the first load), else from the trace blobs of the ROIs, and kept in a bounded LRU cache
+    shared by the views.
+    """
+
+    def __init__(self, key, extraction_method=None, cache=None, block_shape=(64, 4096)):
+        from .pipeline import miniscope, TraceMatrix, ActivityMatrix
+
+        self.key = (miniscope.Fluorescence & key).fetch1('KEY')
+        if extraction_method is not None:
+            self.key['extraction_method'] = extraction_method
+        self.extraction_method = extraction_method
+        self.cache = trace_cache if cache is None else cache
+        self.block_shape = block_shape
+
+        self.row_keys = (miniscope.Fluorescence.Trace & self.key).fetch('KEY', order_by='mask')
+        self.fps = (miniscope.RecordingInfo & self.key).fetch1('fps')
+
+        # the length of the stored traces, which may differ from RecordingInfo.nframes
+        matrix_table = (TraceMatrix if extraction_method is None else ActivityMatrix) & self.key
+        self.has_trace_matrix = bool(matrix_table)
+        if self.has_trace_matrix:
+            nframes = matrix_table.fetch1('nframes')
+        elif self.row_keys:
+            nframes = len(self._read_traces(slice(0, 1))[0])
+        else:
+            nframes = 0
+        self.shape = (len(self.row_keys), int(nframes))
+        self._cache_id = dj.hash.key_hash(self.key)
+        self._trace_file = None
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __repr__(self):
+        return f'TraceView({self.key}, shape={self.shape})'
+
+    def __getitem__(self, item):
+        rows, frames = item if isinstance(item, tuple) else (item, slice(None))
+        row_index = np.arange(self.shape[0])[rows]
+        frame_index = np.arange(self.shape[1])[frames]
+        squeeze = (np.ndim(row_index) == 0, np.ndim(frame_index) == 0)
+        row_index, frame_index = np.atleast_1d(row_index), np.atleast_1d(frame_index)
+
+        traces = np.empty((len(row_index), len(frame_index)), dtype=np.float32)
+        block_rows, block_frames = self.block_shape
+        for row_block in np.unique(row_index // block_rows):
+            in_rows = np.flatnonzero(row_index // block_rows == row_block)
+            for frame_block in np.unique(frame_index // block_frames):
+                in_frames = np.flatnonzero(frame_index // block_frames == frame_block)
+                block = self._get_block(row_block, frame_block)
+                traces[np.ix_(in_rows, in_frames)] = block[np.ix_(
+                    row_index[in_rows] - row_block * block_rows,
+                    frame_index[in_frames] - frame_block * block_frames)]
+
+        if squeeze[1]:
+            traces = traces[:, 0]
+        return traces[0] if squeeze[0] else traces
+
+    def window(self, start, stop, rows=slice(None)):
+        """ Traces of `rows` between `start` and `stop` seconds from the first frame """
+        return self[rows, int(np.floor(start * self.fps)):int(np.ceil(stop * self.fps))]
+
+    def _get_block(self, row_block, frame_block):
+        cache_key = (self._cache_id, row_block, frame_block)
+        if cache_key in self.cache:
+            return self.cache.get(cache_key)
+        return self._load_blocks(row_block, frame_block)
+
+    def _load_blocks(self, row_block, frame_block):
+        """ Load (and cache) the block `frame_block` of the rows of `row_block` """
+        block_rows, block_frames = self.block_shape
+        rows = slice(row_block * block_rows, min((row_block + 1) * block_rows, self.shape[0]))
+
+        if self.has_trace_matrix:
+            frames = slice(frame_block * block_frames,
+                           min((frame_block + 1) * block_frames, self.shape[1]))
+            block = self._read_matrix(rows, frames)
+            self.cache.put((self._cache_id, row_block, frame_block), block)
+            return block
+
+        # one blob per ROI: the whole traces are decoded anyway - cache all their blocks
+        traces = self._read_traces(rows)
+        blocks = {first // block_frames: np.asarray(traces[:, first:first + block_frames],
+                                                    dtype=np.float32)
+                  for first in range(0, traces.shape[1], block_frames)}
+        for block_id in sorted(blocks, key=lambda block_id: block_id == frame_block):
+            self.cache.put((self._cache_id, row_block, block_id), blocks[block_id])
+        return blocks[frame_block]
+
+    def _read_matrix(self, rows, frames):
+        """ `rows` x `frames` slice of the trace matrix file """
+        from .trace_matrix import get_trace_matrix_file, read_trace_matrix
+
+        if self._trace_file is None:
+            self._trace_file = get_trace_matrix_file(self.key, self.extraction_method)
+        return read_trace_matrix(self._trace_file, rows, frames)
+
+    def _read_traces(self, rows):
+        """ (ROIs x frames) traces of the `rows` slice, from the trace blobs of the ROIs """
+        from .pipeline import miniscope
+
+        if self.extraction_method is None:
+            table, attribute = miniscope.Fluorescence.Trace & self.key, 'fluorescence'
+        else:
+            table, attribute = miniscope.Activity.Trace & self.key, 'activity_trace'
+        return np.stack((table & self.row_keys[rows]).fetch(attribute, order_by='mask'))
+
+
+def fetch_trace_views(restriction, extraction_method=None, cache=None):
+    """
+    Lazy TraceView of each Fluorescence entry in `restriction` (e.g. dozens of sessions) -
+    no trace is loaded until sliced
+    :param extraction_method: Activity traces of this extraction method instead of the
+     fluorescence traces
+    """
+    from .pipeline import miniscope
+
+    return [TraceView(key, extraction_method=extraction_method, cache=cache)
+            for key in (miniscope.Fluorescence & restriction).fetch('KEY')]
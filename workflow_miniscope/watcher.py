@@ -0,0 +1,251 @@
+import os
+import time
+import asyncio
+import fnmatch
+import pathlib
+
+from .paths import (get_miniscope_root_data_dir, get_miniscope_root_data_dirs,
+                    get_miniscope_scratch_dir, get_relative_path)
+from .discovery import scan_patterns, discover_sessions, find_recording
+from .metrics import measure_stage
+
+# `pipeline` is imported within the functions, as in `ingest`
+
+
+def _session_signature(session_dir):
+    """ (name, size, modification time) of the files of a session directory """
+    try:
+        with os.scandir(session_dir) as it:
+            return tuple(sorted((entry.name, entry.stat().st_size, entry.stat().st_mtime_ns)
+                                for entry in it if entry.is_file()))
+    except FileNotFoundError:
+        return None
+
+
+def ingest_session_dir(session_dir, root_data_dirs=None, populate=True):
+    """
+    Insert the Session, SessionDirectory and miniscope.Recording entries of one session
+    directory (root / subject / ... / ms*.avi) of a subject already in subject.Subject,
+    then populate its miniscope.RecordingInfo if `populate`
+    :return: session key, None if the subject is unknown or the recording is directly in a root
+    """
+    from .pipeline import subject, session, miniscope
+    from .ingest import _new_session_entries, _recording_scanner, insert_sessions
+    from .recording_info import populate_recording_info
+
+    root_data_dirs = root_data_dirs or get_miniscope_root_data_dirs()
+    recording = find_recording(session_dir)
+    recording_dir = get_relative_path(recording.session_dir, root_data_dirs)
+    if not recording_dir.parts:  # no subject directory
+        return None
+    subject_name = recording_dir.parts[0]
+    if not subject.Subject & {'subject': subject_name}:
+        return None
+
+    session_key = {'subject': subject_name, 'session_datetime': recording.recording_time}
+    with measure_stage('ingest_watched_session', session_key, session.Session):
+        existing_keys = set(zip(*(session.Session & session_key).fetch('subject',
+                                                                       'session_datetime')))
+        _, scanner_list, session_list, session_dir_list = _new_session_entries(
+            [(subject_name, recording)], root_data_dirs, existing_keys)
+        insert_sessions(session_list, session_dir_list, scanner_list=scanner_list)
+
+        # queue the session for RecordingInfo - one recording per session
+        recording_key = dict(session_key, recording_id=0)
+        miniscope.Recording.insert1(dict(recording_key, scanner=_recording_scanner(recording),
+                                         acquisition_software=recording.acq_software,
+                                         recording_directory=recording_dir.as_posix(),
+                                         recording_notes=''), skip_duplicates=True)
+
+    if populate:
+        for _, error in populate_recording_info(recording_key, suppress_errors=True):
+            print(f'---- Failed to populate the RecordingInfo of {session_dir} ({error}) ----')
+    return session_key
+
+
+class SessionWatcher:
+    """
+    Ingest new session directories under the root data directory as soon as their
+    recording files settle, i.e. once the names, sizes and modification times of their
+    files are unchanged for `settle_time` seconds (see `ingest_session_dir`).
+    New files are noticed with inotify (Linux, requires `inotify_simple`), else - or once
+    out of inotify watches - by walking the tree every `poll_interval` seconds.
+    Sessions of unknown subjects are reported and skipped until the watcher restarts.
+    :param clock: function returning the current time in seconds (default: time.monotonic)
+    """
+
+    def __init__(self, root_data_dir=None, settle_time=30, poll_interval=60, populate=True,
+                 use_inotify=True, clock=time.monotonic):
+        self.root_data_dir = pathlib.Path(root_data_dir or get_miniscope_root_data_dir())
+        self.clock = clock
+        self.settle_time = settle_time
+        self.poll_interval = poll_interval
+        self.populate = populate
+        self.use_inotify = use_inotify
+        self.pending = {}  # session directory: (signature, time of its last change)
+        self.done = set()  # ingested or skipped session directories
+        scratch_dir = get_miniscope_scratch_dir()
+        self._scratch_dir = pathlib.Path(scratch_dir) if scratch_dir else None
+        self._inotify = None
+        self._watches = {}  # inotify watch descriptor: directory
+
+    # candidates -----------------------------------------------------------------
+
+    def _add_candidate(self, session_dir):
+        session_dir = pathlib.Path(session_dir)
+        if (session_dir in self.done or session_dir in self.pending
+                or (self._scratch_dir and self._scratch_dir in session_dir.parents)):
+            return
+        self.pending[session_dir] = (_session_signature(session_dir), self.clock())
+
+    def _settled(self):
+        """ Update the signatures of the pending session directories
+        :return: the session directories unchanged for `settle_time` """
+        now, settled = self.clock(), []
+        for session_dir, (signature, since) in list(self.pending.items()):
+            new_signature = _session_signature(session_dir)
+            if new_signature is None:
+                del self.pending[session_dir]  # removed or renamed
+            elif new_signature != signature:
+                self.pending[session_dir] = (new_signature, now)
+            elif now - since >= self.settle_time:
+                settled.append(session_dir)
+        return settled
+
+    def _discover(self):
+        for recording in discover_sessions(self.root_data_dir):
+            self._add_candidate(recording.session_dir)
+
+    # inotify --------------------------------------------------------------------
+
+    def _start_inotify(self, loop):
+        """ :return: True if the tree is watched with inotify """
+        try:
+            from inotify_simple import INotify, flags
+        except ImportError:
+            return False
+
+        self._flags = flags
+        self._inotify = INotify()
+        try:
+            self._watch_tree(self.root_data_dir)
+        except OSError as error:  # e.g. out of watches (fs.inotify.max_user_watches)
+            print(f'---- Failed to watch {self.root_data_dir} with inotify ({error}),'
+                  f' polling every {self.poll_interval}s ----')
+            self._stop_inotify(loop)
+            return False
+
+        loop.add_reader(self._inotify.fileno(), self._read_events)
+        return True
+
+    def _stop_inotify(self, loop):
+        if self._inotify is not None:
+            loop.remove_reader(self._inotify.fileno())
+            self._inotify.close()
+            self._inotify, self._watches = None, {}
+
+    def _watch_tree(self, directory):
+        """ Watch `directory` and its sub-directories, adding the sessions found in them """
+        mask = (self._flags.CREATE | self._flags.MOVED_TO | self._flags.CLOSE_WRITE
+                | self._flags.Q_OVERFLOW)
+        for dirpath, subdirs, filenames in os.walk(directory):
+            dirpath = pathlib.Path(dirpath)
+            if self._scratch_dir and (dirpath == self._scratch_dir
+                                      or self._scratch_dir in dirpath.parents):
+                subdirs[:] = []
+                continue
+            self._watches[self._inotify.add_watch(dirpath, mask)] = dirpath
+            if any(fnmatch.filter(filenames, pattern) for pattern in scan_patterns.values()):
+                self._add_candidate(dirpath)
+
+    def _read_events(self):
+        for event in self._inotify.read(timeout=0):
+            if event.mask & self._flags.Q_OVERFLOW:
+                print('---- inotify queue overflow, re-scanning the root data directory ----')
+                self._discover()
+                continue
+            directory = self._watches.get(event.wd)
+            if directory is None:
+                continue
+            if event.mask & self._flags.ISDIR:
+                # files may be written before the watch is added - `_watch_tree` lists them
+                try:
+                    self._watch_tree(directory / event.name)
+                except OSError as error:
+                    print(f'---- Failed to watch {directory / event.name} ({error}) ----')
+            elif any(fnmatch.fnmatch(event.name, pattern) for pattern in scan_patterns.values()):
+                self._add_candidate(directory)
+
+    # service --------------------------------------------------------------------
+
+    async def run(self, stop=None):
+        """
+        Watch and ingest until `stop` (asyncio.Event) is set
+        """
+        from .pipeline import session
+
+        loop = asyncio.get_running_loop()
+        stop = stop or asyncio.Event()
+
+        # session directories already ingested, e.g. before a restart
+        root_data_dirs = get_miniscope_root_data_dirs()
+        session_dirs = await loop.run_in_executor(None, session.SessionDirectory.fetch,
+                                                  'session_dir')
+        self.done.update(self.root_data_dir / session_dir for session_dir in session_dirs)
+
+        inotify = self.use_inotify and self._start_inotify(loop)
+        print(f'\n---- Watching {self.root_data_dir}'
+              f' ({"inotify" if inotify else f"polling every {self.poll_interval}s"}) ----')
+        if not inotify:
+            await loop.run_in_executor(None, self._discover)
+
+        last_poll = self.clock()
+        try:
+            while not stop.is_set():
+                if not inotify and self.clock() - last_poll >= self.poll_interval:
+                    await loop.run_in_executor(None, self._discover)
+                    last_poll = self.clock()
+
+                for session_dir in self._settled():
+                    del self.pending[session_dir]
+                    self.done.add(session_dir)
+                    try:
+                        session_key = await loop.run_in_executor(
+                            None, ingest_session_dir, session_dir, root_data_dirs,
+                            self.populate)
+                    except Exception as error:
+                        print(f'---- Failed to ingest {session_dir}'
+                              f' ({error.__class__.__name__}: {error}),'
+                              f' retrying in {self.settle_time}s ----')
+                        self.done.discard(session_dir)
+                        self._add_candidate(session_dir)
+                        continue
+                    if session_key is None:
+                        print(f'---- Skipped {session_dir}: unknown subject, or not in a'
+                              f' subject directory ----')
+                    else:
+                        print(f'---- Ingested {session_dir} ----')
+
+                try:  # check the pending sessions every second
+                    await asyncio.wait_for(stop.wait(), timeout=1)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self._stop_inotify(loop)
+
+
+def watch(root_data_dir=None, settle_time=30, poll_interval=60, populate=True, use_inotify=True):
+    """
+    Run a SessionWatcher until interrupted (SIGINT/SIGTERM)
+    """
+    async def main():
+        import signal
+
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stop.set)
+        await SessionWatcher(root_data_dir, settle_time=settle_time, poll_interval=poll_interval,
+                             populate=populate, use_inotify=use_inotify).run(stop)
+
+    asyncio.run(main())